@@ -0,0 +1,127 @@
+'''
+axis_units converts gantry poses between mm/degrees and controller counts,
+for whole arrays of poses at once.
+
+A pose is x,y,z in mm and phi,theta in degrees, as passed to
+gantrycontrol.move().  Counts are what the controller is sent (PA), with z
+and theta flipped to the right handed coordinate system.  Each axis is
+linear (units_per_count) unless it has a calibration table: pairs of
+(pose value, counts) measured on the gantry, interpolated piecewise
+linearly and continued with the nominal factor past the ends.
+
+Calibration tables are kept in a JSON file, by axis name:
+
+  { "x": [ [0, 0], [500, 44920], [1000, 89870] ], "theta": [ ... ] }
+
+Usage:
+
+> from axis_units import axis_units
+> units = axis_units()
+> units.load( 'axis_calibration.json' )      # optional calibration tables
+> counts = units.to_counts( poses )          # poses: (N,5) array, or one pose of 5 values
+> poses = units.from_counts( counts )
+> units.check( counts, lower, upper )        # raises ValueError listing the poses out of range
+'''
+import json
+import numpy as np
+
+axis_names = ( 'x', 'y', 'z', 'phi', 'theta' )
+
+#Calibration of each axis: mm per count for x,y,z and degrees per count for phi,theta
+units_per_count = (0.01113, 0.009382, 0.009355, 0.0226, 180./1000)
+
+#Sign of the counts of each axis for a positive pose value (right handed z and theta)
+count_signs = (1, 1, -1, 1, 1)
+
+#File of the calibration tables used by default (gantrycontrol, scan plans, sweeps)
+default_calibration = 'axis_calibration.json'
+
+#Pose distance (mm, degrees) the ends of a calibration table are continued by
+_far = 1e7
+
+
+class axis_units:
+    '''
+    Pose <-> counts conversion of the 5 axes.
+
+    units_per_count = nominal mm or degrees per count of each axis
+    signs           = sign of the counts of each axis
+    tables          = { axis name: [ (pose value, counts), ... ] } calibration tables
+    '''
+    def __init__( self, units_per_count=units_per_count, signs=count_signs, tables=None ):
+        self.counts_per_unit = np.array( signs, dtype=float ) / np.array( units_per_count, dtype=float )
+        self.tables = {}
+        self.knots = [ None ]*5 # (pose values, counts) interpolated for each calibrated axis
+        for name, table in ( tables or {} ).items():
+            self.set_table( name, table )
+
+    def set_table( self, name, table ):
+        '''Use the calibration table of (pose value, counts) pairs for axis name, None for linear'''
+        k = axis_names.index( name )
+        if table is None or len(table) == 0:
+            self.tables.pop( name, None )
+            self.knots[k] = None
+            return
+        table = np.array( sorted( table ), dtype=float )
+        if len(table) > 1 and np.any( np.diff( table[:,1] )*self.counts_per_unit[k] <= 0 ):
+            raise ValueError( 'calibration table of ' + name + ' is not monotonic' )
+        slope = self.counts_per_unit[k]
+        units = np.concatenate( [ [ table[0,0] - _far ], table[:,0], [ table[-1,0] + _far ] ] )
+        counts = np.concatenate( [ [ table[0,1] - slope*_far ], table[:,1], [ table[-1,1] + slope*_far ] ] )
+        self.tables[name] = table.tolist()
+        self.knots[k] = ( units, counts )
+
+    def to_counts( self, poses, rounded=True ):
+        '''Counts of poses ((N,5) or 5 values, NaN for unknown), rounded to whole counts'''
+        poses = np.asarray( poses, dtype=float )
+        counts = poses * self.counts_per_unit
+        for k, knots in enumerate( self.knots ):
+            if knots is not None:
+                counts[...,k] = np.interp( poses[...,k], *knots )
+        return np.round( counts ) if rounded else counts
+
+    def from_counts( self, counts ):
+        '''Poses of counts ((N,5) or 5 values)'''
+        counts = np.asarray( counts, dtype=float )
+        poses = counts / self.counts_per_unit
+        for k, knots in enumerate( self.knots ):
+            if knots is not None:
+                units, kcounts = knots
+                if kcounts[-1] < kcounts[0]: # np.interp needs increasing x
+                    units, kcounts = units[::-1], kcounts[::-1]
+                poses[...,k] = np.interp( counts[...,k], kcounts, units )
+        return poses
+
+    def check( self, counts, lower, upper ):
+        '''
+        Raise ValueError if any counts are outside lower..upper (5 values each, None for
+        no limit), naming the first rows out of range.  Returns counts.
+        '''
+        counts = np.asarray( counts, dtype=float ).reshape( -1, 5 )
+        bad = np.zeros( counts.shape, dtype=bool )
+        for k in range(5):
+            if lower[k] is not None:
+                bad[:,k] |= counts[:,k] < lower[k]
+            if upper[k] is not None:
+                bad[:,k] |= counts[:,k] > upper[k]
+        rows = np.nonzero( bad.any( axis=1 ) )[0]
+        if len(rows) > 0:
+            raise ValueError( '%d poses out of range, first: ' % len(rows) +
+                              '; '.join( 'row %d %s %d' % ( r, axis_names[k], counts[r,k] )
+                                         for r in rows[:5] for k in np.nonzero( bad[r] )[0] ) )
+        return counts
+
+    def load( self, fname ):
+        '''Use the calibration tables saved in fname, returns False if there is none.'''
+        try:
+            with open( fname, 'r' ) as f:
+                tables = json.load( f )
+        except FileNotFoundError:
+            return False
+        for name, table in tables.items():
+            self.set_table( name, table )
+        return True
+
+    def save( self, fname ):
+        with open( fname, 'w' ) as f:
+            json.dump( self.tables, f, indent=1 )
@@ -0,0 +1,253 @@
+'''
+camera_workers runs each camera in its own long lived worker process.
+
+Spawning gphoto2 for every shot opens the USB device, claims the interface
+and negotiates the PTP session again each time.  A worker opens the session
+once and then takes commands over a queue, so only the capture itself is
+paid per shot.  If a worker crashes only that camera is affected, and it is
+restarted on its next command.
+
+The camera itself is behind a backend class, constructed in the worker with
+the port, with the methods:
+
+  serial_number()            -> serial number of the camera
+  capture( imgname )         take a photo and download it to imgname
+  trigger()                  -> path on the camera of a new photo left there
+  download( campath, imgname ) download campath to imgname and delete it
+  close()
+
+and a staticmethod detect() -> [ [port, cam_type], ... ] run in the main
+process.  libgphoto2_camera uses the python-gphoto2 bindings, fake_camera
+pretends to be a camera for testing without hardware.
+
+Usage:
+
+> import pgcamera2 as pg
+> from camera_workers import fake_camera
+> pgc = pg.pgcamera2( buildcamerafile=True, backend=fake_camera )
+> print( pgc.capture_all( ['1','2'], label='test' ) )
+'''
+import importlib
+import os
+import pickle
+import queue
+import subprocess
+import sys
+import threading
+import time
+try:
+    import gphoto2 as gp
+except ImportError:
+    gp = None
+
+
+class CameraError(Exception):
+    '''A camera worker command failed, or the worker died.'''
+    pass
+
+
+class libgphoto2_camera:
+    '''Camera session kept open with the libgphoto2 python bindings.'''
+    def __init__( self, port ):
+        if gp is None:
+            raise CameraError('libgphoto2_camera needs the gphoto2 python package')
+        ports = gp.PortInfoList()
+        ports.load()
+        self.camera = gp.Camera()
+        self.camera.set_port_info( ports[ ports.lookup_path( port ) ] )
+        self.camera.init()
+
+    @staticmethod
+    def detect():
+        if gp is None:
+            raise CameraError('libgphoto2_camera needs the gphoto2 python package')
+        return [ [port, name] for name, port in gp.Camera.autodetect() ]
+
+    def serial_number( self ):
+        return self.camera.get_single_config( 'serialnumber' ).get_value()
+
+    def capture( self, imgname ):
+        self.download( self.trigger(), imgname )
+
+    def trigger( self ):
+        path = self.camera.capture( gp.GP_CAPTURE_IMAGE )
+        return path.folder.rstrip('/') + '/' + path.name
+
+    def download( self, campath, imgname ):
+        folder, name = campath.rsplit( '/', 1 )
+        self.camera.file_get( folder, name, gp.GP_FILE_TYPE_NORMAL ).save( imgname )
+        self.camera.file_delete( folder, name )
+
+    def close( self ):
+        self.camera.exit()
+
+
+class fake_camera:
+    '''
+    Pretend camera for testing.  Opening the session takes setup seconds
+    and each exposure takes exposure seconds.  The number of cameras
+    detected is set with the environment variable PGCAMERA_FAKE_CAMERAS.
+    '''
+    def __init__( self, port, setup=0.5, exposure=0.2 ):
+        time.sleep( setup )
+        self.port = port
+        self.exposure = exposure
+        self.card = {}  # path -> image
+        self.shots = 0
+
+    @staticmethod
+    def detect():
+        ncam = int( os.environ.get( 'PGCAMERA_FAKE_CAMERAS', '2' ) )
+        return [ [ 'fake:'+str(i+1), 'Fake camera' ] for i in range(ncam) ]
+
+    def serial_number( self ):
+        return 'FAKE' + self.port.split(':')[1]
+
+    def capture( self, imgname ):
+        self.download( self.trigger(), imgname )
+
+    def trigger( self ):
+        time.sleep( self.exposure )
+        self.shots += 1
+        campath = '/DCIM/100FAKE/IMG_%04d.JPG' % self.shots
+        self.card[campath] = b'\xff\xd8 fake image from ' + self.port.encode() + b'\xff\xd9'
+        return campath
+
+    def download( self, campath, imgname ):
+        if campath not in self.card:
+            raise CameraError( campath + ' is not on the camera' )
+        with open( imgname, 'wb' ) as f:
+            f.write( self.card.pop( campath ) )
+
+    def close( self ):
+        pass
+
+
+def worker_main( module, name, port ):
+    '''
+    Body of a worker process: open the camera session with the backend
+    class name from module, then run the (method, args) requests read from
+    stdin until None is received.  Replies are written to stdout, so
+    anything the backend prints goes to stderr instead.
+    '''
+    requests = sys.stdin.buffer
+    replies = os.fdopen( os.dup( 1 ), 'wb' )
+    os.dup2( 2, 1 )
+    def reply( status, value ):
+        pickle.dump( (status, value), replies )
+        replies.flush()
+    try:
+        tstart = time.time()
+        camera = getattr( importlib.import_module( module ), name )( port )
+        reply( 'ready', time.time()-tstart )
+    except Exception as e:
+        reply( 'error', repr(e) )
+        return
+    while True:
+        try:
+            request = pickle.load( requests )
+        except EOFError:
+            break
+        if request is None:
+            break
+        method, args = request
+        try:
+            reply( 'ok', getattr( camera, method )( *args ) )
+        except Exception as e:
+            reply( 'error', repr(e) )
+    camera.close()
+
+
+class camera_worker:
+    '''
+    Handle on the worker process for the camera at port, using the backend
+    class.  call() runs a backend method in the worker.  timeout is the
+    longest a command may take (s) before the worker is killed.
+
+    The worker is a new python process running this file, rather than a
+    multiprocessing fork, so the scan script that started it is not run
+    again in it.
+    '''
+    def __init__( self, backend, port, timeout=60.0 ):
+        self.backend = backend
+        self.port = port
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.process = None
+        self.setup_time = None  # seconds it took to open the camera session
+        self.restarts = 0
+
+    def start( self ):
+        command = [ sys.executable, os.path.abspath( __file__ ),
+                    self.backend.__module__, self.backend.__qualname__, self.port ]
+        self.process = subprocess.Popen( command, stdin=subprocess.PIPE, stdout=subprocess.PIPE )
+        self.replies = queue.Queue()
+        reader = threading.Thread( target=self.read_replies, args=(self.process, self.replies), daemon=True )
+        reader.start()
+        status, value = self.reply()
+        if status != 'ready':
+            self.stop()
+            raise CameraError( 'camera on port '+self.port+' did not open: '+str(value) )
+        self.setup_time = value
+        print('camera on port',self.port,'session opened in',round(value,2),'s')
+
+    def read_replies( self, process, replies ):
+        try:
+            while True:
+                replies.put( pickle.load( process.stdout ) )
+        except (EOFError, OSError, pickle.UnpicklingError):
+            pass
+
+    def reply( self ):
+        '''Wait for the worker to reply, noticing if it died.'''
+        tend = time.time() + self.timeout
+        while True:
+            try:
+                return self.replies.get( timeout=0.1 )
+            except queue.Empty:
+                pass
+            if self.process.poll() is not None:
+                raise CameraError( 'camera worker on port '+self.port+' died' )
+            if time.time() > tend:
+                self.process.kill()
+                raise CameraError( 'camera on port '+self.port+' did not answer in '+str(self.timeout)+' s' )
+
+    def send( self, request ):
+        pickle.dump( request, self.process.stdin )
+        self.process.stdin.flush()
+
+    def call( self, method, *args ):
+        '''Run the backend method with args in the worker, return its result.'''
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                if self.process is not None:
+                    self.restarts += 1
+                self.start()
+            try:
+                self.send( (method, args) )
+            except OSError:
+                raise CameraError( 'camera worker on port '+self.port+' died' )
+            status, value = self.reply()
+            if status != 'ok':
+                raise CameraError( value )
+            return value
+
+    def stop( self ):
+        '''Close the camera session and end the worker.'''
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            try:
+                self.send( None )
+                self.process.wait( 5 )
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+        self.process = None
+
+
+# backends by the names used on the command line, gphoto2 runs a new gphoto2 process per command
+backends = { 'gphoto2': None, 'libgphoto2': libgphoto2_camera, 'fake': fake_camera }
+
+
+if __name__ == "__main__":
+    worker_main( sys.argv[1], sys.argv[2], sys.argv[3] )
@@ -3,6 +3,7 @@
 import sys
 import argparse
 import pgcamera2 as pg
+import camera_workers
 import time
 
 def main():
@@ -13,6 +14,7 @@ def main():
     parser.add_argument('--dir',default='.',help='Directory to place images',type=str )
     parser.add_argument('--imglabel',default='img',help='Label to add to image',type=str )
     parser.add_argument('--buildcamfile',default=False,help='Build pgcamera_cameras.txt',type=bool )
+    parser.add_argument('--backend',default='gphoto2',choices=sorted(camera_workers.backends),help='gphoto2 runs gphoto2 for each image, the others keep a session open per camera')
     
     args = parser.parse_args()
     print(args)
@@ -23,17 +25,19 @@ def main():
     print('imglabel=',args.imglabel)
     print('buildcamfile=',args.buildcamfile)
     if args.buildcamfile:
-        pgc = pg.pgcamera( buildcamerafile=True)
+        pgc = pg.pgcamera2( buildcamerafile=True, backend=camera_workers.backends[args.backend] )
+    else:
+        pgc = pg.pgcamera2( backend=camera_workers.backends[args.backend] )
                         
     nimg = 0
     while True:
-        pgc = pg.pgcamera2( )
         #print(pgc.camvitals)
         pg.print_camera_list( pgc.camvitals )
-        for iser, icam, iaddr, iname in pgc.camvitals:
-            pgc.capture_image( icam,  dir=args.dir, label=args.imglabel, append_date=args.appenddate )
+        results = pgc.capture_all( [ icam for iser, icam, iaddr, iname in pgc.camvitals ],
+                                   dir=args.dir, label=args.imglabel, append_date=args.appenddate )
+        for icam, res in results.items():
+            print('Camera',icam,':',res['file'],'in',round(res['latency'],1),'s', '' if res['error'] is None else res['error'])
 
-        del pgc
         nimg = nimg + 1
         if args.nimages != -1 and nimg >= args.nimages:
             break;
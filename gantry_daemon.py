@@ -0,0 +1,330 @@
+'''
+gantry_daemon holds the one connection to the controller and serves the
+gantry to other programs on a local socket.
+
+Without it every script builds its own gantrycontrol, paying for GOpen,
+load_position and the servo setup at startup, and two scripts can not use
+the gantry at the same time.  Clients of the daemon connect in milliseconds,
+moves are run one at a time, any number of clients can read or stream the
+position meanwhile, and a client can take the motion lease so nobody else
+moves the gantry until it is done.
+
+Requests and replies are JSON lines over TCP on localhost:
+
+  {"method": "move_rel", "args": [10, 0, 0]}  ->  {"result": ...} or {"error": "..."}
+  {"method": "subscribe", "period": 0.1}      ->  {"event": "position", "t": ..., "position": [...]} every period
+
+Start the daemon with (see --help, --emulate runs it on the emulator):
+
+  python gantry_daemon.py --fast-home
+
+and in the scripts use connect(), which gives a client of the daemon if one
+is running, else a gantrycontrol of its own:
+
+> import gantry_daemon as gd
+> gantry = gd.connect()
+> gantry.move_rel( 10 )                 # same methods as gantrycontrol
+> with gantry.lease( 'led scan' ):      # nobody else moves the gantry meanwhile
+>     gantry.move( 100, 200 )
+> for t, position in gantry.subscribe( 0.1 ):   # position stream, on its own connection
+>     print( t, position )
+'''
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+default_address = ( '127.0.0.1', 7311 )
+
+# gantrycontrol methods run one at a time, only by the lease holder if the lease is taken
+motion_methods = { 'move', 'move_rel', 'move_to_centre', 'locate_home_xyz', 'locate_home_fast', 'home',
+                   'set_theta_phi_origin', 'wait_settled', 'sync', 'save_position', 'load_position',
+                   'start_telemetry', 'stop_telemetry' }
+
+# gantrycontrol methods anyone can call at any time
+query_methods = { 'get_cur_pos', 'get_cur_pos_mm', 'position_text', 'get_max', 'clock', 'encoder_position',
+                  'home_trusted', 'position_trusted', 'convert', 'unconvert' }
+
+# gantrycontrol attributes clients can read
+attributes = { 'settle_times', 'saved_round_trips', 'connect_position', 'saved_position', 'file_galilpos' }
+
+
+class GantryDaemonError(Exception):
+    '''The daemon could not be reached, or refused or failed a request.'''
+    pass
+
+
+def daemon_address():
+    '''Address of the daemon: GANTRY_DAEMON=host:port, else default_address'''
+    address = os.environ.get( 'GANTRY_DAEMON', '' )
+    if address == '':
+        return default_address
+    host, port = address.rsplit( ':', 1 )
+    return ( host, int(port) )
+
+
+def to_json( value ):
+    '''Tuples, NumPy arrays and numbers of gantrycontrol results as JSON'''
+    return json.dumps( value, default=lambda o: o.tolist() if hasattr( o, 'tolist' ) else str(o) ) + '\n'
+
+
+class gantry_daemon( socketserver.ThreadingTCPServer ):
+    '''
+    Serves gantry (a gantrycontrol) at address.  Each client connection is
+    handled in its own thread.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__( self, gantry, address=default_address ):
+        socketserver.ThreadingTCPServer.__init__( self, address, gantry_handler )
+        self.gantry = gantry
+        self.motion = threading.Lock()      # held while a motion method runs
+        self.lease = threading.Condition()
+        self.lease_owner = None             # handler holding the motion lease
+        self.lease_name = ''
+        self.requests = 0
+        self.last_position = None           # (t, counts) last read for the position stream
+
+    def acquire_lease( self, handler, name, timeout ):
+        with self.lease:
+            if not self.lease.wait_for( lambda: self.lease_owner in (None, handler), timeout ):
+                raise GantryDaemonError( 'gantry is leased by ' + self.lease_name )
+            self.lease_owner = handler
+            self.lease_name = name
+        return True
+
+    def release_lease( self, handler ):
+        with self.lease:
+            if self.lease_owner is handler:
+                self.lease_owner = None
+                self.lease_name = ''
+                self.lease.notify_all()
+        return True
+
+    def call( self, handler, method, args, kwargs ):
+        '''Run one request of handler'''
+        self.requests += 1
+        if method in query_methods:
+            with self.gantry.lock: # commands of the query together on the connection, see gantrycontrol.lock
+                return getattr( self.gantry, method )( *args, **kwargs )
+        if method == 'get':
+            if args[0] not in attributes:
+                raise GantryDaemonError( 'no attribute ' + str(args[0]) )
+            return getattr( self.gantry, args[0] )
+        if method == 'acquire_lease':
+            return self.acquire_lease( handler, *args, **kwargs )
+        if method == 'release_lease':
+            return self.release_lease( handler )
+        if method == 'status':
+            with self.lease:
+                return { 'lease': self.lease_name, 'moving': self.motion.locked(), 'requests': self.requests }
+        if method in motion_methods:
+            with self.motion: # check the lease holding it, so nobody takes the lease before the move starts
+                with self.lease:
+                    if self.lease_owner not in (None, handler):
+                        raise GantryDaemonError( 'gantry is leased by ' + self.lease_name )
+                return getattr( self.gantry, method )( *args, **kwargs )
+        raise GantryDaemonError( 'unknown method ' + str(method) )
+
+    def position_event( self ):
+        '''
+        Newest position, from the data records if telemetry is on.  Else it is read with TP
+        when the connection is free; while a move waits for motion complete on it the last
+        position read (and its time) is sent again.
+        '''
+        gantry = self.gantry
+        rec = gantry.telemetry.latest() if gantry.telemetry is not None else None
+        if rec is not None:
+            return { 'event': 'position', 't': rec['t'], 'position': rec['position'], 'moving': bool( rec['moving'].any() ) }
+        if gantry.lock.acquire( blocking=self.last_position is None ):
+            try:
+                self.last_position = ( gantry.clock(), gantry.encoder_position() )
+            finally:
+                gantry.lock.release()
+        t, position = self.last_position
+        return { 'event': 'position', 't': t, 'position': position, 'moving': self.motion.locked() }
+
+
+class gantry_handler( socketserver.StreamRequestHandler ):
+    '''One client connection: requests in, replies (or a position stream) out'''
+    def handle( self ):
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads( line )
+                except ValueError:
+                    self.wfile.write( to_json( { 'error': 'request is not JSON' } ).encode() )
+                    continue
+                if request.get( 'method' ) == 'subscribe':
+                    self.stream( request.get( 'period', 0.1 ) )
+                    return
+                try:
+                    reply = { 'result': self.server.call( self, request.get( 'method' ), request.get( 'args', [] ),
+                                                          request.get( 'kwargs', {} ) ) }
+                except Exception as e:
+                    reply = { 'error': repr(e) }
+                self.wfile.write( to_json( reply ).encode() )
+        except (OSError, ValueError):
+            pass # client went away
+        finally:
+            self.server.release_lease( self )
+
+    def stream( self, period ):
+        while True:
+            self.wfile.write( to_json( self.server.position_event() ).encode() )
+            self.wfile.flush()
+            time.sleep( period )
+
+
+class gantry_client:
+    '''
+    Client of the gantry daemon with the methods of gantrycontrol that make
+    sense remotely (see motion_methods and query_methods).  The print methods
+    print here rather than in the daemon.
+    '''
+    def __init__( self, address=None, timeout=None ):
+        self.address = daemon_address() if address is None else address
+        try:
+            self.sock = socket.create_connection( self.address, timeout=2.0 )
+        except OSError as e:
+            raise GantryDaemonError( 'no gantry daemon at %s:%d (%s)' % ( self.address + ( e, ) ) )
+        self.sock.settimeout( timeout )
+        self.rfile = self.sock.makefile( 'rb' )
+        self.lock = threading.Lock()
+
+    def __del__( self ):
+        self.close()
+
+    def close( self ):
+        if getattr( self, 'sock', None ) is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = None
+
+    def request( self, method, *args, **kwargs ):
+        '''Run method of the daemon's gantrycontrol with args, return its result'''
+        with self.lock:
+            try:
+                self.sock.sendall( to_json( { 'method': method, 'args': args, 'kwargs': kwargs } ).encode() )
+                line = self.rfile.readline()
+            except OSError as e:
+                raise GantryDaemonError( 'lost the gantry daemon: ' + str(e) )
+        if line == b'':
+            raise GantryDaemonError( 'the gantry daemon closed the connection' )
+        reply = json.loads( line )
+        if 'error' in reply:
+            raise GantryDaemonError( reply['error'] )
+        return reply['result']
+
+    def __getattr__( self, name ):
+        if name in motion_methods or name in query_methods:
+            return lambda *args, **kwargs: self.request( name, *args, **kwargs )
+        if name in attributes:
+            return self.request( 'get', name )
+        raise AttributeError( name )
+
+    def get_cur_pos( self ):
+        return tuple( self.request( 'get_cur_pos' ) )
+
+    def get_cur_pos_mm( self ):
+        return tuple( self.request( 'get_cur_pos_mm' ) )
+
+    def print_position( self, message='Positon: ' ):
+        print( message + self.position_text() )
+
+    def print_cur_pos( self ):
+        print('current (x,y,z,phi,theta) (counts)=', *self.get_cur_pos())
+
+    def print_cur_pos_mm( self ):
+        x,y,z,phi,theta = self.get_cur_pos_mm()
+        print('current (x,y,z,phi,theta) (mm) =',x,y,z,theta,phi )
+
+    def status( self ):
+        '''Lease holder, whether a move is running and the number of requests served'''
+        return self.request( 'status' )
+
+    def lease( self, name='', timeout=None ):
+        '''
+        Context manager holding the motion lease: other clients can not move the gantry
+        until it exits.  Waits up to timeout seconds (None: forever) for another lease to end.
+        '''
+        client = self
+        class _lease:
+            def __enter__( self ):
+                client.request( 'acquire_lease', name, timeout )
+                return client
+            def __exit__( self, *exc ):
+                client.request( 'release_lease' )
+                return False
+        return _lease()
+
+    def subscribe( self, period=0.1 ):
+        '''Yield (t, position) every period seconds, on a connection of its own'''
+        sock = socket.create_connection( self.address, timeout=2.0 )
+        sock.settimeout( None )
+        try:
+            sock.sendall( to_json( { 'method': 'subscribe', 'period': period } ).encode() )
+            for line in sock.makefile( 'rb' ):
+                event = json.loads( line )
+                yield event['t'], tuple( event['position'] )
+        finally:
+            sock.close()
+
+
+def connect( address=None, **options ):
+    '''
+    Client of the gantry daemon if one is running, else a gantrycontrol of this
+    program's own (options are passed to it).
+    '''
+    try:
+        return gantry_client( address )
+    except GantryDaemonError:
+        import gantrycontrol
+        return gantrycontrol.gantrycontrol( **options )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the gantry to other programs on a local socket')
+    parser.add_argument('--address',default='',help='host:port to listen on, default GANTRY_DAEMON or %s:%d' % default_address)
+    parser.add_argument('--position-file',dest='position_file',default='galil_last_position.txt',help='File holding the last saved position')
+    parser.add_argument('--home',help='Home the gantry when starting',action='store_true')
+    parser.add_argument('--fast-home',dest='fast_home',help='Home with locate_home_fast when starting',action='store_true')
+    parser.add_argument('--telemetry',default=0.,help='Stream the controller data records every this many ms',type=float)
+    parser.add_argument('--emulate',help='Run on the controller emulator (see gclib_emulator.py)',action='store_true')
+    parser.add_argument('--time-warp',dest='time_warp',default=1.,help='Time warp factor of the emulator',type=float)
+    args = parser.parse_args()
+
+    import gantrycontrol as gc
+    if args.emulate:
+        gantry = gc.gantrycontrol( args.position_file, backend='emulator', time_warp=args.time_warp )
+    else:
+        gantry = gc.gantrycontrol( args.position_file )
+    if args.telemetry > 0:
+        gantry.start_telemetry( args.telemetry/1000. )
+    if args.home or args.fast_home:
+        gantry.home( fast=args.fast_home )
+
+    if args.address != '':
+        host, port = args.address.rsplit( ':', 1 )
+        address = ( host, int(port) )
+    else:
+        address = daemon_address()
+    server = gantry_daemon( gantry, address )
+    print('Gantry daemon listening on %s:%d' % address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.gantry = None
+        del gantry # saves the position and closes the connection
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -117,33 +117,42 @@ class camera:
         
         rcamera = a list of approximately N points in global coordinate
                   system of the vector from the camera to the target
+
+        See get_scanpoints_array for the same points as one array.
+        '''
+        return list( self.get_scanpoints_array( N, r, phi1, phi2, theta1, theta2 ) )
+
+    def get_scanpoints_array( self, N, r, phi1, phi2, theta1, theta2  ):
+        '''
+        Same inputs and points as get_scanpoints, computed for all points at once.
+
+        Returns an (M,3) array of the vectors from the camera to the target,
+        with M approximately N.
         '''
         assert( N > 0 )
         assert( r > 0 )
         assert( phi2 > phi1 )
         assert( theta2 > theta1 )
-        rvecs = []
         dA = (phi2-phi1) * ( np.cos(theta1) - np.cos(theta2) ) / N
         d = np.sqrt( dA )
         Mtheta = int( np.rint( (theta2 - theta1) / d ) )
         dtheta = (theta2 - theta1) / Mtheta
-        dphi = dA / dtheta
-        for m in range(Mtheta):
-            theta = theta1 + (theta2-theta1) * ( m + 0.5 ) / Mtheta
-            Mphi = int( np.abs(np.rint( (phi2-phi1)*np.sin(theta) / dtheta )) )
-            for n in range(Mphi):
-                dphi= (phi2-phi1)* (n+0.5) / Mphi
-                phi= phi1 + dphi
-                #handle raster in phi
-                if m % 2 == 1: #go down in phi
-                    phi = phi2 - dphi
-                # rotate from camera phi to gantry phi!
-                phi += self.phip
-                rcvec =  [ r*np.sin( theta ) * np.cos(phi), 
-                              r*np.sin( theta ) * np.sin(phi),
-                              r*np.cos( theta ) ]
-                rvecs.append( np.array(rcvec) )
-        return rvecs
+        # one entry per circle of latitude
+        thetas = theta1 + (theta2-theta1) * ( np.arange(Mtheta) + 0.5 ) / Mtheta
+        Mphis = np.abs( np.rint( (phi2-phi1)*np.sin(thetas) / dtheta ) ).astype(int)
+        # one entry per point: circle m and point n on that circle
+        m = np.repeat( np.arange(Mtheta), Mphis )
+        n = np.arange( len(m) ) - np.repeat( np.cumsum(Mphis) - Mphis, Mphis )
+        Mphi = Mphis[m]
+        theta = thetas[m]
+        dphi = (phi2-phi1) * (n+0.5) / Mphi
+        #handle raster in phi, odd circles go down in phi
+        phi = np.where( m % 2 == 1, phi2 - dphi, phi1 + dphi )
+        # rotate from camera phi to gantry phi!
+        phi += self.phip
+        return np.column_stack( [ r*np.sin( theta ) * np.cos(phi),
+                                  r*np.sin( theta ) * np.sin(phi),
+                                  r*np.cos( theta ) ] )
 
 # ## Now calculate position and rotation of gantry
 # 
@@ -194,14 +203,34 @@ def get_gantry_settings( cam, rvecs ):
     Returns:
     gsettings  = list of gantry settings (xg,yg,zg,phig,thetag) in cm and rad
     tlocs     = list of target positions (xt,yt,zt,ntx,nty,ntz) in cm and normal vector
+
+    See get_gantry_settings_array for the same as arrays.
     '''
-    gsettings = []
-    tlocs = []
-    for rv in rvecs:
-        rg, phig, thetag, rt, nt = get_gantry_setting( rv, cam.rc )
-        gsettings.append( [rg[0],rg[1],rg[2],phig,thetag] )
-        tlocs.append( [rt[0],rt[1],rt[2],nt[0],nt[1],nt[2]] )
-    return (gsettings, tlocs)
-                           
+    gsettings, tlocs = get_gantry_settings_array( cam, rvecs )
+    return (gsettings.tolist(), tlocs.tolist())
 
 
+def get_gantry_settings_array( cam, rvecs ):
+    '''
+    get_gantry_setting for all scan points at once.
+
+    Inputs:
+    cam = camera object
+    rvecs = (N,3) array (or list) of 3-vectors pointing from camera to target
+
+    Returns:
+    gsettings  = (N,5) array of gantry settings (xg,yg,zg,phig,thetag) in mm and rad
+    tlocs      = (N,6) array of target positions (xt,yt,zt,ntx,nty,ntz) in mm and normal vector
+    '''
+    r = np.asarray( rvecs, dtype=float ).reshape( -1, 3 )
+    rhat = r / np.linalg.norm( r, axis=1 )[:,None]
+    nt = -rhat
+    phig = np.arctan2( nt[:,1], nt[:,0] )
+    thetag = np.arctan2( nt[:,2], np.sqrt( nt[:,0]**2+nt[:,1]**2 ) )
+    rtdir = np.cross( rhat, np.array( [0.,0.,1.] ) )
+    rthat = rtdir / np.linalg.norm( rtdir, axis=1 )[:,None]
+    rt = rthat * 250.0
+    rg = np.asarray( cam.rc, dtype=float ) + r - rt
+    gsettings = np.column_stack( [ rg, phig, thetag ] )
+    tlocs = np.column_stack( [ rt, nt ] )
+    return (gsettings, tlocs)
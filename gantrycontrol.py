@@ -1,7 +1,108 @@
 import sys
 import string
+import concurrent.futures
+import threading
 import gclib
 import time
+import numpy as np
+import tracing
+import telemetry
+from axis_units import axis_units, units_per_count, default_calibration #mm per count for x,y,z and degrees per count for phi,theta
+
+#Settle tolerances of each axis used by wait_settled: position error TE (counts) and velocity TV (counts/s)
+settle_te_tol = (10, 10, 10, 5, 5)
+settle_tv_tol = (100, 100, 100, 50, 50)
+
+#Methods of the gclib connection that talk to the controller on its command channel, run one at a time (see gantrycontrol.lock)
+connection_methods = ('GCommand','GCommandMany','GMotionComplete','GProgramDownload','GArrayDownload','GArrayUpload','GMessage','GRecordRate')
+
+def locked(lock, method):
+  '''method, run while holding lock'''
+  def run(*args, **kwargs):
+    with lock:
+      return method(*args, **kwargs)
+  return run
+
+#Names of the controller arrays holding a scan table (positions then speeds of each axis, point number)
+scan_table_arrays = ('tpx','tpy','tpz','tpp','tpt','tsx','tsy','tsz','tsp','tst','tpn')
+
+#DMC program stepping through the scan table, one move per row.  Rows ending a scan point
+#(tpn>=0) wait until TE and TV of every axis stay within tte?/ttv? for tdwell ms (like
+#wait_settled, giving up after tsto ms), send "AT n,settle ms" and wait for the host to
+#set tack=n (images taken).  A move ending on a limit switch or stopped sends "FAULT n" instead.
+scan_table_program = """#SCAN
+trow=0
+tack=-1
+#TROW
+SP tsx[trow],tsy[trow],tsz[trow],tsp[trow],tst[trow]
+PA tpx[trow],tpy[trow],tpz[trow],tpp[trow],tpt[trow]
+BG ABCDE
+AM ABCDE
+JP #TFAULT,(_SCA<>1)|(_SCB<>1)|(_SCC<>1)|(_SCD<>1)|(_SCE<>1)
+JP #TNEXT,tpn[trow]<0
+tt0=TIME
+#TSETL
+tt1=TIME
+#TSETC
+JP #TSETO,TIME-tt0>=tsto
+JP #TSETL,(@ABS[_TEA]>ttea)|(@ABS[_TEB]>tteb)|(@ABS[_TEC]>ttec)
+JP #TSETL,(@ABS[_TED]>tted)|(@ABS[_TEE]>ttee)
+JP #TSETL,(@ABS[_TVA]>ttva)|(@ABS[_TVB]>ttvb)|(@ABS[_TVC]>ttvc)
+JP #TSETL,(@ABS[_TVD]>ttvd)|(@ABS[_TVE]>ttve)
+JP #TSETC,TIME-tt1<tdwell
+JP #TAT
+#TSETO
+tt1=TIME
+#TAT
+MG "AT",tpn[trow],tt1-tt0
+#TWAIT
+JP #TWAIT,tack<tpn[trow]
+#TNEXT
+trow=trow+1
+JP #TROW,trow<tnrows
+MG "DONE"
+EN
+#TFAULT
+MG "FAULT",trow
+EN
+"""
+
+#DMC program homing x,y,z in two stages: jog at hfast to the reverse limit switches (axes already
+#on them stay), back off hback counts, jog back at hslow.  With hindex=1 it then moves forward to
+#the encoder index (FI), which becomes position 0.  Sends "HOMED", or "HFAULT" if a limit was not found.
+home_program = """#HOME
+JG -hfast,-hfast,-hfast
+JP #HFA,_LRA=0
+BG A
+#HFA
+JP #HFB,_LRB=0
+BG B
+#HFB
+JP #HFC,_LRC=0
+BG C
+#HFC
+AM ABC
+JP #HFAULT,(_LRA<>0)|(_LRB<>0)|(_LRC<>0)
+SP hfast,hfast,hfast
+PR hback,hback,hback
+BG ABC
+AM ABC
+JG -hslow,-hslow,-hslow
+BG ABC
+AM ABC
+JP #HFAULT,(_LRA<>0)|(_LRB<>0)|(_LRC<>0)
+JP #HDONE,hindex=0
+JG hslow,hslow,hslow
+FI ABC
+BG ABC
+AM ABC
+#HDONE
+MG "HOMED"
+EN
+#HFAULT
+MG "HFAULT"
+EN
+"""
 
 
 class gantrycontrol:
@@ -34,26 +135,77 @@ class gantrycontrol:
   > gantry.move_rel( 0, 0, 0,0,1000 ) # move the gantry in phi by 1000 steps from the current position
   > gantry.move_rel( 1, 2, 3,4,5,2,3,4,5,6 ) # move x axis 1 count with speed 2counts/s, axis y 2 counts with speed 2counts/s...
   > gantry.move_rel_mm(0,0,1000)      # moves z axis 1000 mm from current position. Same format as gantry.move_rel but unit is mm.
+  > gantry.units.to_counts( poses )   # counts of an (N,5) array of x,y,z (mm), phi,theta (degrees) poses, see axis_units.py
+  > gantry.plan_counts( points )      # counts of every stage of a scan, checked against the limits before moving
+  > f = gantry.move_async( 100, 200 ) # start a move and return a concurrent.futures.Future right away
+  > position, duration = f.result()   # encoder position (counts) and seconds taken, once the move is done
+  > gantry.move_rel_async( 0, 0, 10 ) # same for move_rel
   > gantry.locate_home_xyz()          # jog the gantry to home (0,0,0)
+  > gantry.locate_home_fast()         # same, fast approach then slow re-approach run on the controller
+  > gantry.home( trust=True )         # move to home without searching if home_trusted(), else locate_home_fast
+  > gantry.wait_settled()             # wait for the servos to settle after a move (instead of sleeping)
+  > gantry.settle_times               # seconds each wait_settled took
+  > gantry.start_telemetry( 0.01 )     # stream data records every 10 ms (see telemetry.py), then motion
+                                      # complete, settling and encoder_position use them instead of commands
+  > gantry.encoder_position( t )      # encoder position (counts) at time t on the gantry.clock()
+  > with gantry.lock: ...              # the connection runs one command at a time from any thread, hold the
+                                      # lock to send several without other threads' commands in between
   > del gantry                        # done using gantry, delete object (closes connections)
+
+  To run without the controller use the emulator backend (see gclib_emulator.py):
+
+  > gantry = gl.gantrycontrol('emulated_position.txt', backend='emulator', time_warp=100.)
+  > gantry.clock()                    # seconds on the controller time base (emulated clock)
+
+  The commanded position, speeds, accelerations and soft limits are cached.  The cache is
+  filled on connect, updated from the commands sent, and dropped after an error.  Position
+  reads are answered from it while the gantry is idle and SP/AC only send changed values.
+
+  > gantry.sync()                     # refresh the cache from the controller
+  > gantry.saved_round_trips          # number of controller round trips saved by the cache
   """
 
-  def __init__(self, fname='galil_last_position.txt'):
-    self.g = gclib.py() #make an instance of the gclib python class
+  def __init__(self, fname='galil_last_position.txt', address='192.168.42.10 -s ALL', backend=None, calibration=default_calibration, **backend_options):
+    '''
+    fname   = file holding the last saved position
+    address = controller address passed to GOpen
+    backend = 'gclib' (real controller) or 'emulator', default from GCLIB_BACKEND environment variable
+    calibration = file of the axis calibration tables (see axis_units.py), used if it exists
+    backend_options are passed to the emulator, e.g. time_warp=100.
+    '''
+    self.units = axis_units()
+    if self.units.load(calibration):
+      print('Axis calibration tables for', ', '.join(self.units.tables), 'loaded from', calibration)
+    self.g = gclib.connection(backend, **backend_options) #make an instance of the gclib python class
+    tracing.instrument(self.g, {'GCommand':'controller', 'GCommandMany':'controller', 'GMotionComplete':'motion',
+                                'GProgramDownload':'controller', 'GArrayDownload':'controller', 'GMessage':'controller',
+                                'GSleep':'wait'})
+    #one command (or batch, or wait for motion complete) at a time on the connection, from any thread
+    self.lock = threading.RLock()
+    for method in connection_methods:
+      if hasattr(self.g, method):
+        setattr(self.g, method, locked(self.lock, getattr(self.g, method)))
     self.c = self.g.GCommand #alias the command callable
     self.file_galilpos = fname
+    self.saved_round_trips = 0
+    self.settle_times = []
+    self.telemetry = None
+    self.invalidate()
 
     print('gclib version:', self.g.GVersion())
-    self.g.GOpen('192.168.42.10 -s ALL')
+    self.g.GOpen(address)
     print( self.g.GInfo() )
+    #position the controller kept, before load_position overwrites it (see position_trusted)
+    self.connect_position = tuple( float(v) for v in self.c('TP').split(',') )
     self.load_position( ) # assume we are at last saved position
 
-    print('Enable motors')
-    self.c('SH') #Enable the motor
-
-    print('Set smoothing on theta,phi axes')
-    self.c('KS ,,,50,50')
-    self.c('AC ,,,2048,1024')
+    self.sync()
+    print('Enable motors, set smoothing on theta,phi axes')
+    commands = ['SH','KS ,,,50,50'] #Enable the motor
+    ac = self.axes_command('AC',[None,None,None,2048,1024])
+    if ac is not None:
+      commands.append(ac)
+    self.g.GCommandMany(commands)
     print(' done.')
 
 
@@ -61,16 +213,138 @@ class gantrycontrol:
     '''
     Destructor saves position and closes connection
     '''
+    self.wait_pending()
+    self.stop_telemetry()
     self.g.GClose()
 
+  def clock(self):
+    '''
+    Seconds on the controller's time base: the wall clock for the real controller,
+    the emulated clock (which counts time warped waits in full) for the emulator.
+    '''
+    if hasattr(self.g, 'clock'):
+      return self.g.clock()
+    return time.monotonic()
+
+  def sleep(self, seconds):
+    '''
+    Blocking sleep on the controller's time base, so emulated runs can be time warped.
+    '''
+    self.g.GSleep(int(seconds*1000))
+
+  def start_telemetry(self, period=0.01, spill=None, capacity=60000):
+    '''
+    Stream the controller's data records every period seconds into a ring buffer (see telemetry.py),
+    appended to the file spill if given.  Motion complete, settling and encoder_position then read
+    the records instead of sending commands.
+    '''
+    self.stop_telemetry()
+    self.telemetry = telemetry.telemetry(self.g, period, capacity, spill, clock=self.clock)
+    self.telemetry.start()
+    return self.telemetry
+
+  def stop_telemetry(self):
+    if self.telemetry is not None:
+      self.telemetry.stop()
+      self.telemetry = None
+
+  def telemetry_record(self):
+    '''
+    Newest data record, once one of the last record period has arrived. None without telemetry,
+    or if the records stopped coming (then commands are used instead).
+    '''
+    if self.telemetry is None:
+      return None
+    if not self.telemetry.wait_for(self.clock() - self.telemetry.period):
+      print('no data record from the controller, reading it with commands')
+      return None
+    return self.telemetry.latest()
+
+  def encoder_position(self,t=None):
+    '''
+    Encoder position (counts) of each axis at time t on the gantry clock (default: now),
+    from the data records if telemetry is on, else read with TP.
+    '''
+    if t is not None and self.telemetry is not None and self.telemetry.wait_for(t):
+      return tuple( float(v) for v in self.telemetry.position_at(t) )
+    rec = self.telemetry_record()
+    if rec is not None:
+      return tuple( float(v) for v in rec['position'] )
+    return tuple( float(v) for v in self.c('TP').split(',') )
+
+  def motion_complete(self,axes='ABCDE'):
+    '''
+    Blocks until axes have completed their motion, watching the data records if telemetry is on
+    (polling every record period), else with GMotionComplete.  The first record is read a period
+    after the call, so it was made after the motion began.
+    '''
+    idx = [ 'ABCDE'.index(a) for a in axes ]
+    with tracing.span('motion_complete', 'motion', telemetry=self.telemetry is not None):
+      while True:
+        if self.telemetry is not None:
+          self.sleep(self.telemetry.period)
+        rec = self.telemetry_record()
+        if rec is None:
+          self.g.GMotionComplete(axes)
+          return
+        if not any( rec['moving'][k] for k in idx ):
+          return
+
+  def sync(self):
+    '''
+    Refresh the cached controller state: commanded position, speeds, accelerations and soft limits.
+    '''
+    self.invalidate()
+    pos, sp, ac, fl = self.g.GCommandMany(['PA ?,?,?,?,?','SP ?,?,?,?,?','AC ?,?,?,?,?','FL ?,?,?'])
+    self._pos = [ float(v) for v in pos.split(',') ]
+    self._settings['SP'] = [ float(v) for v in sp.split(',') ]
+    self._settings['AC'] = [ float(v) for v in ac.split(',') ]
+    self._fl = tuple( float(v) for v in fl.split(',') )
+
+  def invalidate(self):
+    '''
+    Forget the cached controller state, it is read again when next needed.
+    '''
+    self._pos = None #commanded position in counts, only set while the gantry is idle
+    self._settings = {} #mnemonic (SP, AC) -> value of each axis
+    self._fl = None #soft limits of x,y,z in counts
+
+  #Sends mnemonic (e.g. SP, AC) with one value per axis, None for axes to leave alone. Values equal to the cached ones are not sent.
+  def set_axes(self,mnemonic,values):
+    command = self.axes_command(mnemonic,values)
+    if command is not None:
+      self.c(command)
+
+  #Command setting mnemonic to values (see set_axes), None if nothing changes. Updates the cache as if the command was sent.
+  def axes_command(self,mnemonic,values):
+    if mnemonic not in self._settings:
+      self._settings[mnemonic] = [ float(v) for v in self.c(mnemonic+' ?,?,?,?,?').split(',') ]
+    cached = self._settings[mnemonic]
+    fields = []
+    for k, v in enumerate(values):
+      if v is None or cached[k] == v:
+        fields.append('')
+      else:
+        fields.append('%g' % v)
+    if all(f == '' for f in fields):
+      self.saved_round_trips += 1
+      return None
+    command = mnemonic + ' ' + ','.join(fields).rstrip(',')
+    self._settings[mnemonic] = [ c if v is None else float(v) for c, v in zip(cached, values) ]
+    return command
+
   #Get the maximum software limit on x,y,z axis in counts
   def get_max(self):
+    if self._fl is not None:
+      self.saved_round_trips += 1
+      return self._fl
     res = self.c('FL ?,?,?')
     max_x,max_y,max_z = res.split(',')
     max_x = float(max_x)
     max_y = float(max_y)
     max_z = float(max_z)
 
+    self._fl = (max_x,max_y,max_z)
     return max_x,max_y,max_z
 
   #move the gantry to centre of the tank in x,y,z.
@@ -84,28 +358,43 @@ class gantrycontrol:
     '''
       print position of gantry
     '''
-    print( message + self.c('PA ?,?,?,?,?') )
+    print( message + self.position_text() )
+
+  def position_text(self):
+    '''
+    Current position in counts formatted like the answer to PA ?,?,?,?,?
+    '''
+    return '%d, %d, %d, %d, %d' % self.get_cur_pos()
 
   def save_position(self):
     '''
-    Read the current position from the galil and save it to file.
+    Read the current position from the galil (or the cache, while idle) and save it to file.
     '''
-    res = self.c('PA ?,?,?,?,?')
+    res = self.position_text()
     print(self.file_galilpos)
-    f = open(self.file_galilpos,'w')
-    f.write(res)
-    f.close()
+    self.write_position(res)
     print('wrote (x,y,z,phi,theta) to galil_last_position.txt: ',res)
 
+  def write_position(self,res):
+    '''
+    Write position res (text as returned by PA ?,?,?,?,?) to the position file.
+    '''
+    with tracing.span('write_position', 'file'):
+      f = open(self.file_galilpos,'w')
+      f.write(res)
+      f.close()
+
   def load_position(self):
     '''
     Load position from file
     '''
     f = open(self.file_galilpos,'r')
     res = f.readline()
+    self.saved_position = tuple( float(v) for v in res.split(',') )
     command = 'DP '+res
     print('Loading position with command =',command)
     self.c(command)
+    self._pos = None
 
 
   def locate_home_xyz(self):
@@ -116,6 +405,7 @@ class gantrycontrol:
     '''
     try:
       self.print_position('before homing: ')
+      self._pos = None
       '''
       Checking limit switch status _LRA variable contains limit switch status of reverse limit switch in axis  A.
       If the limit switch is already activated  that axis is already at home so we don't want to move it.
@@ -140,40 +430,118 @@ class gantrycontrol:
         command = 'BG'+axes
         self.c(command) # only BG the axes that have speed otherwise the value of _BGX for X axis will stay 1.
 
-      self.g.GMotionComplete('ABCDE')
-      time.sleep(1)
+      self.motion_complete('ABCDE')
+      self.wait_settled()
       self.c('DP 0,0,0')
+      self._pos = None
+      self.print_position('after homing: ')
+      self.save_position()
+    except:
+      print('Homing failed.  Disabling motor')
+      self.invalidate()
+      self.c('ST')
+      self.c('MO')
+      self.c('TE')
+
+  def locate_home_fast(self,fast=10000,slow=250,back=2000,index=False):
+    '''
+      Homes x,y,z with home_program run on the controller: jog at fast counts/s to the
+      reverse limit switches, back off back counts and re-approach at slow counts/s, so the
+      switch is found precisely without crawling the whole way.  With index=True the axes
+      then move forward to the encoder index, which is repeatable to a count but up to a
+      motor turn past the switch: home the same way for the scans and for the calibration.
+      Defines home as 0,0,0 and writes the position to file.
+    '''
+    try:
+      self.print_position('before homing: ')
+      self.invalidate() # the program sets the speeds and moves the gantry
+      self.c('hfast=%d;hslow=%d;hback=%d;hindex=%d' % (fast, slow, back, 1 if index else 0))
+      self.g.GProgramDownload(home_program)
+      self.c('XQ #HOME')
+      buffered = ''
+      while 'HOMED' not in buffered and 'HFAULT' not in buffered:
+        try:
+          buffered += self.g.GMessage()
+        except gclib.GclibError:
+          if float(self.c('MG _XQ0')) < 0:
+            raise RuntimeError('homing program stopped: ' + self.c('TC1'))
+      if 'HFAULT' in buffered:
+        raise RuntimeError('homing did not reach the reverse limit switches')
+      self.wait_settled()
+      if not index:
+        self.c('DP 0,0,0')
       self.print_position('after homing: ')
       self.save_position()
     except:
       print('Homing failed.  Disabling motor')
+      print(sys.exc_info()[1])
+      self.invalidate()
+      self.c('HX')
       self.c('ST')
       self.c('MO')
       self.c('TE')
 
+  def home_trusted(self,tol=20):
+    '''
+    Quick check that the position loaded from file can be trusted without homing: the
+    controller kept it since it was saved (see position_trusted) and the reverse limit
+    switches of x,y,z are tripped exactly for the axes within tol counts of home.
+    '''
+    if not self.position_trusted(self.saved_position):
+      return False
+    limits = self.g.GCommandMany(['MG _LRA','MG _LRB','MG _LRC'])
+    pos = self.get_cur_pos()
+    for k in range(3):
+      if (float(limits[k]) == 0.) != (abs(pos[k]) <= tol):
+        return False
+    return True
+
+  def home(self,trust=False,fast=True,speed=10000,index=False):
+    '''
+    Bring the gantry to home (0,0,0 in x,y,z).  With trust=True and home_trusted(), it is
+    moved there at speed counts/s without searching for the switches.  Otherwise it is homed
+    with locate_home_fast (fast=True) or locate_home_xyz.
+    '''
+    if trust and self.home_trusted():
+      print('Saved position agrees with the controller and the limit switches, moving home without searching')
+      self.move(0,0,0,"DM","DM",speed,speed,speed)
+      self.wait_settled()
+    elif fast:
+      self.locate_home_fast(fast=speed,index=index)
+    else:
+      self.locate_home_xyz()
+
+  def position_trusted(self,counts,tol=(20,20,20,20,20)):
+    '''
+    True if the controller kept its position since counts (e.g. the position recorded
+    when the last scan point was done): both the encoder position read on connecting,
+    before the saved position was loaded, and the current one are within tol counts of it.
+    A controller that was reset reports 0 on connecting and is not trusted.
+    '''
+    if counts is None:
+      return False
+    current = [ float(v) for v in self.c('TP').split(',') ]
+    for pos in (self.connect_position, current):
+      if any( abs(p - c) > t for p, c, t in zip(pos, counts, tol) ):
+        return False
+    return True
+
   def set_theta_phi_origin(self):
     self.c('DP ,,,0,0')
+    if self._pos is not None:
+      self._pos[3:] = [0.,0.]
     self.save_position()
 
   #converts from mm to counts
   #Conversion factors obtained from calibration.
+  # converts mm,degrees to counts, with z and theta not yet flipped to the right handed coordinate system (see axis_units)
   def convert(self,x,y,z,phi,theta):
-    x=round(x/0.01113)
-    y=round(y/0.009382)
-    z=round(z/0.009355)
-    phi=round(phi/0.0226)
-    theta=-round(theta*1000/180.)#old value = round(theta/0.02259)
-    
-    return x,y,z,phi,theta
+    x,y,z,phi,theta = self.units.to_counts([x,y,z,phi,theta])
+    return x,y,-z,phi,-theta
 
-  # converts counts to mm
+  # converts counts to mm, the inverse of convert
   def unconvert(self,curx,cury,curz,curphi,curtheta):
-    x = 0.01113*curx
-    y = 0.009382*cury
-    z = 0.009355*curz
-    phi = 0.0226*curphi
-    theta = -(180./1000)*curtheta#old value = 0.02259*curtheta
-    
+    x,y,z,phi,theta = self.units.from_counts([curx,cury,-curz,curphi,-curtheta])
     return x,y,z,phi,theta
 
   # returns current position in mm
@@ -187,16 +555,21 @@ class gantrycontrol:
     x,y,z,phi,theta = self.get_cur_pos_mm()
     print('current (x,y,z,phi,theta) (mm) =',x,y,z,theta,phi )
 
-  # returns current position in counts
+  # returns current position in counts, from the cache while the gantry is idle
   def get_cur_pos(self):
-    res = self.c('PA ?,?,?,?,?')
-    curx,cury,curz,curphi,curtheta = res.split(',')
-    curx = float(curx)
-    cury = float(cury)
-    curz = float(curz)
-    curtheta = float(curtheta)
-    curphi = float(curphi)
-    return curx,cury,curz,curphi,curtheta
+    with self.lock: # the move worker sets _pos too
+      if self._pos is not None:
+        self.saved_round_trips += 1
+        return tuple(self._pos)
+      res = self.c('PA ?,?,?,?,?')
+      curx,cury,curz,curphi,curtheta = res.split(',')
+      curx = float(curx)
+      cury = float(cury)
+      curz = float(curz)
+      curtheta = float(curtheta)
+      curphi = float(curphi)
+      self._pos = [curx,cury,curz,curphi,curtheta]
+      return curx,cury,curz,curphi,curtheta
 
   #Prints current position in counts
   def print_cur_pos(self):
@@ -228,7 +601,24 @@ class gantrycontrol:
     x,y,z in mm
     theta,phi in degrees
     default value is set to "DM". "DM" means don't move that axis. Can't use zero because it would mean move to absolute position 0.
+    Blocks until the move is done, see move_async.
+    '''
+    return self.wait_move( self.move_async(x,y,z,phi,theta,spx,spy,spz,spphi,sptheta), 'move command' )
+
+  #Absolute move that returns without waiting for the gantry, same arguments as move.
+  def move_async(self,x="DM",y="DM",z="DM",phi="DM",theta="DM",spx=1000,spy=1000,spz=1000,spphi=250,sptheta=250):
     '''
+    Start an absolute move (see move) and return a concurrent.futures.Future right away.
+    The future resolves to (position, duration) when the moving axes have finished:
+    the encoder position (TP) in counts and the seconds the move took.  It holds the
+    exception if the controller returned an error (the gantry is then stopped).
+    A new move waits for the previous one to finish before it starts.  Other controller
+    calls may be made meanwhile, from any thread: the connection runs one command at a
+    time (self.lock), so they wait while the move's GMotionComplete is waiting for it.
+    In asyncio code use: await asyncio.wrap_future( gantry.move_async(...) )
+    '''
+    self.wait_pending()
+    t0 = self.clock()
     try:
       #check if we don't want to move some axis
       curx,cury,curz,curtheta,curphi = self.get_cur_pos_mm()
@@ -249,40 +639,39 @@ class gantrycontrol:
         print("inside ph")
         phi=curphi
 
-      #setting up speed
-      command = 'SP %g,%g,%g,%g,%g'% (spx,spy,spz,spphi,sptheta)
-      print('SPEED COMMAND : ',command)
-      self.c( command )
+      #setting up speed, sent with the move
+      sp = self.axes_command('SP',[spx,spy,spz,spphi,sptheta])
 
-      print('current speed', self.c('SP ?,?,?,?,?'))
+      print('current speed', self._settings['SP'])
 
       #Only begin the axes whose Absolute position has changed
       axes = self.axes_to_begin(x-curx,y-cury,z-curz,phi-curphi,theta-curtheta) #This check is not necessary if someone doesn't set speed of some axis to 0 by accident.
 
-      # converting mm to counts
-      x,y,z,phi,theta = self.convert(x,y,z,phi,theta)
-      z=-z #convert to right handed coordinate system.
-      theta=-theta
-      #Sending absolute move command
-      command = 'PA %g,%g,%g,%g,%g'% (x,y,z,phi,theta)
-      print('try running in move: ',command)
-      self.c( command )
+      # converting mm to counts, in the right handed coordinate system
+      x,y,z,phi,theta = self.units.to_counts([x,y,z,phi,theta])
+      #Sending absolute move command, for the axes that move
+      target = [x,y,z,phi,theta]
+      fields = [ '%g' % target[k] if name in axes else '' for k, name in enumerate('ABCDE') ]
+      command = 'PA ' + ','.join(fields).rstrip(',')
 
 
       print('axes = '+axes)
       if len(axes)>0:
-        self.c('BG'+axes) # Begin only if there is any axes to begin
-        self.g.GMotionComplete('ABCDE') # check if the motion has completed
-        self.print_cur_pos()
-        self.save_position()
+        print('try running in move: ',command)
+        pos = list(self.get_cur_pos())
+        self._pos = None # moving
+        self.g.GCommandMany( ([sp] if sp is not None else []) + [command, 'BG'+axes] ) # Begin only if there is any axes to begin
+        final = [ float(target[k]) if name in axes else pos[k] for k, name in enumerate('ABCDE') ]
+        return self.finish_async( axes, final, t0, 'move command' )
+      else:
+        if sp is not None:
+          self.c(sp)
+        self.saved_round_trips += 1 # no PA sent
+        return self.finish_async( axes, None, t0, 'move command' )
 
     except:
-      print("error returned by the controller during move command")
-      #will implement code to print the error returned by controller in future
-      self.c('ST')
-      self.c('MO')
-      print(self.c('TE'))
-      
+      return self.failed_future( 'move command' )
+
 
   #Relative move. Units (mm)
   def move_rel(self,x=0,y=0,z=0,phi=0,theta=0,spx=1000,spy=1000,spz=1000,spphi=250,sptheta=250):
@@ -290,37 +679,327 @@ class gantrycontrol:
     move relative distance x,y,z,phi,theta from current location
     distances are in mm
     saves position to file after moving
+    Blocks until the move is done and the gantry has settled, see move_rel_async.
     '''
+    future = self.move_rel_async(x,y,z,phi,theta,spx,spy,spz,spphi,sptheta)
+    res = self.wait_move( future, 'relative move command' )
+    if res is not None and res[1] > 0:
+      self.wait_settled()
+    return res
+
+  #Relative move that returns without waiting for the gantry, same arguments as move_rel. See move_async.
+  def move_rel_async(self,x=0,y=0,z=0,phi=0,theta=0,spx=1000,spy=1000,spz=1000,spphi=250,sptheta=250):
+    self.wait_pending()
+    t0 = self.clock()
     try:
-      #setting up speed
-      command = 'SP %g,%g,%g,%g,%g'% (spx,spy,spz,spphi,sptheta)
-      self.c( command )
+      #setting up speed, sent with the move
+      sp = self.axes_command('SP',[spx,spy,spz,spphi,sptheta])
 
       self.print_cur_pos()
 
       
       axes = self.axes_to_begin(x,y,z,phi,theta) 
-      x,y,z,phi,theta = self.convert(x,y,z,phi,theta) #convert mm to counts
-      z=-z #convert to right handed coordinate system.
-      theta=-theta
+      #convert mm to counts: those of the position moved to less the current ones, as the calibration need not be linear
+      pos = list(self.get_cur_pos())
+      x,y,z,phi,theta = self.units.to_counts( self.units.from_counts(pos) + [x,y,z,phi,theta] ) - pos
       command = 'PR %g,%g,%g,%g,%g'% (x,y,z,phi,theta)
       print('try running: ',command)
-      self.c( command )
+      commands = ([sp] if sp is not None else []) + [command]
 
       
       if len(axes)>0:  
-        self.c('BG'+axes)
-        self.g.GMotionComplete('ABCDE')
-        time.sleep(1)
+        self._pos = None # moving
+        self.g.GCommandMany(commands + ['BG'+axes])
+        final = [ p + d for p, d in zip(pos, (x,y,z,phi,theta)) ]
+        return self.finish_async( axes, final, t0, 'relative move command' )
+      else:
+        self.g.GCommandMany(commands)
+        return self.finish_async( axes, None, t0, 'relative move command' )
 
+    except:
+      return self.failed_future( 'relative move command' )
+
+  #Waits for the previous asynchronous move, if any, to finish
+  def wait_pending(self):
+    pending = getattr(self, '_pending', None)
+    if pending is not None:
+      concurrent.futures.wait([pending])
+      self._pending = None
+
+  #Future resolving once axes have stopped at commanded position final (counts), or right away if no axes move
+  def finish_async(self,axes,final,t0,what):
+    def finish():
+      try:
+        self.motion_complete('ABCDE') # check if the motion has completed
+        with self.lock:
+          self._pos = final
+        position = self.encoder_position()
         self.print_cur_pos()
         self.save_position()
+        return position, self.clock() - t0
+      except:
+        self.stop_after_error(what)
+        raise
+    if len(axes) == 0:
+      future = concurrent.futures.Future()
+      future.set_result( (self.get_cur_pos(), 0.) )
+      return future
+    if getattr(self, '_executor', None) is None:
+      self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    self._pending = self._executor.submit(finish)
+    return self._pending
+
+  #Future holding the exception being handled, after stopping the gantry
+  def failed_future(self,what):
+    error = sys.exc_info()[1]
+    self.stop_after_error(what)
+    future = concurrent.futures.Future()
+    future.set_exception(error)
+    return future
+
+  #Waits for future from move_async/move_rel_async. Errors are reported (and the gantry stopped) but not raised, like the blocking moves always did.
+  def wait_move(self,future,what):
+    try:
+      return future.result()
+    except:
+      if not future.done(): # interrupted while waiting
+        self.stop_after_error(what)
+      return None
+
+  def wait_settled(self,axes='ABCDE',te_tol=settle_te_tol,tv_tol=settle_tv_tol,dwell=0.05,timeout=2.0,poll=0.01):
+    '''
+    Waits until the position error (TE) and velocity (TV) of axes stay within te_tol (counts)
+    and tv_tol (counts/s) for dwell seconds, polling every poll seconds.  Gives up with a
+    message after timeout seconds.  Use it after a move instead of sleeping a fixed time.
+    Returns the settle time (s), which is also appended to settle_times.
+    '''
+    with tracing.span('settle', 'motion', axes=axes):
+      return self._wait_settled(axes,te_tol,tv_tol,dwell,timeout,poll)
+
+  def _wait_settled(self,axes,te_tol,tv_tol,dwell,timeout,poll):
+    t0 = self.clock()
+    idx = [ 'ABCDE'.index(a) for a in axes ]
+    since = None # time since when the axes are within tolerance
+    while True:
+      rec = self.telemetry_record()
+      if rec is not None:
+        te, tv = rec['error'], rec['velocity']
+      else:
+        te, tv = self.g.GCommandMany(['TE','TV'])
+        te = [ float(v) for v in te.split(',') ]
+        tv = [ float(v) for v in tv.split(',') ]
+      now = self.clock()
+      if all( abs(te[k]) <= te_tol[k] and abs(tv[k]) <= tv_tol[k] for k in idx ):
+        if since is None:
+          since = now
+        if now - since >= dwell:
+          break
+      else:
+        since = None
+      if now - t0 >= timeout:
+        print('wait_settled: axes',axes,'not settled after',timeout,'s, TE =',te,'TV =',tv)
+        since = now
+        break
+      self.sleep(poll)
+    settle = since - t0
+    self.settle_times.append(settle)
+    print('settled in',round(settle,3),'s')
+    return settle
+
+  def stop_after_error(self,what):
+    '''
+    Stop the gantry and turn the motors off after an error (or interrupt) during a move.
+    '''
+    print("error returned by the controller during " + what)
+    print(sys.exc_info()[1])
+    #will implement code to print the error returned by controller in future
+    self.invalidate()
+    self.c('ST')
+    self.c('MO')
+    print(self.c('TE'))
+
+
+  #Counts of all the stages of a scan, checked against the limits.  Stages are (x,y,z,phi,theta) in the units of move(), None for an axis that doesn't move.
+  def plan_counts(self,points,lower=(0,0,0,None,None),upper=None):
+    '''
+    Convert every stage of points (list of scan points, each a list of stages) to the counts
+    the controller is sent, in one go, and check them before anything moves.
+    Axes that don't move in a stage keep the counts of the stage before (or the current position).
+    lower, upper = limits in counts, None for no limit.  By default x,y,z must be between home
+    (the reverse limit switches) and the soft limits FL.  Raises ValueError if a stage is out of range.
+    Returns an (number of stages, 5) array.
+    '''
+    stages = [ [ float('nan') if v is None else v for v in stage ] for stages in points for stage in stages ]
+    if len(stages) == 0:
+      return np.zeros((0,5))
+    return self.check_counts(self.units.to_counts(stages),lower,upper)
 
+  #Checks the counts of all the stages of a scan, e.g. from a compiled scan plan, like plan_counts does.
+  def check_counts(self,counts,lower=(0,0,0,None,None),upper=None):
+    '''
+    counts = (number of stages, 5) counts, NaN for the axes that don't move in a stage.
+    Fills those in from the stage before and checks the limits like plan_counts.
+    '''
+    counts = np.array(counts, dtype=float).reshape(-1,5)
+    cur = np.array(self.get_cur_pos(), dtype=float)
+    for row in counts: # axes not moving keep the previous counts
+      unmoved = np.isnan(row)
+      row[unmoved] = cur[unmoved]
+      cur = row
+    if upper is None:
+      upper = tuple(self.get_max()) + (None, None)
+    return self.units.check(counts, lower, upper)
+
+  #Runs a whole scan on the controller.  Stages are (x,y,z,phi,theta) in the units of move(), None for an axis that doesn't move.
+  def run_scan_table(self,points,at_point,speeds=(1000,1000,1000,200,200),te_tol=settle_te_tol,tv_tol=settle_tv_tol,dwell=0.05,timeout=2.0,counts=None):
+    '''
+    Download the scan as a table to the controller and let scan_table_program step through it.
+    points   = list of scan points, each a list of stages; a stage is x,y,z in mm and phi,theta
+               in degrees like move(), with None for the axes that don't move in that stage
+    at_point = function called with the point number once the gantry is settled at the point
+               (take the images here), the program moves on when it returns
+    speeds   = speed of x,y,z,phi,theta in counts/s
+    te_tol, tv_tol, dwell, timeout = settling at each point before calling at_point, checked
+               by the program on the controller the way wait_settled does it
+    counts   = counts of all the stages (see check_counts) if they are converted already, e.g.
+               scan_plan.stage_counts(), else they are converted from points
+
+    The only traffic per point is the "AT n" message from the controller and the reply
+    setting tack=n.  The position file is written from the table, without asking the controller.
+    The settle time of each point is appended to settle_times.
+    '''
+    rows = self.plan_counts(points) if counts is None else self.check_counts(counts)
+    pointnum = []
+    for n, stages in enumerate(points):
+      pointnum += [-1]*(len(stages)-1) + [n]
+    if len(rows) == 0:
+      return
+    if min(speeds) <= 0:
+      raise ValueError('scan table speeds must be positive')
+
+    columns = [ [ row[k] for row in rows ] for k in range(5) ] + [ [ sp ]*len(rows) for sp in speeds ] + [ pointnum ]
+    self.c('DA *[]')
+    self.c('DM ' + ','.join( '%s[%d]' % (name, len(rows)) for name in scan_table_arrays ))
+    for name, column in zip(scan_table_arrays, columns):
+      self.g.GArrayDownload(name, 0, len(rows)-1, [ '%d' % v for v in column ])
+    self.c('tnrows=%d;tdwell=%d;tsto=%d' % (len(rows), round(dwell*1000), round(timeout*1000)))
+    self.c(';'.join( 'tte%s=%d;ttv%s=%d' % (a.lower(), te, a.lower(), tv) for a, te, tv in zip('ABCDE', te_tol, tv_tol) ))
+    self.g.GProgramDownload(scan_table_program)
+    print('Downloaded scan table of', len(rows), 'moves for', len(points), 'points')
+
+    lastrow = {} #row at which each point ends
+    for r, n in enumerate(pointnum):
+      if n >= 0:
+        lastrow[n] = r
+    buffered = ''
+    self._pos = None # the program moves the gantry
+    self._settings.pop('SP', None) # and sets the speeds
+    try:
+      self.c('XQ #SCAN')
+      while True:
+        try:
+          buffered += self.g.GMessage()
+        except gclib.GclibError:
+          if float(self.c('MG _XQ0')) < 0:
+            raise RuntimeError('scan table program stopped: ' + self.c('TC1'))
+          continue
+        lines = buffered.replace('\r','').split('\n')
+        buffered = lines.pop()
+        for line in lines:
+          fields = line.split()
+          if len(fields) == 0:
+            continue
+          if fields[0] == 'DONE':
+            self._pos = [ float(v) for v in rows[-1] ]
+            self.write_position( '%d, %d, %d, %d, %d' % tuple(rows[-1]) )
+            return
+          if fields[0] == 'FAULT':
+            raise RuntimeError('scan table move %d did not complete' % round(float(fields[1])))
+          if fields[0] == 'AT':
+            n = round(float(fields[1]))
+            settle = float(fields[2])/1000.
+            if settle >= timeout:
+              print('run_scan_table: point',n,'not settled after',timeout,'s')
+            self.settle_times.append(settle)
+            self.write_position( '%d, %d, %d, %d, %d' % tuple(rows[lastrow[n]]) )
+            at_point(n)
+            self.c('tack=%d' % n)
     except:
-      print("error returned by the controller during relative move command")
-      #will implement code to print the error returned by controller in future
+      print("error during scan table, stopping the gantry")
+      self.invalidate()
+      self.c('HX')
       self.c('ST')
       self.c('MO')
-      self.c('TE')
-     
+      self.save_position()
+      raise
 
+  #Contour mode motion through a list of positions, without stopping.  Used for fly scans.
+  def run_contour(self,axes,positions,dt=6,stations=[],at_station=None):
+    '''
+    Drive axes (e.g. 'ABD') through positions in contour mode and call at_station on the way.
+    positions  = absolute positions in counts of the contour axes, one every 2**dt ms;
+                 positions[0] must be where the axes are now
+    stations   = indices into positions at which to call at_station
+    at_station = function called with (station number, index into positions reached), so the
+                 pose of an image can be taken from the commanded positions
+
+    The contour buffer is kept filled while at_station runs.  A station already passed
+    when the next one is reached is skipped.  Returns the list of skipped stations.
+    '''
+    names = 'ABCDE'
+    def cd(values, suffix=''):
+      fields = [ '' ]*5
+      for name, v in zip(axes, values):
+        fields[names.index(name)] = '%d' % v
+      return 'CD ' + ','.join(fields).rstrip(',') + suffix
+    segments = [ cd( [ b - a for a, b in zip(p0, p1) ] ) for p0, p1 in zip(positions[:-1], positions[1:]) ]
+    segtime = 2**dt/1000.
+    skipped = []
+    self._pos = None # contour motion
+    try:
+      self.c('CM ' + axes)
+      self.c('DT %d' % dt)
+      sent = 0
+      ended = False
+      nextstation = 0
+      while True:
+        cs, cm = [ round(float(v)) for v in self.c('MG _CS,_CM').split() ]
+        #top up the contour buffer, several segments per command
+        batch = []
+        while sent < len(segments) and cm > 0:
+          batch.append(segments[sent])
+          sent += 1
+          cm -= 1
+          if len(';'.join(batch)) > 60:
+            self.c(';'.join(batch))
+            batch = []
+        if len(batch) > 0:
+          self.c(';'.join(batch))
+        if sent == len(segments) and not ended:
+          self.c(cd([0]*len(axes), '=0')) #end of contour
+          ended = True
+        if nextstation < len(stations) and stations[nextstation] <= cs:
+          if nextstation+1 < len(stations) and stations[nextstation+1] <= cs:
+            print('run_contour: passed station', nextstation, 'before it could be captured')
+            skipped.append(nextstation)
+          elif at_station is not None:
+            at_station(nextstation, cs)
+          nextstation += 1
+          continue
+        if cs >= len(segments) and nextstation >= len(stations):
+          break
+        #sleep until the next station, or until the buffer is half empty
+        wait = (sent - cs)/2
+        if nextstation < len(stations):
+          wait = min(wait, stations[nextstation] - cs)
+        self.sleep(max(wait, 1)*segtime)
+      self.motion_complete(axes)
+      self.save_position()
+    except:
+      print("error during contour motion, stopping the gantry")
+      self.invalidate()
+      self.c('ST')
+      self.c('MO')
+      self.save_position()
+      raise
+    return skipped
@@ -7,71 +7,80 @@ Contact softwaresupport@galil.com with questions, comments, and suggestions.
 # Part of implementation, don't use directly.
 ###############################################################################
 import platform #for distinguishing 'Windows', 'Linux', 'Darwin'
+import os
 from ctypes import *
 
-if platform.system() == 'Windows':
-    if '64 bit' in platform.python_compiler():
-        WinDLL(r'C:\Program Files (x86)\Galil\gclib\dll\x64\libcrypto-1_1-x64.dll')
-        WinDLL(r'C:\Program Files (x86)\Galil\gclib\dll\x64\libssl-1_1-x64.dll')
-        _gclib_path = r'C:\Program Files (x86)\Galil\gclib\dll\x64\gclib.dll'
-        _gclibo_path = r'C:\Program Files (x86)\Galil\gclib\dll\x64\gclibo.dll'
-        _gclib = WinDLL(_gclib_path)
-        _gclibo = WinDLL(_gclibo_path)
-    else:
-        WinDLL(r'C:\Program Files (x86)\Galil\gclib\dll\x86\libcrypto-1_1.dll')
-        WinDLL(r'C:\Program Files (x86)\Galil\gclib\dll\x86\libssl-1_1.dll')
-        _gclib_path = r'C:\Program Files (x86)\Galil\gclib\dll\x86\gclib.dll'
-        _gclibo_path = r'C:\Program Files (x86)\Galil\gclib\dll\x86\gclibo.dll'
-        _gclib = WinDLL(_gclib_path)
-        _gclibo = WinDLL(_gclibo_path)
-        #Reassign symbol name, Python doesn't like @ in function names
-        #gclib calls
-        setattr(_gclib, 'GArrayDownload', getattr(_gclib, '_GArrayDownload@20'))
-        setattr(_gclib, 'GArrayUpload', getattr(_gclib, '_GArrayUpload@28'))
-        setattr(_gclib, 'GClose', getattr(_gclib, '_GClose@4'))
-        setattr(_gclib, 'GCommand', getattr(_gclib, '_GCommand@20'))
-        setattr(_gclib, 'GFirmwareDownload', getattr(_gclib, '_GFirmwareDownload@8'))
-        setattr(_gclib, 'GInterrupt', getattr(_gclib, '_GInterrupt@8'))
-        setattr(_gclib, 'GMessage', getattr(_gclib, '_GMessage@12'))
-        setattr(_gclib, 'GOpen', getattr(_gclib, '_GOpen@8'))
-        setattr(_gclib, 'GProgramDownload', getattr(_gclib, '_GProgramDownload@12'))
-        setattr(_gclib, 'GProgramUpload', getattr(_gclib, '_GProgramUpload@12'))
-        #gclibo calls (open source component/convenience functions)
-        setattr(_gclibo, 'GAddresses', getattr(_gclibo, '_GAddresses@8'))
-        setattr(_gclibo, 'GArrayDownloadFile', getattr(_gclibo, '_GArrayDownloadFile@8'))
-        setattr(_gclibo, 'GArrayUploadFile', getattr(_gclibo, '_GArrayUploadFile@12'))
-        setattr(_gclibo, 'GAssign', getattr(_gclibo, '_GAssign@8'))
-        setattr(_gclibo, 'GError', getattr(_gclibo, '_GError@12'))
-        setattr(_gclibo, 'GInfo', getattr(_gclibo, '_GInfo@12'))
-        setattr(_gclibo, 'GIpRequests', getattr(_gclibo, '_GIpRequests@8'))
-        setattr(_gclibo, 'GMotionComplete', getattr(_gclibo, '_GMotionComplete@8'))
-        setattr(_gclibo, 'GProgramDownloadFile', getattr(_gclibo, '_GProgramDownloadFile@12'))
-        setattr(_gclibo, 'GSleep', getattr(_gclibo, '_GSleep@4'))
-        setattr(_gclibo, 'GProgramUploadFile', getattr(_gclibo, '_GProgramUploadFile@8'))
-        setattr(_gclibo, 'GTimeout', getattr(_gclibo, '_GTimeout@8'))
-        setattr(_gclibo, 'GVersion', getattr(_gclibo, '_GVersion@8'))
-        setattr(_gclibo, 'GSetupDownloadFile', getattr(_gclibo, '_GSetupDownloadFile@20'))
-        setattr(_gclibo, 'GServerStatus', getattr(_gclibo, '_GServerStatus@8'))
-        setattr(_gclibo, 'GSetServer', getattr(_gclibo, '_GSetServer@4'))
-        setattr(_gclibo, 'GListServers', getattr(_gclibo, '_GListServers@8'))
-        setattr(_gclibo, 'GPublishServer', getattr(_gclibo, '_GPublishServer@12'))
-        setattr(_gclibo, 'GRemoteConnections', getattr(_gclibo, '_GRemoteConnections@8'))
-
-elif platform.system() == 'Linux':
-    cdll.LoadLibrary("libgclib.so.0")
-    _gclib = CDLL("libgclib.so.0")
-    cdll.LoadLibrary("libgclibo.so.0")
-    _gclibo = CDLL("libgclibo.so.0")
-
-elif platform.system() == 'Darwin': #OSX
-    _gclib_path = '/Applications/gclib/dylib/gclib.0.dylib'
-    _gclibo_path = '/Applications/gclib/dylib/gclibo.0.dylib'
-    cdll.LoadLibrary(_gclib_path)
-    _gclib = CDLL(_gclib_path)
-    cdll.LoadLibrary(_gclibo_path)
-    _gclibo = CDLL(_gclibo_path)
-    
-    
+_gclib = None #stays None when the library is not installed, e.g. on a laptop running the emulator
+_gclibo = None
+_load_error = None
+try:
+    if platform.system() == 'Windows':
+        if '64 bit' in platform.python_compiler():
+            WinDLL(r'C:\Program Files (x86)\Galil\gclib\dll\x64\libcrypto-1_1-x64.dll')
+            WinDLL(r'C:\Program Files (x86)\Galil\gclib\dll\x64\libssl-1_1-x64.dll')
+            _gclib_path = r'C:\Program Files (x86)\Galil\gclib\dll\x64\gclib.dll'
+            _gclibo_path = r'C:\Program Files (x86)\Galil\gclib\dll\x64\gclibo.dll'
+            _gclib = WinDLL(_gclib_path)
+            _gclibo = WinDLL(_gclibo_path)
+        else:
+            WinDLL(r'C:\Program Files (x86)\Galil\gclib\dll\x86\libcrypto-1_1.dll')
+            WinDLL(r'C:\Program Files (x86)\Galil\gclib\dll\x86\libssl-1_1.dll')
+            _gclib_path = r'C:\Program Files (x86)\Galil\gclib\dll\x86\gclib.dll'
+            _gclibo_path = r'C:\Program Files (x86)\Galil\gclib\dll\x86\gclibo.dll'
+            _gclib = WinDLL(_gclib_path)
+            _gclibo = WinDLL(_gclibo_path)
+            #Reassign symbol name, Python doesn't like @ in function names
+            #gclib calls
+            setattr(_gclib, 'GArrayDownload', getattr(_gclib, '_GArrayDownload@20'))
+            setattr(_gclib, 'GArrayUpload', getattr(_gclib, '_GArrayUpload@28'))
+            setattr(_gclib, 'GClose', getattr(_gclib, '_GClose@4'))
+            setattr(_gclib, 'GCommand', getattr(_gclib, '_GCommand@20'))
+            setattr(_gclib, 'GFirmwareDownload', getattr(_gclib, '_GFirmwareDownload@8'))
+            setattr(_gclib, 'GInterrupt', getattr(_gclib, '_GInterrupt@8'))
+            setattr(_gclib, 'GMessage', getattr(_gclib, '_GMessage@12'))
+            setattr(_gclib, 'GOpen', getattr(_gclib, '_GOpen@8'))
+            setattr(_gclib, 'GProgramDownload', getattr(_gclib, '_GProgramDownload@12'))
+            setattr(_gclib, 'GProgramUpload', getattr(_gclib, '_GProgramUpload@12'))
+            setattr(_gclib, 'GRecord', getattr(_gclib, '_GRecord@12'))
+            #gclibo calls (open source component/convenience functions)
+            setattr(_gclibo, 'GAddresses', getattr(_gclibo, '_GAddresses@8'))
+            setattr(_gclibo, 'GArrayDownloadFile', getattr(_gclibo, '_GArrayDownloadFile@8'))
+            setattr(_gclibo, 'GArrayUploadFile', getattr(_gclibo, '_GArrayUploadFile@12'))
+            setattr(_gclibo, 'GAssign', getattr(_gclibo, '_GAssign@8'))
+            setattr(_gclibo, 'GError', getattr(_gclibo, '_GError@12'))
+            setattr(_gclibo, 'GInfo', getattr(_gclibo, '_GInfo@12'))
+            setattr(_gclibo, 'GIpRequests', getattr(_gclibo, '_GIpRequests@8'))
+            setattr(_gclibo, 'GMotionComplete', getattr(_gclibo, '_GMotionComplete@8'))
+            setattr(_gclibo, 'GProgramDownloadFile', getattr(_gclibo, '_GProgramDownloadFile@12'))
+            setattr(_gclibo, 'GSleep', getattr(_gclibo, '_GSleep@4'))
+            setattr(_gclibo, 'GProgramUploadFile', getattr(_gclibo, '_GProgramUploadFile@8'))
+            setattr(_gclibo, 'GRecordRate', getattr(_gclibo, '_GRecordRate@12'))
+            setattr(_gclibo, 'GTimeout', getattr(_gclibo, '_GTimeout@8'))
+            setattr(_gclibo, 'GVersion', getattr(_gclibo, '_GVersion@8'))
+            setattr(_gclibo, 'GSetupDownloadFile', getattr(_gclibo, '_GSetupDownloadFile@20'))
+            setattr(_gclibo, 'GServerStatus', getattr(_gclibo, '_GServerStatus@8'))
+            setattr(_gclibo, 'GSetServer', getattr(_gclibo, '_GSetServer@4'))
+            setattr(_gclibo, 'GListServers', getattr(_gclibo, '_GListServers@8'))
+            setattr(_gclibo, 'GPublishServer', getattr(_gclibo, '_GPublishServer@12'))
+            setattr(_gclibo, 'GRemoteConnections', getattr(_gclibo, '_GRemoteConnections@8'))
+
+    elif platform.system() == 'Linux':
+        cdll.LoadLibrary("libgclib.so.0")
+        _gclib = CDLL("libgclib.so.0")
+        cdll.LoadLibrary("libgclibo.so.0")
+        _gclibo = CDLL("libgclibo.so.0")
+
+    elif platform.system() == 'Darwin': #OSX
+        _gclib_path = '/Applications/gclib/dylib/gclib.0.dylib'
+        _gclibo_path = '/Applications/gclib/dylib/gclibo.0.dylib'
+        cdll.LoadLibrary(_gclib_path)
+        _gclib = CDLL(_gclib_path)
+        cdll.LoadLibrary(_gclibo_path)
+        _gclibo = CDLL(_gclibo_path)
+
+except OSError as e:
+    _load_error = e
+
 
 # Python "typedefs"
 _GReturn = c_int #type for a return code
@@ -85,45 +94,53 @@ _GOption = c_int #type for option variables, e.g.    GArrayDownload
 _GStatus = c_ubyte #type for interrupt status bytes
 _GStatus_ptr = POINTER(_GStatus) #used for argtypes declaration
 
-#Define arguments and result type (if not C int type)
-#gclib calls
-_gclib.GArrayDownload.argtypes = [_GCon, _GCStringIn, _GOption, _GOption, _GCStringIn]
-_gclib.GArrayUpload.argtypes = [_GCon, _GCStringIn, _GOption, _GOption, _GOption, _GCStringOut, _GSize]
-_gclib.GClose.argtypes = [_GCon]
-_gclib.GCommand.argtypes = [_GCon, _GCStringIn, _GCStringOut, _GSize, _GSize_ptr]
-_gclib.GFirmwareDownload.argtypes = [_GCon, _GCStringIn]
-_gclib.GInterrupt.argtypes = [_GCon, _GStatus_ptr]
-_gclib.GMessage.argtypes = [_GCon, _GCStringOut, _GSize]
-_gclib.GOpen.argtypes = [_GCStringIn, _GCon_ptr]
-_gclib.GProgramDownload.argtypes = [_GCon, _GCStringIn, _GCStringIn]
-_gclib.GProgramUpload.argtypes = [_GCon, _GCStringOut, _GSize]
-#gclibo calls (open source component/convenience functions)
-_gclibo.GAddresses.argtypes = [_GCStringOut, _GSize]
-_gclibo.GArrayDownloadFile.argtypes = [_GCon, _GCStringIn]
-_gclibo.GArrayUploadFile.argtypes = [_GCon, _GCStringIn, _GCStringIn]
-_gclibo.GAssign.argtypes = [_GCStringIn, _GCStringIn]
-_gclibo.GError.argtypes = [_GReturn, _GCStringOut, _GSize]
-_gclibo.GError.restype    = None
-_gclibo.GError.argtypes = [_GCon, _GCStringOut, _GSize]
-_gclibo.GIpRequests.argtypes = [_GCStringOut, _GSize]
-_gclibo.GMotionComplete.argtypes = [_GCon, _GCStringIn]
-_gclibo.GProgramDownloadFile.argtypes = [_GCon, _GCStringIn, _GCStringIn]
-_gclibo.GSleep.argtypes = [c_uint]
-_gclibo.GSleep.restype    = None
-_gclibo.GProgramUploadFile.argtypes = [_GCon, _GCStringIn]
-_gclibo.GTimeout.argtypes = [_GCon, c_int]
-_gclibo.GVersion.argtypes = [_GCStringOut, _GSize]
-_gclibo.GServerStatus.argtypes = [_GCStringOut, _GSize]
-_gclibo.GSetServer.argtypes = [_GCStringIn]
-_gclibo.GListServers.argtypes = [_GCStringOut, _GSize]
-_gclibo.GPublishServer.argtypes = [_GCStringIn, _GOption, _GOption]
-_gclibo.GRemoteConnections.argtypes = [_GCStringOut, _GSize]
-_gclibo.GSetupDownloadFile.argtypes = [_GCon, _GCStringIn, _GOption, _GCStringOut, _GSize]
+if _gclib is not None:
+    #Define arguments and result type (if not C int type)
+    #gclib calls
+    _gclib.GArrayDownload.argtypes = [_GCon, _GCStringIn, _GOption, _GOption, _GCStringIn]
+    _gclib.GArrayUpload.argtypes = [_GCon, _GCStringIn, _GOption, _GOption, _GOption, _GCStringOut, _GSize]
+    _gclib.GClose.argtypes = [_GCon]
+    _gclib.GCommand.argtypes = [_GCon, _GCStringIn, _GCStringOut, _GSize, _GSize_ptr]
+    _gclib.GFirmwareDownload.argtypes = [_GCon, _GCStringIn]
+    _gclib.GInterrupt.argtypes = [_GCon, _GStatus_ptr]
+    _gclib.GMessage.argtypes = [_GCon, _GCStringOut, _GSize]
+    _gclib.GOpen.argtypes = [_GCStringIn, _GCon_ptr]
+    _gclib.GProgramDownload.argtypes = [_GCon, _GCStringIn, _GCStringIn]
+    _gclib.GProgramUpload.argtypes = [_GCon, _GCStringOut, _GSize]
+    _gclib.GRecord.argtypes = [_GCon, _GCStringOut, _GOption]
+    #gclibo calls (open source component/convenience functions)
+    _gclibo.GAddresses.argtypes = [_GCStringOut, _GSize]
+    _gclibo.GArrayDownloadFile.argtypes = [_GCon, _GCStringIn]
+    _gclibo.GArrayUploadFile.argtypes = [_GCon, _GCStringIn, _GCStringIn]
+    _gclibo.GAssign.argtypes = [_GCStringIn, _GCStringIn]
+    _gclibo.GError.argtypes = [_GReturn, _GCStringOut, _GSize]
+    _gclibo.GError.restype    = None
+    _gclibo.GError.argtypes = [_GCon, _GCStringOut, _GSize]
+    _gclibo.GIpRequests.argtypes = [_GCStringOut, _GSize]
+    _gclibo.GMotionComplete.argtypes = [_GCon, _GCStringIn]
+    _gclibo.GProgramDownloadFile.argtypes = [_GCon, _GCStringIn, _GCStringIn]
+    _gclibo.GSleep.argtypes = [c_uint]
+    _gclibo.GSleep.restype    = None
+    _gclibo.GProgramUploadFile.argtypes = [_GCon, _GCStringIn]
+    _gclibo.GRecordRate.argtypes = [_GCon, c_double]
+    _gclibo.GTimeout.argtypes = [_GCon, c_int]
+    _gclibo.GVersion.argtypes = [_GCStringOut, _GSize]
+    _gclibo.GServerStatus.argtypes = [_GCStringOut, _GSize]
+    _gclibo.GSetServer.argtypes = [_GCStringIn]
+    _gclibo.GListServers.argtypes = [_GCStringOut, _GSize]
+    _gclibo.GPublishServer.argtypes = [_GCStringIn, _GOption, _GOption]
+    _gclibo.GRemoteConnections.argtypes = [_GCStringOut, _GSize]
+    _gclibo.GSetupDownloadFile.argtypes = [_GCon, _GCStringIn, _GOption, _GCStringOut, _GSize]
 
 #Set up some constants
 _enc = "ASCII" #byte encoding for going between python strings and c strings.
 _buf_size = 500000 #size of response buffer. Big enough to fit entire 4000 program via UL/LS, or 24000 elements of array data.
 _error_buf = create_string_buffer(128)    #buffer for retrieving error code descriptions.
+_record_size = 2048 #big enough for the data record (union GDataRecord) of any controller
+
+#GRecord methods
+G_QR = 0 #ask for a data record with the QR command
+G_DR = 1 #read the next record of the stream started with GRecordRate (DR)
     
 def _rc(return_code):
     """Checks return codes from gclib and raises a python error if result is exceptional."""
@@ -135,14 +152,125 @@ def _rc(return_code):
 class GclibError(Exception):
     """Error class for non-zero gclib return codes."""
     pass 
+
+
+###############################################################################
+# Command batching.
+# The controller accepts several commands separated by ';' in one transaction.
+###############################################################################
+_max_line = 80 #longest command line sent in one transaction
+_batch_marker = 'gcb' #controller variable set before each command of a batched line, to find the one that failed
+
+#commands answering with a line of their own (besides any command with a ? operand)
+_answering = ('MG', 'TP', 'TE', 'TV', 'SC', 'TC', 'RP', 'TD', 'TS', 'TI', 'TB')
+
+def _answers(command):
+    """True if command returns a response line."""
+    command = command.strip()
+    return '?' in command or command[:2].upper() in _answering
+
+
+class Batching:
+    """
+    Sends lists of commands in as few GCommand transactions as fit the controller's
+    line length, for classes with a GCommand method (py and the emulator).
+    """
+
+    def GCommandMany(self, commands):
+        """
+        Performs the commands in as few transactions as possible. Returns the response
+        of each command ('' for commands that don't answer).
+        If a command fails the GclibError raised has the failing command, its index and
+        the TC1 message; the commands before it were executed, the ones after it were not.
+        """
+        responses = []
+        for first, count, line in self._pack(commands):
+            try:
+                answer = self.GCommand(line)
+            except GclibError as e:
+                index = first
+                if count > 1:
+                    try:
+                        index = int(float(self.GCommand('MG ' + _batch_marker)))
+                    except GclibError:
+                        pass
+                try:
+                    reason = self.GCommand('TC1')
+                except GclibError:
+                    reason = str(e)
+                error = GclibError('question mark returned by controller for ' + repr(commands[index]) + ' (' + reason + ')')
+                error.command = commands[index]
+                error.index = index
+                error.responses = responses
+                raise error
+            lines = answer.replace('\r', '').split('\n') if answer != '' else []
+            for cmd in commands[first:first+count]:
+                responses.append(lines.pop(0).strip() if _answers(cmd) and len(lines) > 0 else '')
+        return responses
+
+    def _pack(self, commands):
+        """
+        Split commands into lines of at most _max_line characters, returning (index of the
+        first command, number of commands, line) for each. Lines of several commands set
+        the marker variable before each one.
+        """
+        lines = []
+        i = 0
+        while i < len(commands):
+            marked = [ _batch_marker + '=%d' % i, commands[i] ]
+            j = i + 1
+            while j < len(commands):
+                candidate = marked + [ _batch_marker + '=%d' % j, commands[j] ]
+                if len(';'.join(candidate)) > _max_line:
+                    break
+                marked = candidate
+                j += 1
+            lines.append((i, j-i, ';'.join(marked) if j > i + 1 else commands[i]))
+            i = j
+        return lines
+
+    def batch(self):
+        """
+        Context manager collecting commands to send with GCommandMany on exit:
+
+        > with g.batch() as b:
+        >     b.GCommand('SP 1000')
+        >     i = b.GCommand('PA ?')
+        > b.responses[i]
+        """
+        return _Batch(self)
+
+
+class _Batch:
+    """Commands collected by Batching.batch()"""
+    def __init__(self, connection):
+        self.connection = connection
+        self.commands = []
+        self.responses = None
+
+    def GCommand(self, command):
+        """Queue command, returning the index of its response in responses."""
+        self.commands.append(command)
+        return len(self.commands) - 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.responses = self.connection.GCommandMany(self.commands)
+        return False
+
  
-class py:
+class py(Batching):
     """Represents a single Python connection to a Galil Controller or PLC."""
     
     def __init__(self):
         """Constructor for the Connection class. Initializes gclib's handle and read buffer."""
         self._gcon = _GCon(0) #handle to connection
         self._buf = create_string_buffer(_buf_size)
+        if _gclib is None:
+            raise GclibError('gclib library could not be loaded (' + str(_load_error) + '), use the emulator backend instead')
         self._timeout = 5000
         return        
     
@@ -434,6 +562,27 @@ class py:
         _rc(_gclibo.GMotionComplete(self._gcon, c_axes))
         return
 
+    def GRecord(self, method=G_QR):
+        """
+        Provides a data record from the controller as bytes, see telemetry.py to decode it.
+        method G_QR asks for one with the QR command, G_DR waits for the next record of the
+        stream started with GRecordRate (the connection must be opened with -s DR or -s ALL).
+        """
+        self._cc()
+        if not hasattr(self, '_record_buf'):
+            self._record_buf = create_string_buffer(_record_size)
+        _rc(_gclib.GRecord(self._gcon, self._record_buf, method))
+        length = self._record_buf.raw[2] | (self._record_buf.raw[3] << 8) #record length is in header bytes 2-3
+        return self._record_buf.raw[:length]
+
+    def GRecordRate(self, period_ms):
+        """
+        Sets the period (ms) of the data records streamed by the controller (DR). 0 stops the stream.
+        """
+        self._cc()
+        _rc(_gclibo.GRecordRate(self._gcon, period_ms))
+        return
+
     def GInterrupt(self):
         """   
         Provides access to PCI and UDP interrupts from the controller.
@@ -470,4 +619,27 @@ class py:
         if (options == 0):
             info_dict["options"] = rc
 
-        return info_dict
\ No newline at end of file
+        return info_dict
+
+
+###############################################################################
+# Backend selection.
+# The scripts talk to whatever connection() returns, so the same code can drive
+# the real controller or the local emulator in gclib_emulator.py.
+###############################################################################
+def connection(backend=None, **options):
+    """
+    Returns a new (not yet opened) connection object.
+    backend is 'gclib' for the real controller through the Galil library, or 'emulator'
+    for gclib_emulator.py. If backend is None the GCLIB_BACKEND environment variable
+    is used, defaulting to 'gclib'. options are passed on to the emulator (e.g. time_warp).
+    """
+    if backend is None:
+        backend = os.environ.get('GCLIB_BACKEND', 'gclib')
+    backend = backend.lower()
+    if backend == 'gclib':
+        return py()
+    if backend == 'emulator':
+        import gclib_emulator #imported here, gclib_emulator imports this module
+        return gclib_emulator.py(**options)
+    raise GclibError('unknown gclib backend ' + backend)
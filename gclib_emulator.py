@@ -0,0 +1,1035 @@
+"""
+Local emulator of the Galil DMC controller that drives the gantry.
+
+It speaks the subset of the DMC command language used by gantrycontrol.py and the
+scan scripts, models a trapezoidal velocity profile and limit switches on every axis,
+and keeps time on an emulated clock. Waits (GMotionComplete, GSleep) can be shortened
+by a time warp factor, so a full scan can be replayed in seconds while the emulated
+clock still reports how long it would have taken on the real gantry.
+
+Select it through gclib.connection, or with the environment variables
+GCLIB_BACKEND=emulator and GCLIB_TIME_WARP=<factor>.
+
+Usage:
+
+> import gclib
+> g = gclib.connection('emulator', time_warp=1000.)
+> g.GOpen('192.168.42.10 -s ALL')
+> g.GCommand('SH')
+> g.GCommand('PA 10000,0,0,0,0')
+> g.GCommand('BGA')
+> g.GMotionComplete('A')
+> g.clock()                 # emulated seconds since the connection was made
+> g.transactions            # number of command/response round trips so far
+
+Supported commands: PA PR SP AC DC KS JG DP FL BL (values or ? queries), BG ST MO SH
+(optionally with an axis mask), TP TE TV SC (tell), TC1 and MG of strings, variables,
+array elements and _LR _LF _BG _TP _TE _TV _SC _MO _SP _AC _DC _FL _BL _RP _XQ0 operands.
+CM DT CD (contour mode, with _CM _CS) are supported for fly scans.  FI (find index) moves
+at the JG speed to the next encoder index pulse, one every _index_pitch counts, and defines
+the position there as 0.
+Several commands may be separated by ';'. KS smoothing is accepted and reported but not
+modelled. TP reports the commanded position; after each move TE and TV show the servo
+ringing down (see _settle_error) so settle detection has something to wait for.
+
+Variables (a=1), arrays (DM, DA, GArrayDownload, GArrayUpload) and programs
+(GProgramDownload, XQ, HX) are supported for the DMC program subset used by
+gantrycontrol.run_scan_table: labels, assignments, JP with a condition, AM, WT, EN, MG
+(sent to GMessage) and the motion commands above with expressions as values.
+Expressions are evaluated left to right like on the controller, with parentheses, @ABS[]
+and the TIME operand (ms of emulated clock).
+Only thread 0 is emulated, and the program only runs when the host talks to the
+emulator, so a '#L;JP #L,cond' loop waiting on a variable set by the host costs nothing.
+
+Data records (GRecord with G_QR, or the stream started with GRecordRate read with G_DR)
+are DMC-4000 records (see telemetry.py) of the emulated clock.  Like the UDP stream of the
+controller, records older than _dr_backlog periods that were not read are dropped.
+"""
+import math
+import numpy
+import os
+import re
+import threading
+import time
+
+import gclib
+from gclib import GclibError, Batching
+from telemetry import record_dtype, status_moving, status_negative, status_motor_off, \
+                      switch_forward_limit, switch_reverse_limit, switch_home
+
+_axes = 'ABCDE' #A,B,C = x,y,z and D,E = phi,theta
+
+#Travel between the reverse and forward limit switches in counts, roughly the size of the tank.
+#The rotation axes have no limit switches.
+_travel = (135000, 130000, 90000, None, None)
+
+#DMC power-up defaults
+_default_sp = 25000
+_default_ac = 256000
+_default_ks = 2
+_max_limit = 2147483647
+
+_latency = 0.001 #emulated ethernet round trip per GCommand (s)
+_line_time = 0.00004 #time to execute one program line (s)
+_array_elements = 24000 #array space of a DMC-4000
+_contour_buffer = 511 #contour segments the controller can queue
+_sample_period = 0.001 #servo sample period (TM 1000)
+_dr_backlog = 100 #data records the host can be behind before the older ones are lost
+_index_pitch = 4000 #counts between encoder index pulses (one per motor turn)
+_index_phase = 1234 #physical position of the first index pulse after the reverse limit
+
+#servo settling after a move: the position error starts at the final deceleration times
+#_settle_error and rings at _settle_freq, decaying with time constant _settle_tau
+_settle_error = 2e-5 #s^2
+_settle_freq = 8. #Hz
+_settle_tau = 0.08 #s
+
+#stop codes reported by SC and _SC
+_sc_running = 0
+_sc_done = 1
+_sc_forward_limit = 2
+_sc_reverse_limit = 3
+_sc_stopped = 4
+
+#error codes reported by TC1
+_tc_messages = {
+    0: 'No error',
+    1: 'Unrecognized command',
+    4: 'Command has wrong number of operands',
+    6: 'Number out of range',
+    7: 'Command not valid while running',
+    20: 'Begin not valid with motor off',
+    21: 'Begin not valid while running',
+    22: 'Begin not possible due to Limit Switch',
+    50: 'Not enough fields in program line',
+    51: 'Not enough array space',
+    52: 'Array index out of range',
+    58: 'Label not found',
+    59: 'Variable or array not defined',
+}
+
+_identifier = re.compile(r'([A-Za-z][A-Za-z0-9]*)(\[([^\]]*)\])?\s*=(.*)$')
+_token = re.compile(r'\s*(\d+\.?\d*|\.\d+|"[^"]*"|_[A-Z]{2}[A-H0-9]?|@[A-Z]{3}|[A-Za-z][A-Za-z0-9]*|<>|<=|>=|[-+*/()<>=&|\[\]])')
+
+
+class _CommandError(Exception):
+    """Raised while interpreting a command, carries the TC1 error code."""
+    def __init__(self, code):
+        Exception.__init__(self, _tc_messages[code])
+        self.code = code
+
+
+def _trapezoid(d, sp, ac, dc):
+    """
+    Phases [(duration, acceleration), ...] of a move of signed distance d starting and
+    ending at rest, with speed sp, acceleration ac and deceleration dc.
+    Triangular if the axis can't reach sp within the distance.
+    """
+    if d == 0 or sp == 0:
+        return []
+    s = 1. if d > 0 else -1.
+    d = abs(d)
+    dacc = sp*sp/(2.*ac)
+    ddec = sp*sp/(2.*dc)
+    if dacc + ddec <= d:
+        return [(sp/ac, s*ac), ((d-dacc-ddec)/sp, 0.), (sp/dc, -s*dc)]
+    vpeak = math.sqrt(2.*d*ac*dc/(ac+dc))
+    return [(vpeak/ac, s*ac), (vpeak/dc, -s*dc)]
+
+
+def _crossing(p, v, a, duration, boundary, direction):
+    """
+    Earliest time in [0,duration] at which p + v*t + a*t*t/2 reaches boundary while
+    moving in direction (+1 or -1), or None.
+    """
+    if a == 0.:
+        if v == 0.:
+            return None
+        roots = [(boundary-p)/v]
+    else:
+        disc = v*v + 2.*a*(boundary-p)
+        if disc < 0.:
+            return None
+        r = math.sqrt(disc)
+        roots = sorted(((-v-r)/a, (-v+r)/a))
+    for t in roots:
+        vt = v + a*t
+        if 0. <= t <= duration and (vt*direction > 0. or (vt == 0. and a*direction > 0.)):
+            return t
+    return None
+
+
+class _Axis:
+    """
+    Settings and motion of one emulated axis.
+    Positions are kept in physical counts from the reverse limit switch, the
+    controller reports them shifted by offset (set with DP).
+    """
+    def __init__(self, name, travel, start):
+        self.name = name
+        self.travel = travel
+        self.offset = 0.
+        self.sp = _default_sp
+        self.ac = _default_ac
+        self.dc = _default_ac
+        self.ks = _default_ks
+        self.fl = float(_max_limit)
+        self.bl = -float(_max_limit)
+        self.jg = 0.
+        self.mode = 'PA'
+        self.pa = 0.
+        self.pr = 0.
+        self.servo = False
+        self.stop_code = _sc_done
+        #current motion segment: at time t0 the axis is at p0 moving at v0, then follows phases
+        #(duration, acceleration) or (duration, acceleration, velocity at the start) for contour segments
+        self.t0 = 0.
+        self.p0 = float(start)
+        self.v0 = 0.
+        self.phases = []
+
+    def state(self, t):
+        """Physical position and velocity at emulated time t."""
+        dt = max(t - self.t0, 0.)
+        p = self.p0
+        v = self.v0
+        for phase in self.phases:
+            duration, a = phase[0], phase[1]
+            if len(phase) > 2:
+                v = phase[2]
+            if dt < duration:
+                return p + v*dt + 0.5*a*dt*dt, v + a*dt
+            p += v*duration + 0.5*a*duration*duration
+            v += a*duration
+            dt -= duration
+        return p, 0.
+
+    def end_time(self):
+        return self.t0 + sum(phase[0] for phase in self.phases)
+
+    def servo_error(self, t):
+        """Position error (counts) and its rate (counts/s) while settling after the motion ends."""
+        end = self.end_time()
+        if t < end:
+            return 0., 0.
+        a = next((abs(phase[1]) for phase in reversed(self.phases) if phase[1] != 0.), 0.)
+        ds = t - end
+        w = 2.*math.pi*_settle_freq
+        decay = a*_settle_error*math.exp(-ds/_settle_tau)
+        return decay*math.cos(w*ds), -decay*(math.cos(w*ds)/_settle_tau + w*math.sin(w*ds))
+
+    def moving(self, t):
+        return t < self.end_time()
+
+    def position(self, t):
+        """Reported position at time t"""
+        return self.state(t)[0] + self.offset
+
+    def reverse_limit(self, t):
+        return self.travel is not None and self.state(t)[0] <= 0.5
+
+    def forward_limit(self, t):
+        return self.travel is not None and self.state(t)[0] >= self.travel - 0.5
+
+    def start(self, t, phases, stop_code=_sc_done):
+        """Start following phases from the current state at time t, stopping at limits."""
+        p, v = self.state(t)
+        self.t0, self.p0, self.v0 = t, p, v
+        self.phases = phases
+        self.stop_code = _sc_running if len(phases) > 0 else stop_code
+        self._final_stop_code = stop_code
+        self._apply_limits()
+
+    def extend(self, t, phases):
+        """Append phases to the motion, starting at time t or when the current motion ends if that is later."""
+        end = self.end_time()
+        first = len(self.phases)
+        if t > end:
+            phases = [(t - end, 0., 0.)] + phases
+        self.phases = self.phases + phases
+        self.stop_code = _sc_running
+        self._final_stop_code = _sc_done
+        self._apply_limits(first)
+
+    def _apply_limits(self, first=0):
+        """Truncate the current phases (from index first) where they first reach a limit switch or software limit."""
+        if len(self.phases) == 0:
+            return
+        forward = self.fl - self.offset
+        reverse = self.bl - self.offset
+        if self.travel is not None:
+            forward = min(forward, float(self.travel))
+            reverse = max(reverse, 0.)
+        p = self.p0
+        v = self.v0
+        for i, phase in enumerate(self.phases):
+            duration, a = phase[0], phase[1]
+            if len(phase) > 2:
+                v = phase[2]
+            if i < first:
+                p += v*duration + 0.5*a*duration*duration
+                v += a*duration
+                continue
+            hits = [ (tcross, code) for tcross, code in
+                     ((_crossing(p, v, a, duration, forward, 1.), _sc_forward_limit),
+                      (_crossing(p, v, a, duration, reverse, -1.), _sc_reverse_limit)) if tcross is not None ]
+            if len(hits) > 0:
+                tcross, code = min(hits)
+                self.phases = self.phases[:i] + [(tcross,) + tuple(phase[1:])]
+                self._final_stop_code = code
+                return
+            p += v*duration + 0.5*a*duration*duration
+            v += a*duration
+
+    def update(self, t):
+        """Latch the stop code once the motion has finished."""
+        if self.stop_code == _sc_running and not self.moving(t):
+            self.stop_code = self._final_stop_code
+
+    def stop_code_at(self, t):
+        """Stop code at time t, without latching it."""
+        if self.stop_code == _sc_running:
+            return _sc_running if self.moving(t) else self._final_stop_code
+        return self.stop_code
+
+
+class py(Batching):
+    """
+    Emulated connection to the gantry's Galil controller.
+    Mirrors the methods of gclib.py that the gantry code uses.
+
+    time_warp = factor by which waits are shortened in real time (default from the
+                GCLIB_TIME_WARP environment variable, else 1). Use float('inf') to not wait at all.
+    start     = physical start position of each axis in counts from the reverse limit switches
+                (default is the middle of the travel for x,y,z and 0 for phi,theta)
+    latency   = emulated duration of one command/response round trip (s)
+    """
+
+    def __init__(self, time_warp=None, start=None, latency=_latency):
+        if time_warp is None:
+            time_warp = float(os.environ.get('GCLIB_TIME_WARP', '1'))
+        if time_warp <= 0:
+            raise GclibError('time_warp must be positive')
+        if start is None:
+            start = [ travel/2 if travel is not None else 0 for travel in _travel ]
+        self.time_warp = time_warp
+        self.latency = latency
+        self.transactions = 0
+        self._axes = [ _Axis(name, travel, pos) for name, travel, pos in zip(_axes, _travel, start) ]
+        self._address = None
+        self._timeout = 5000
+        self._tc = 0
+        self._lock = threading.RLock()
+        self._real_t0 = time.monotonic()
+        self._skipped = 0. #emulated seconds skipped by the time warp
+        self._variables = {}
+        self._arrays = {}
+        self._program_text = ''
+        self._program = [] #statements of the downloaded program
+        self._labels = {} #label -> index of its statement
+        self._pc = None #index of the statement thread 0 executes next, None when not running
+        self._pt = 0. #emulated time of thread 0
+        self._wt = None #end of the WT thread 0 is in
+        self._messages = [] #(time, text) of unsolicited messages not read yet
+        self._contour_axes = [] #axes in contour mode (CM)
+        self._contour_dt = 0.002 #contour segment time set with DT (s)
+        self._contour_segments = [] #(start, end) times of the contour segments sent with CD
+        self._dr_period = 0. #seconds between streamed data records, 0 when not streaming
+        self._dr_next = 0. #emulated time of the next streamed data record
+
+    def __del__(self):
+        self.GClose()
+
+    ###########################################################################
+    # emulated clock
+    ###########################################################################
+    def clock(self):
+        """Emulated seconds since the connection object was made."""
+        return time.monotonic() - self._real_t0 + self._skipped
+
+    def _wait_until(self, t):
+        """Block until the emulated clock reaches t, sleeping 1/time_warp of the wait in real time."""
+        now = self.clock()
+        if t <= now:
+            return
+        if not math.isinf(self.time_warp):
+            time.sleep((t-now)/self.time_warp)
+        with self._lock:
+            now = self.clock()
+            if now < t:
+                self._skipped += t - now
+
+    ###########################################################################
+    # gclib.py interface
+    ###########################################################################
+    def _cc(self):
+        """Checks if connection is established, throws error if not."""
+        if self._address is None:
+            raise GclibError('connection not established')
+
+    def GOpen(self, address):
+        self._address = address
+
+    def GClose(self):
+        self._address = None
+
+    def GVersion(self):
+        return 'py.emulator'
+
+    def GInfo(self):
+        self._cc()
+        return self._address + ', DMC4050 emulator, time warp ' + str(self.time_warp)
+
+    def GSleep(self, val):
+        """Blocking sleep of val milliseconds of emulated time."""
+        self._wait_until(self.clock() + val/1000.)
+
+    def GTimeout(self, timeout):
+        self._cc()
+        self._timeout = timeout
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.GTimeout(timeout)
+
+    def GCommand(self, command):
+        """
+        Performs a command-and-response transaction, returning the trimmed response.
+        Raises GclibError like gclib does when the controller answers '?'.
+        """
+        self._cc()
+        self.transactions += 1
+        self._wait_until(self.clock() + self.latency)
+        with self._lock:
+            t = self.clock()
+            self._run_program(t)
+            for axis in self._axes:
+                axis.update(t)
+            responses = []
+            try:
+                for cmd in command.split(';'):
+                    res = self._execute(cmd.strip(), t)
+                    if res is not None:
+                        responses.append(res)
+            except _CommandError as e:
+                self._tc = e.code
+                raise GclibError('question mark returned by controller')
+        return '\r\n'.join(responses)
+
+    def GMotionComplete(self, axes):
+        """Blocking call that returns once all axes specified have completed their motion."""
+        self._cc()
+        with self._lock:
+            self._run_program(self.clock())
+            end = max([ self._axes[_axes.index(name)].end_time() for name in axes.upper() if name in _axes ] + [0.])
+        if math.isinf(end):
+            raise GclibError('GMotionComplete on an axis jogging without a limit')
+        self._wait_until(end)
+
+    def GProgramDownload(self, program, preprocessor=""):
+        """Downloads a program to the emulated program buffer (preprocessor options are ignored)."""
+        self._cc()
+        self.transactions += 1
+        self._wait_until(self.clock() + self.latency)
+        statements = []
+        labels = {}
+        for line in program.replace('\r', '\n').split('\n'):
+            line = line.strip()
+            if line == '' or line.startswith('REM') or line.startswith("'"):
+                continue
+            parts = line.split(';')
+            if parts[0].startswith('#'):
+                labels[parts[0].strip()[1:]] = len(statements)
+                parts = parts[1:]
+            statements += [ part.strip() for part in parts if part.strip() != '' ]
+        with self._lock:
+            self._run_program(self.clock())
+            if self._pc is not None:
+                raise GclibError('program download not valid while running')
+            self._program_text = program
+            self._program = statements
+            self._labels = labels
+
+    def GProgramUpload(self):
+        """Uploads the program from the emulated program buffer."""
+        self._cc()
+        return self._program_text
+
+    def GArrayDownload(self, name, first, last, array_data):
+        """
+        Downloads array data to a pre-dimensioned array (see DM).  first=last=-1 for
+        the whole array.
+        """
+        self._cc()
+        self.transactions += 1
+        self._wait_until(self.clock() + self.latency)
+        with self._lock:
+            if name not in self._arrays:
+                raise GclibError('array ' + name + ' not dimensioned')
+            array = self._arrays[name]
+            if first < 0:
+                first = 0
+            if last < 0:
+                last = first + len(array_data) - 1
+            values = [ float(val) for val in array_data ][:last-first+1]
+            if first + len(values) > len(array):
+                raise GclibError('array ' + name + ' too small')
+            array[first:first+len(values)] = values
+
+    def GArrayUpload(self, name, first, last):
+        """Uploads array data from the emulated array table."""
+        self._cc()
+        self.transactions += 1
+        self._wait_until(self.clock() + self.latency)
+        with self._lock:
+            self._run_program(self.clock())
+            if name not in self._arrays:
+                raise GclibError('array ' + name + ' not dimensioned')
+            array = self._arrays[name]
+            if first < 0:
+                first = 0
+            if last < 0:
+                last = len(array) - 1
+            return list(array[first:last+1])
+
+    def GMessage(self):
+        """
+        Unsolicited messages (MG in a program) sent so far.  Blocks until the program
+        sends one, raising GclibError after the timeout if none arrives.
+        """
+        self._cc()
+        timeout = (self._timeout if self._timeout >= 0 else 5000)/1000.
+        with self._lock:
+            now = self.clock()
+            self._run_program(now)
+            if len(self._messages) == 0:
+                self._run_program(now + timeout, lookahead=True)
+            messages = self._messages
+            self._messages = []
+        if len(messages) == 0:
+            self._wait_until(now + timeout)
+            raise GclibError('operation timed out')
+        self._wait_until(messages[-1][0])
+        return ''.join(text for t, text in messages)
+
+    def GRecordRate(self, period_ms):
+        """Start streaming data records every period_ms milliseconds of emulated time, 0 stops."""
+        self._cc()
+        self.transactions += 1
+        self._wait_until(self.clock() + self.latency)
+        with self._lock:
+            self._dr_period = period_ms/1000.
+            self._dr_next = self.clock()
+
+    def GRecord(self, method=gclib.G_QR):
+        """
+        Data record (bytes) of the emulated controller.  G_QR asks for the current one (a
+        transaction), G_DR waits for the next record of the stream started with GRecordRate,
+        raising GclibError after the timeout.  Waiting for the stream does not advance the
+        emulated clock, the records arrive as other calls move it on.
+        """
+        self._cc()
+        if method == gclib.G_QR:
+            self.transactions += 1
+            self._wait_until(self.clock() + self.latency)
+            with self._lock:
+                return self._record(self.clock())
+        tend = time.monotonic() + (self._timeout if self._timeout >= 0 else 5000)/1000.
+        while True:
+            with self._lock:
+                if self._dr_period <= 0.:
+                    raise GclibError('data records are not streaming, see GRecordRate')
+                now = self.clock()
+                if now >= self._dr_next:
+                    lost = math.floor((now - self._dr_next)/self._dr_period) - _dr_backlog
+                    t = self._dr_next + max(lost, 0)*self._dr_period
+                    self._dr_next = t + self._dr_period
+                    return self._record(t)
+                wait = (self._dr_next - now)/self.time_warp
+            if time.monotonic() >= tend:
+                raise GclibError('operation timed out')
+            time.sleep(min(max(wait, 0.0002), 0.01))
+
+    def _record(self, t):
+        """DMC-4000 data record of the state at emulated time t"""
+        record = numpy.zeros(1, dtype=record_dtype(len(self._axes)))
+        record['header'] = 0x80
+        record['length'] = record.dtype.itemsize
+        record['sample'] = int(t/_sample_period) & 0xffff
+        record['error_code'] = self._tc
+        axes = record['axes'][0]
+        for k, axis in enumerate(self._axes):
+            p, v = axis.state(t)
+            error, rate = axis.servo_error(t)
+            status = 0
+            if axis.moving(t):
+                status |= status_moving
+            if v < 0:
+                status |= status_negative
+            if not axis.servo:
+                status |= status_motor_off
+            switches = switch_home
+            if not axis.forward_limit(t):
+                switches |= switch_forward_limit
+            if not axis.reverse_limit(t):
+                switches |= switch_reverse_limit
+            axes['status'][k] = status
+            axes['switches'][k] = switches
+            axes['stop_code'][k] = axis.stop_code_at(t)
+            axes['reference'][k] = round(p + axis.offset)
+            axes['position'][k] = round(p + axis.offset)
+            axes['error'][k] = round(error)
+            axes['velocity'][k] = round(v + rate)
+        return record.tobytes()
+
+    ###########################################################################
+    # command interpreter
+    ###########################################################################
+    def _mask(self, rest):
+        """Axes named in an axis mask such as 'ABC', all axes if empty."""
+        rest = rest.replace(' ', '').upper()
+        if rest == '':
+            return list(self._axes)
+        if any(name not in _axes for name in rest):
+            raise _CommandError(1)
+        return [ self._axes[_axes.index(name)] for name in rest ]
+
+    def _operand(self, name, t):
+        """Value of an MG operand such as _LRA"""
+        if name == '_XQ0':
+            return -1. if self._pc is None else float(self._pc)
+        if name == '_CM':
+            return float(_contour_buffer - sum(1 for start, end in self._contour_segments if start > t))
+        if name == '_CS':
+            return float(sum(1 for start, end in self._contour_segments if end <= t))
+        if len(name) != 4 or name[0] != '_' or name[3] not in _axes:
+            raise _CommandError(1)
+        axis = self._axes[_axes.index(name[3])]
+        key = name[1:3]
+        if key == 'LR':
+            return 0. if axis.reverse_limit(t) else 1.
+        if key == 'LF':
+            return 0. if axis.forward_limit(t) else 1.
+        if key == 'BG':
+            return 1. if axis.moving(t) else 0.
+        if key in ('TP', 'RP'):
+            return round(axis.position(t))
+        if key == 'TV':
+            return round(axis.state(t)[1] + axis.servo_error(t)[1])
+        if key == 'TE':
+            return round(axis.servo_error(t)[0])
+        if key == 'SC':
+            return axis.stop_code
+        if key == 'MO':
+            return 0. if axis.servo else 1.
+        values = {'SP': axis.sp, 'AC': axis.ac, 'DC': axis.dc, 'FL': axis.fl, 'BL': axis.bl}
+        if key in values:
+            return values[key]
+        raise _CommandError(1)
+
+    def _execute(self, cmd, t):
+        """Interpret one command at emulated time t, returning its response or None."""
+        if cmd == '':
+            return None
+        assignment = _identifier.match(cmd)
+        if assignment is not None:
+            name, index, value = assignment.group(1), assignment.group(3), assignment.group(4)
+            value = self._evaluate(value, t)
+            if index is None:
+                self._variables[name] = value
+            else:
+                self._array(name)[self._index(name, index, t)] = value
+            return None
+        mnemonic = cmd[:2].upper()
+        rest = cmd[2:].strip()
+
+        if mnemonic == 'TC':
+            code = self._tc
+            if rest == '1':
+                return str(code) + ' ' + _tc_messages[code]
+            return str(code)
+
+        if mnemonic == 'MG':
+            return self._message(rest, t)
+
+        if mnemonic == 'DM':
+            for field in rest.split(','):
+                m = re.match(r'\s*([A-Za-z][A-Za-z0-9]*)\[(\d+)\]\s*$', field)
+                if m is None:
+                    raise _CommandError(1)
+                used = sum(len(array) for name, array in self._arrays.items() if name != m.group(1))
+                if used + int(m.group(2)) > _array_elements:
+                    raise _CommandError(51)
+                self._arrays[m.group(1)] = [0.]*int(m.group(2))
+            return None
+
+        if mnemonic == 'DA':
+            for field in rest.split(','):
+                field = field.strip()
+                if field == '*[]':
+                    self._arrays = {}
+                elif field == '*':
+                    self._variables = {}
+                elif field.endswith('[]'):
+                    self._arrays.pop(field[:-2], None)
+                else:
+                    self._variables.pop(field, None)
+            return None
+
+        if mnemonic == 'XQ':
+            label = rest.split(',')[0].strip()
+            if not label.startswith('#') or label[1:] not in self._labels:
+                raise _CommandError(58)
+            self._pc = self._labels[label[1:]]
+            self._pt = t
+            self._wt = None
+            return None
+
+        if mnemonic == 'CM':
+            axes = self._mask(rest)
+            if any(axis.moving(t) for axis in axes):
+                raise _CommandError(7)
+            self._contour_axes = axes
+            self._contour_segments = []
+            return None
+
+        if mnemonic == 'DT':
+            n = self._evaluate(rest, t)
+            if n != int(n) or n < 1 or n > 8:
+                raise _CommandError(6)
+            self._contour_dt = 2**int(n)/1000.
+            return None
+
+        if mnemonic == 'CD':
+            return self._contour(rest, t)
+
+        if mnemonic == 'HX':
+            self._pc = None
+            return None
+
+        if mnemonic in ('TP', 'TE', 'TV', 'SC'):
+            key = {'TP': '_TP', 'TE': '_TE', 'TV': '_TV', 'SC': '_SC'}[mnemonic]
+            return ', '.join('%d' % self._operand(key+axis.name, t) for axis in self._mask(rest))
+
+        if mnemonic == 'FI':
+            for axis in self._mask(rest):
+                if axis.moving(t):
+                    raise _CommandError(7)
+                axis.mode = 'FI'
+            return None
+
+        if mnemonic == 'SH':
+            for axis in self._mask(rest):
+                axis.servo = True
+            return None
+
+        if mnemonic == 'MO':
+            for axis in self._mask(rest):
+                axis.start(t, [])
+                axis.v0 = 0.
+                axis.servo = False
+            return None
+
+        if mnemonic == 'ST':
+            for axis in self._mask(rest):
+                if axis.moving(t):
+                    v = axis.state(t)[1]
+                    axis.start(t, [(abs(v)/axis.dc, -math.copysign(axis.dc, v))], _sc_stopped)
+            return None
+
+        if mnemonic == 'BG':
+            axes = self._mask(rest)
+            for axis in axes:
+                if not axis.servo:
+                    raise _CommandError(20)
+                if axis.moving(t):
+                    raise _CommandError(21)
+                direction = axis.jg if axis.mode in ('JG', 'FI') else self._distance(axis, t)
+                if (direction > 0 and axis.forward_limit(t)) or (direction < 0 and axis.reverse_limit(t)):
+                    raise _CommandError(22)
+            for axis in axes:
+                if axis.mode == 'JG':
+                    phases = []
+                    if axis.jg != 0:
+                        phases = [(abs(axis.jg)/axis.ac, math.copysign(axis.ac, axis.jg)), (float('inf'), 0.)]
+                    axis.start(t, phases)
+                elif axis.mode == 'FI':
+                    p = axis.state(t)[0]
+                    turns = math.floor((p - _index_phase)/_index_pitch) + (1 if axis.jg > 0 else 0)
+                    index = _index_phase + turns*_index_pitch
+                    axis.start(t, _trapezoid(index - p, abs(axis.jg), axis.ac, axis.dc) if axis.jg != 0 else [])
+                    axis.offset = -index
+                    axis.pa = 0.
+                else:
+                    axis.start(t, _trapezoid(self._distance(axis, t), axis.sp, axis.ac, axis.dc))
+            return None
+
+        if mnemonic in ('PA', 'PR', 'SP', 'AC', 'DC', 'KS', 'JG', 'DP', 'FL', 'BL'):
+            return self._axis_values(mnemonic, rest, t)
+
+        raise _CommandError(1)
+
+    def _contour(self, rest, t):
+        """CD: queue one contour segment of increments per axis, 'CD ...=n' sets its time to 2**n ms, =0 ends contour mode."""
+        if len(self._contour_axes) == 0:
+            raise _CommandError(1)
+        dt = self._contour_dt
+        if '=' in rest:
+            rest, n = rest.split('=')
+            n = self._evaluate(n, t)
+            if n == 0:
+                self._contour_axes = []
+                return None
+            if n != int(n) or n < 1 or n > 8:
+                raise _CommandError(6)
+            dt = 2**int(n)/1000.
+        fields = rest.split(',')
+        if len(fields) > len(self._axes):
+            raise _CommandError(4)
+        increments = {}
+        for axis, field in zip(self._axes, fields):
+            if field.strip() == '':
+                continue
+            d = self._evaluate(field, t)
+            if d != 0 and axis not in self._contour_axes:
+                raise _CommandError(6)
+            increments[axis.name] = d
+        if self._operand('_CM', t) <= 0:
+            raise _CommandError(6)
+        start = max([t] + [ end for s, end in self._contour_segments[-1:] ])
+        self._contour_segments.append((start, start+dt))
+        for axis in self._contour_axes:
+            axis.extend(start, [(dt, 0., increments.get(axis.name, 0.)/dt)])
+        return None
+
+    def _distance(self, axis, t):
+        """Distance the next BG will move axis in PA or PR mode."""
+        if axis.mode == 'PR':
+            return axis.pr
+        return axis.pa - axis.position(t)
+
+    def _axis_values(self, mnemonic, rest, t):
+        """Set or query (with ?) one value per axis, e.g. 'SP 1000,1000' or 'PA ?,?,?'"""
+        fields = rest.split(',') if rest != '' else []
+        if len(fields) > len(self._axes):
+            raise _CommandError(4)
+        responses = []
+        for axis, field in zip(self._axes, fields):
+            field = field.strip()
+            if field == '':
+                continue
+            if field == '?':
+                responses.append(self._query(mnemonic, axis, t))
+                continue
+            try:
+                val = float(field)
+            except ValueError:
+                val = self._evaluate(field, t)
+            if mnemonic in ('SP', 'AC', 'DC', 'KS') and val < 0:
+                raise _CommandError(6)
+            if mnemonic in ('AC', 'DC') and val == 0:
+                raise _CommandError(6)
+            if mnemonic in ('PA', 'PR', 'JG', 'DP') and axis.moving(t):
+                raise _CommandError(7)
+            if mnemonic == 'PA':
+                axis.pa, axis.mode = val, 'PA'
+            elif mnemonic == 'PR':
+                axis.pr, axis.mode = val, 'PR'
+            elif mnemonic == 'JG':
+                axis.jg, axis.mode = val, 'JG'
+            elif mnemonic == 'DP':
+                axis.offset = val - axis.state(t)[0]
+                axis.pa = val
+            else:
+                setattr(axis, mnemonic.lower(), val)
+        if len(responses) > 0:
+            return ', '.join(responses)
+        return None
+
+    def _query(self, mnemonic, axis, t):
+        if mnemonic == 'PA':
+            if axis.moving(t):
+                return '%d' % axis.pa
+            return '%d' % round(axis.position(t))
+        if mnemonic == 'DP':
+            return '%d' % round(axis.position(t))
+        if mnemonic in ('FL', 'BL', 'KS'):
+            return '%.4f' % getattr(axis, mnemonic.lower())
+        return '%d' % getattr(axis, mnemonic.lower())
+
+    ###########################################################################
+    # expressions and programs
+    ###########################################################################
+    def _array(self, name):
+        if name not in self._arrays:
+            raise _CommandError(59)
+        return self._arrays[name]
+
+    def _index(self, name, index, t):
+        i = int(self._evaluate(index, t))
+        if i < 0 or i >= len(self._array(name)):
+            raise _CommandError(52)
+        return i
+
+    def _evaluate(self, expr, t):
+        """Value of expression expr, evaluated left to right like the controller does."""
+        tokens = _token.findall(expr)
+        if ''.join(tokens) != expr.replace(' ', ''):
+            raise _CommandError(1)
+        value, pos = self._evaluate_tokens(tokens, 0, t)
+        if pos != len(tokens):
+            raise _CommandError(1)
+        return value
+
+    def _evaluate_tokens(self, tokens, pos, t):
+        """Evaluate tokens from pos up to a closing bracket, returning the value and position after it."""
+        value, pos = self._evaluate_term(tokens, pos, t)
+        while pos < len(tokens) and tokens[pos] not in (')', ']'):
+            op = tokens[pos]
+            rhs, pos = self._evaluate_term(tokens, pos+1, t)
+            if op == '+': value = value + rhs
+            elif op == '-': value = value - rhs
+            elif op == '*': value = value * rhs
+            elif op == '/':
+                if rhs == 0:
+                    raise _CommandError(6)
+                value = value / rhs
+            elif op == '<': value = float(value < rhs)
+            elif op == '>': value = float(value > rhs)
+            elif op == '=': value = float(value == rhs)
+            elif op == '<>': value = float(value != rhs)
+            elif op == '<=': value = float(value <= rhs)
+            elif op == '>=': value = float(value >= rhs)
+            elif op == '&': value = float(value != 0 and rhs != 0)
+            elif op == '|': value = float(value != 0 or rhs != 0)
+            else:
+                raise _CommandError(1)
+        return value, pos
+
+    def _evaluate_term(self, tokens, pos, t):
+        if pos >= len(tokens):
+            raise _CommandError(1)
+        token = tokens[pos]
+        if token == '-':
+            value, pos = self._evaluate_term(tokens, pos+1, t)
+            return -value, pos
+        if token == '(':
+            value, pos = self._evaluate_tokens(tokens, pos+1, t)
+            if pos >= len(tokens) or tokens[pos] != ')':
+                raise _CommandError(1)
+            return value, pos+1
+        if token[0].isdigit() or token[0] == '.':
+            return float(token), pos+1
+        if token[0] == '_':
+            return float(self._operand(token, t)), pos+1
+        if token == '@ABS':
+            if pos+1 >= len(tokens) or tokens[pos+1] != '[':
+                raise _CommandError(1)
+            value, end = self._evaluate_tokens(tokens, pos+2, t)
+            if end >= len(tokens) or tokens[end] != ']':
+                raise _CommandError(1)
+            return abs(value), end+1
+        if token == 'TIME':
+            return float(round(t*1000)), pos+1
+        if token[0].isalpha():
+            if pos+1 < len(tokens) and tokens[pos+1] == '[':
+                array = self._array(token)
+                index, end = self._evaluate_tokens(tokens, pos+2, t)
+                if end >= len(tokens) or tokens[end] != ']':
+                    raise _CommandError(1)
+                if int(index) < 0 or int(index) >= len(array):
+                    raise _CommandError(52)
+                return array[int(index)], end+1
+            if token not in self._variables:
+                raise _CommandError(59)
+            return self._variables[token], pos+1
+        raise _CommandError(1)
+
+    def _message(self, rest, t):
+        """Text of MG with strings and expressions separated by commas."""
+        parts = []
+        for field in rest.split(','):
+            field = field.strip()
+            if field.startswith('"') and field.endswith('"') and len(field) >= 2:
+                parts.append(field[1:-1])
+            else:
+                parts.append('%.4f' % self._evaluate(field, t))
+        return ' '.join(parts)
+
+    def _run_program(self, horizon, lookahead=False):
+        """
+        Execute thread 0 up to emulated time horizon.  With lookahead the host is waiting
+        for a message, so stop at the first one and don't let a waiting thread catch up
+        with horizon (the host may still set the variable it waits on earlier).
+        """
+        while self._pc is not None and self._pt <= horizon:
+            try:
+                state = self._step(horizon)
+            except _CommandError as e:
+                self._tc = e.code
+                self._pc = None
+                break
+            if state == 'waiting':
+                if not lookahead:
+                    self._pt = max(self._pt, horizon)
+                break
+            if state == 'later' or (state == 'message' and lookahead):
+                break
+
+    def _step(self, horizon):
+        """
+        Execute the next statement of thread 0.  Returns 'later' if it has to wait past
+        horizon, 'waiting' if it loops on a condition only the host can change,
+        'message' after an MG, else None.
+        """
+        t = self._pt
+        for axis in self._axes:
+            axis.update(t)
+        if self._pc >= len(self._program):
+            self._pc = None
+            return None
+        stmt = self._program[self._pc]
+        mnemonic = stmt[:2].upper()
+        rest = stmt[2:].strip()
+        state = None
+        if mnemonic == 'EN' and rest == '':
+            self._pc = None
+            return None
+        if mnemonic == 'JP':
+            fields = rest.split(',', 1)
+            label = fields[0].strip()
+            if not label.startswith('#') or label[1:] not in self._labels:
+                raise _CommandError(58)
+            if len(fields) == 1 or self._evaluate(fields[1], t) != 0:
+                target = self._labels[label[1:]]
+                if target == self._pc and len(fields) == 2 and '_' not in fields[1]:
+                    return 'waiting'
+                self._pc = target
+                self._pt += _line_time
+                return None
+        elif mnemonic == 'AM':
+            end = max([ axis.end_time() for axis in self._mask(rest) ] + [t])
+            if math.isinf(end):
+                return 'waiting'
+            if end > horizon:
+                return 'later'
+            self._pt = end
+        elif mnemonic == 'WT':
+            if self._wt is None:
+                self._wt = t + self._evaluate(rest, t)/1000.
+            if self._wt > horizon:
+                return 'later'
+            self._pt = self._wt
+            self._wt = None
+        elif mnemonic == 'MG':
+            self._messages.append((t, self._message(rest, t) + '\r\n'))
+            state = 'message'
+        else:
+            self._execute(stmt, t)
+        self._pc += 1
+        self._pt += _line_time
+        return state
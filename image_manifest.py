@@ -0,0 +1,209 @@
+'''
+image_manifest keeps an SQLite database of the images taken by the scans, so
+analysis jobs can select images by scan, point, camera or pose without
+globbing and parsing image names.
+
+One row is written per image as soon as it is captured: the scan and point,
+the commanded gantry setting and the pose measured by the encoders (both mm
+and rad, like get_gantry_settings), the target position and normal, the
+camera number and serial number, the file, its size and the capture and
+write times.  Images downloaded in the background (--defer-download) get
+their size and write time filled in by update_files() after the downloads.
+The result of the image checks (see image_qa) is added with set_qa().
+
+The database is in WAL mode, so it can be queried while a scan writes it.
+
+Usage:
+
+> from image_manifest import image_manifest
+> manifest = image_manifest( 'image_manifest.db' )
+> manifest.start_scan( scan_id, param_file='parameters_sphere.txt', npoints=200 )
+> manifest.add_image( scan_id, n, gset, measured, tl, camera, serial, fname, t_capture )
+> manifest.update_files()
+> manifest.nearest( x, y, z, count=5, camera='4' )   # images taken closest to a gantry position
+> manifest.images( scan_id, camera='4' )             # all the images of camera 4 in the scan
+> manifest.export_csv( 'images.csv', scan_id )
+
+or from the command line (see --help):
+
+  python image_manifest.py image_manifest.db --export images.csv --camera 4
+'''
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+pose_columns = ( 'x', 'y', 'z', 'phi', 'theta' )
+measured_columns = ( 'mx', 'my', 'mz', 'mphi', 'mtheta' )
+target_columns = ( 'xt', 'yt', 'zt', 'ntx', 'nty', 'ntz' )
+
+# Image check result: 'ok', the problems found, or null if not checked; and the measured sharpness
+qa_columns = ( ( 'qa', 'text' ), ( 'sharpness', 'real' ) )
+
+image_columns = ( ( 'scan_id', 'point', 'camera', 'serial', 'file', 'size', 't_capture', 't_written' )
+                  + pose_columns + measured_columns + target_columns )
+
+schema = '''
+create table if not exists scans (
+  scan_id text primary key, started real, label text, param_file text, plan_key text, npoints integer );
+create table if not exists images (
+  id integer primary key, scan_id text not null, point integer not null, camera text, serial text,
+  file text not null, size integer, t_capture real, t_written real,
+  ''' + ', '.join( c+' real' for c in pose_columns + measured_columns + target_columns ) + ''',
+  ''' + ', '.join( c+' '+t for c, t in qa_columns ) + ''' );
+create index if not exists images_scan_point on images ( scan_id, point );
+create index if not exists images_camera on images ( camera, scan_id );
+create index if not exists images_serial on images ( serial );
+create index if not exists images_position on images ( x, y, z );
+create index if not exists images_file on images ( file );
+'''
+
+
+class image_manifest:
+    '''
+    SQLite manifest of the scan images in fname.  Can be used from several
+    threads, writes are committed one image at a time.
+    '''
+    def __init__( self, fname ):
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect( fname, check_same_thread=False )
+        self.db.row_factory = sqlite3.Row
+        self.db.execute( 'pragma journal_mode=wal' )
+        self.db.executescript( schema )
+        have = [ row['name'] for row in self.db.execute( 'pragma table_info( images )' ) ]
+        for column, sqltype in qa_columns:
+            if column not in have: # manifest written before the column was added
+                self.db.execute( 'alter table images add column ' + column + ' ' + sqltype )
+
+    def close( self ):
+        with self.lock:
+            self.db.close()
+
+    def start_scan( self, scan_id, label='', param_file='', plan_key='', npoints=0 ):
+        '''Record scan scan_id, kept as it is if it was started before (resumed scan)'''
+        with self.lock, self.db:
+            self.db.execute( 'insert or ignore into scans values ( ?, ?, ?, ?, ?, ? )',
+                             ( scan_id, time.time(), label, param_file, plan_key, int(npoints) ) )
+
+    def add_image( self, scan_id, point, gset, measured, tl, camera, serial, fname, t_capture ):
+        '''
+        Record image fname of camera (number and serial) taken at time t_capture at point
+        number point: gset is the commanded gantry setting, measured the one of the encoders
+        (5 values each, mm and rad) and tl the target position and normal (6 values).
+        The size and write time are read if the file is there already.
+        '''
+        size, t_written = file_info( fname )
+        values = ( [ scan_id, int(point), str(camera), serial, fname, size, t_capture, t_written ]
+                   + [ float(v) for v in gset ] + [ None if v is None else float(v) for v in measured ]
+                   + [ float(v) for v in tl ] )
+        with self.lock, self.db:
+            self.db.execute( 'insert into images ( ' + ', '.join( image_columns ) + ' ) values ( ' +
+                             ', '.join( '?'*len(image_columns) ) + ' )', values )
+
+    def update_files( self ):
+        '''Fill in the size and write time of the images downloaded since they were added.  Returns the number still missing.'''
+        with self.lock:
+            rows = self.db.execute( 'select id, file from images where size is null' ).fetchall()
+        missing = 0
+        updates = []
+        for row in rows:
+            size, t_written = file_info( row['file'] )
+            if size is None:
+                missing += 1
+            else:
+                updates.append( ( size, t_written, row['id'] ) )
+        with self.lock, self.db:
+            self.db.executemany( 'update images set size = ?, t_written = ? where id = ?', updates )
+        return missing
+
+    def set_qa( self, fname, result ):
+        '''Record the image_qa result of image fname'''
+        qa = 'ok' if result['ok'] else '; '.join( result['problems'] )
+        with self.lock, self.db:
+            self.db.execute( 'update images set qa = ?, sharpness = ? where file = ?', ( qa, result.get('sharpness'), fname ) )
+
+    def query( self, sql, args=() ):
+        '''Rows of an SQL query as dicts'''
+        with self.lock:
+            return [ dict(row) for row in self.db.execute( sql, args ).fetchall() ]
+
+    def scans( self ):
+        return self.query( 'select * from scans order by started' )
+
+    def images( self, scan_id=None, camera=None, point=None ):
+        '''Images of scan_id, camera and point (all if None), in scan order'''
+        where, args = selection( scan_id=scan_id, camera=camera, point=point )
+        return self.query( 'select * from images' + where + ' order by scan_id, point, camera', args )
+
+    def nearest( self, x, y, z, count=10, radius=100.0, scan_id=None, camera=None ):
+        '''
+        The count images commanded closest to gantry position x,y,z (mm), within radius
+        mm, nearest first, with their distance in 'distance'.
+        '''
+        where, args = selection( scan_id=scan_id, camera=camera )
+        box = ' and '.join( c+' between ? and ?' for c in ( 'x', 'y', 'z' ) )
+        where = ( where + ' and ' if where != '' else ' where ' ) + box
+        args = args + [ x-radius, x+radius, y-radius, y+radius, z-radius, z+radius ]
+        rows = self.query( 'select *, ( x-? )*( x-? ) + ( y-? )*( y-? ) + ( z-? )*( z-? ) as distance from images' + where +
+                           ' order by distance limit ?', [ x, x, y, y, z, z ] + args + [ int(count) ] )
+        for row in rows:
+            row['distance'] = row['distance']**0.5
+        return [ row for row in rows if row['distance'] <= radius ]
+
+    def export_csv( self, fname, scan_id=None, camera=None ):
+        '''Write the images of scan_id and camera (all if None) to CSV file fname, returns the number of images'''
+        rows = self.images( scan_id, camera )
+        with open( fname, 'w', newline='' ) as f:
+            writer = csv.DictWriter( f, fieldnames=( 'id', ) + image_columns + tuple( c for c, t in qa_columns ) )
+            writer.writeheader()
+            writer.writerows( rows )
+        return len(rows)
+
+
+def selection( **values ):
+    '''SQL where clause and arguments selecting the columns with a value that is not None'''
+    names = [ name for name, value in values.items() if value is not None ]
+    if len(names) == 0:
+        return '', []
+    return ' where ' + ' and '.join( name+' = ?' for name in names ), [ values[name] for name in names ]
+
+
+def file_info( fname ):
+    '''(size, modification time) of fname, (None, None) if it is not there'''
+    try:
+        st = os.stat( fname )
+    except OSError:
+        return None, None
+    return st.st_size, st.st_mtime
+
+
+def main():
+    parser = argparse.ArgumentParser( description='Query and export the image manifest' )
+    parser.add_argument('manifest',nargs='?',default='image_manifest.db',help='Manifest database')
+    parser.add_argument('--scan',default=None,help='Only the images of this scan id')
+    parser.add_argument('--camera',default=None,help='Only the images of this camera number')
+    parser.add_argument('--export',default='',help='Write the images to this CSV file')
+    parser.add_argument('--near',default=None,nargs=3,type=float,metavar=('X','Y','Z'),help='List the images taken closest to this gantry position (mm)')
+    parser.add_argument('--count',default=10,type=int,help='Number of images listed with --near')
+    args = parser.parse_args()
+
+    manifest = image_manifest( args.manifest )
+    if args.export != '':
+        n = manifest.export_csv( args.export, args.scan, args.camera )
+        print('Wrote', n, 'images to', args.export)
+    elif args.near is not None:
+        for row in manifest.nearest( *args.near, count=args.count, scan_id=args.scan, camera=args.camera ):
+            print('%8.1f mm  %s  point %d  camera %s  %s' % ( row['distance'], row['scan_id'], row['point'], row['camera'], row['file'] ))
+    else:
+        for scan in manifest.scans():
+            n = len( manifest.images( scan['scan_id'], args.camera ) )
+            print( scan['scan_id'], time.strftime( '%Y-%m-%d %H:%M:%S', time.localtime( scan['started'] ) ), scan['param_file'], n, 'images' )
+    manifest.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+'''
+image_qa checks the scan images in the background while the scan goes on, so
+a blurry, badly exposed or broken image is found while the gantry is still at
+the point (and can be retaken at once), or soon enough to go back for it at
+the end of the scan instead of redoing the whole scan.
+
+Each image is checked by a worker thread for:
+
+  integrity     the file is there, is a whole JPEG (SOI and EOI markers) and decodes
+  sharpness     variance of the Laplacian of the image, at least min_sharpness
+  exposure      at most max_clipped of the pixels saturated, at most max_dark black
+  checkerboard  (if a pattern size is given) at least half of its inner corners found
+
+The image is decoded at 1/decimate of its size (JPEG DCT scaling, see
+PIL.Image.draft), which is several times faster than a full decode and plenty
+for these checks.  The thresholds depend on the cameras and the lighting;
+check_image reports the measured values so they can be tuned from a good scan
+(python image_qa.py *.jpg).  Without Pillow only the file integrity is checked.
+
+Usage:
+
+> from image_qa import image_qa
+> qa = image_qa( workers=2, min_sharpness=20., checkerboard=(9,6) )
+> qa.submit( 'c4_12pch4_z-185.6_y227.0_x761.2.jpg' )
+> result = qa.result( 'c4_12pch4_z-185.6_y227.0_x761.2.jpg', timeout=1.0 )  # None if not checked yet
+> if result is not None and not result['ok']:
+>     print( result['problems'] )
+> qa.wait_all()
+'''
+import argparse
+import concurrent.futures
+import os
+import sys
+import threading
+import numpy as np
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Pixel values counted as saturated and as black
+clipped_level = 250
+dark_level = 5
+
+# Half size (pixels, in the decimated image) of the quadrants compared by the corner detector
+corner_radius = 3
+
+
+def jpeg_complete( fname ):
+    '''True if fname starts with the JPEG SOI marker and has an EOI marker near its end'''
+    with open( fname, 'rb' ) as f:
+        head = f.read( 2 )
+        f.seek( max( os.path.getsize( fname ) - 1024, 0 ) )
+        tail = f.read()
+    return head == b'\xff\xd8' and b'\xff\xd9' in tail
+
+
+def decode_gray( fname, decimate=4 ):
+    '''Image in fname as a 2D float array of gray levels 0-255, decoded at 1/decimate of its size if possible'''
+    with Image.open( fname ) as img:
+        img.draft( 'L', ( max( img.width//decimate, 1 ), max( img.height//decimate, 1 ) ) )
+        return np.asarray( img.convert( 'L' ), dtype=float )
+
+
+def sharpness( gray ):
+    '''Variance of the Laplacian (5 point stencil) of a gray image'''
+    lap = ( gray[:-2,1:-1] + gray[2:,1:-1] + gray[1:-1,:-2] + gray[1:-1,2:] - 4.*gray[1:-1,1:-1] )
+    return float( np.var( lap ) ) if lap.size > 0 else 0.
+
+
+def checkerboard_corners( gray, radius=corner_radius, threshold=0.3 ):
+    '''
+    Number of checkerboard-like corners in a gray image: points where the four
+    quadrants around them alternate dark and bright (a saddle), scored as the
+    contrast between the diagonals less the differences along them, so edges
+    and flat areas score low.  Local maxima scoring above threshold (fraction of
+    full contrast) are counted.
+    '''
+    r = radius
+    if gray.shape[0] < 4*r or gray.shape[1] < 4*r:
+        return 0
+    s = np.zeros( ( gray.shape[0]+1, gray.shape[1]+1 ) )
+    s[1:,1:] = gray.cumsum( 0 ).cumsum( 1 )
+    def box( y0, x0 ):
+        # sums of the r x r boxes starting at offset (y0,x0) from every pixel that has all four quadrants
+        h, w = gray.shape[0] - 2*r + 1, gray.shape[1] - 2*r + 1
+        return ( s[y0+r:y0+r+h, x0+r:x0+r+w] - s[y0:y0+h, x0+r:x0+r+w] - s[y0+r:y0+r+h, x0:x0+w] + s[y0:y0+h, x0:x0+w] )
+    tl, tr, bl, br = box( 0, 0 ), box( 0, r ), box( r, 0 ), box( r, r )
+    score = ( np.abs( tl + br - tr - bl ) - np.abs( tl - br ) - np.abs( tr - bl ) ) / ( 2.*255.*r*r )
+    peaks = np.lib.stride_tricks.sliding_window_view( np.pad( score, r, constant_values=-1. ), ( 2*r+1, 2*r+1 ) ).max( axis=(2,3) )
+    return int( np.count_nonzero( ( score >= peaks ) & ( score > threshold ) ) )
+
+
+def check_image( fname, decimate=4, min_sharpness=20., max_clipped=0.02, max_dark=0.5, checkerboard=None ):
+    '''
+    Check image fname.  checkerboard is the number of inner corners (columns, rows)
+    of the pattern that must be in view, None to not look for it.  Returns a dict with
+    'ok', the list of 'problems' and the measured 'size', 'sharpness', 'clipped' and
+    'dark' fractions and checkerboard 'corners' (None when not measured).
+    '''
+    result = { 'file': fname, 'ok': False, 'problems': [], 'size': None, 'sharpness': None,
+               'clipped': None, 'dark': None, 'corners': None }
+    problems = result['problems']
+    if not os.path.exists( fname ):
+        problems.append( 'missing' )
+        return result
+    result['size'] = os.path.getsize( fname )
+    if fname.lower().endswith( ( '.jpg', '.jpeg' ) ) and not jpeg_complete( fname ):
+        problems.append( 'truncated' )
+        return result
+    if Image is None:
+        result['ok'] = True
+        return result
+    try:
+        gray = decode_gray( fname, decimate )
+    except (OSError, ValueError, SyntaxError) as e:
+        problems.append( 'unreadable: ' + str(e) )
+        return result
+    result['sharpness'] = sharpness( gray )
+    result['clipped'] = float( np.mean( gray >= clipped_level ) )
+    result['dark'] = float( np.mean( gray <= dark_level ) )
+    if result['sharpness'] < min_sharpness:
+        problems.append( 'blurred (sharpness %.1f)' % result['sharpness'] )
+    if result['clipped'] > max_clipped:
+        problems.append( 'overexposed (%.1f%% clipped)' % ( 100.*result['clipped'] ) )
+    if result['dark'] > max_dark:
+        problems.append( 'underexposed (%.1f%% black)' % ( 100.*result['dark'] ) )
+    if checkerboard is not None:
+        result['corners'] = checkerboard_corners( gray )
+        if result['corners'] < 0.5*checkerboard[0]*checkerboard[1]:
+            problems.append( 'no checkerboard (%d corners)' % result['corners'] )
+    result['ok'] = len(problems) == 0
+    return result
+
+
+class image_qa:
+    '''
+    Pool of workers checking images (see check_image, which takes the limits).
+    Results are kept by file name.
+    '''
+    def __init__( self, workers=2, **limits ):
+        self.limits = limits
+        self.pool = concurrent.futures.ThreadPoolExecutor( max_workers=workers, thread_name_prefix='image_qa' )
+        self.done = threading.Condition()
+        self.results = {}  # file -> result of check_image
+        self.pending = 0   # images submitted and not checked yet
+
+    def submit( self, fname ):
+        '''Check fname in the background'''
+        with self.done:
+            self.pending += 1
+        self.pool.submit( self.run, fname )
+
+    def run( self, fname ):
+        try:
+            result = check_image( fname, **self.limits )
+        except Exception as e:
+            result = { 'file': fname, 'ok': False, 'problems': [ 'check failed: ' + repr(e) ] }
+        with self.done:
+            self.results[fname] = result
+            self.pending -= 1
+            self.done.notify_all()
+
+    def record( self, fname, problem ):
+        '''Record that fname failed without checking it (e.g. it was never downloaded)'''
+        with self.done:
+            self.results[fname] = { 'file': fname, 'ok': False, 'problems': [ problem ] }
+            self.done.notify_all()
+
+    def result( self, fname, timeout=0. ):
+        '''Result of fname, waiting up to timeout seconds for it.  None if it is not checked yet.'''
+        with self.done:
+            self.done.wait_for( lambda: fname in self.results, timeout )
+            return self.results.get( fname )
+
+    def wait_all( self, timeout=None ):
+        '''Wait until all the submitted images are checked'''
+        with self.done:
+            return self.done.wait_for( lambda: self.pending == 0, timeout )
+
+    def close( self ):
+        self.pool.shutdown( wait=True )
+
+
+def main():
+    parser = argparse.ArgumentParser( description='Check scan images and print the measured sharpness, exposure and checkerboard corners' )
+    parser.add_argument('files',nargs='+',help='Image files')
+    parser.add_argument('--decimate',default=4,type=int,help='Decode the images at 1/2, 1/4 or 1/8 of their size')
+    parser.add_argument('--checkerboard',default='',help='Inner corners of the checkerboard as COLSxROWS, empty to not look for it')
+    args = parser.parse_args()
+    checkerboard = tuple( int(v) for v in args.checkerboard.lower().split('x') ) if args.checkerboard != '' else None
+    for fname in args.files:
+        r = check_image( fname, args.decimate, checkerboard=checkerboard )
+        print( fname, 'ok' if r['ok'] else 'FAILED', 'sharpness', r['sharpness'], 'clipped', r['clipped'],
+               'dark', r['dark'], 'corners', r['corners'], '; '.join( r['problems'] ) )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
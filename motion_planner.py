@@ -0,0 +1,199 @@
+'''
+motion_planner decides how to move the gantry from one scan point to the next.
+
+Moving all five axes at once costs one SP/PA/BG exchange, one motion complete
+wait and one position save per point, instead of two when z is moved on its own
+first.  The planner uses a single simultaneous move whenever the path it takes
+stays clear of the keep-out volumes (camera, tank walls, anything else in the
+tank), and only splits the move into stages when it has to.
+
+The path of a move is not a straight line: every axis follows its own
+trapezoidal profile and they finish at different times, so the path is sampled
+in time with the same motion model used to order the scan points.  At each
+sample the gantry post (vertical, from the end of the gantry up to z=0), the arm
+to the target and the target itself are checked against the keep-out volumes.
+
+Positions are gantry settings (xg,yg,zg,phig,thetag) in mm and radians, as
+returned by get_gantry_settings.
+
+Usage:
+
+> from motion_planner import keepout, motion_planner
+> ko = keepout( spheres=[ (800.,500.,-600.,250.) ], tank=(0.,0.,-1200.,1500.,1200.,0.) )
+> planner = motion_planner( ko )
+> for stage in planner.plan( gset_from, gset_to ):
+>     print( stage )   # 5 values, None for the axes that don't move in this stage
+
+plan raises PlanningError when no move it knows is clear of the keep-out volumes.
+'''
+import numpy as np
+from scan_order import motion_model, counts_per_gset_unit
+
+target_arm = 250.0  # distance (mm) from the end of the gantry to the target (see get_gantry_setting)
+
+
+class PlanningError(Exception):
+    '''No collision free move was found.'''
+    pass
+
+
+class keepout:
+    '''
+    Volumes the gantry and target must stay out of, in gantry coordinates (mm).
+
+    spheres       = list of (x,y,z,radius), e.g. around the camera
+    boxes         = list of (xmin,ymin,zmin,xmax,ymax,zmax)
+    tank          = (xmin,ymin,zmin,xmax,ymax,zmax) the target and end of the gantry
+                    must stay inside, or None
+    target_radius = half size of the target, kept clear of the volumes (mm)
+    post_radius   = clearance around the gantry post and the arm to the target (mm)
+    '''
+    def __init__( self, spheres=[], boxes=[], tank=None, target_radius=100.0, post_radius=25.0 ):
+        self.spheres = np.array( spheres, dtype=float ).reshape( -1, 4 )
+        self.boxes = np.array( boxes, dtype=float ).reshape( -1, 6 )
+        self.tank = None if tank is None else np.array( tank, dtype=float )
+        self.target_radius = target_radius
+        self.post_radius = post_radius
+
+    def hits( self, pts, radius ):
+        '''
+        True if any of the points pts (shape (N,3)) come within radius of a
+        keep-out volume.
+        '''
+        for x, y, z, r in self.spheres:
+            d2 = (pts[:,0]-x)**2 + (pts[:,1]-y)**2 + (pts[:,2]-z)**2
+            if np.any( d2 < (r+radius)**2 ):
+                return True
+        for box in self.boxes:
+            if np.any( np.all( (pts > box[:3]-radius) & (pts < box[3:]+radius), axis=1 ) ):
+                return True
+        return False
+
+    def top( self ):
+        '''Highest z (mm) of the keep-out volumes, -inf if there are none.'''
+        tops = list( self.spheres[:,2] + self.spheres[:,3] ) + list( self.boxes[:,5] )
+        if len(tops) == 0:
+            return -np.inf
+        return max( tops )
+
+    def outside_tank( self, pts, radius ):
+        '''True if any of the points pts come within radius of the tank walls.'''
+        if self.tank is None:
+            return False
+        return bool( np.any( (pts < self.tank[:3]+radius) | (pts > self.tank[3:]-radius) ) )
+
+    def collides( self, poses, narm=5, post_step=50.0 ):
+        '''
+        True if the gantry collides with something at any of the gantry settings
+        in poses (shape (N,5)).
+        '''
+        rg = poses[:,:3]
+        phi = poses[:,3]
+        rt = target_arm * np.stack( [ -np.sin(phi), np.cos(phi), np.zeros(len(phi)) ], axis=1 )
+        target = rg + rt
+        if self.hits( target, self.target_radius ) or self.outside_tank( target, self.target_radius ):
+            return True
+        if self.outside_tank( rg, 0. ):
+            return True
+        arm = ( rg[:,None,:] + np.linspace( 0., 1., narm )[None,:,None] * rt[:,None,:] ).reshape( -1, 3 )
+        if self.hits( arm, self.post_radius ):
+            return True
+        # the post runs from the end of the gantry up to z = 0
+        zmin = min( np.min( rg[:,2] ), 0. )
+        heights = np.arange( zmin, 0., post_step )
+        for h in heights:
+            above = rg[:,2] <= h
+            if np.any( above ):
+                post = np.column_stack( [ rg[above,0], rg[above,1], np.full( np.sum(above), h ) ] )
+                if self.hits( post, self.post_radius ):
+                    return True
+        return False
+
+
+class motion_planner:
+    '''
+    Plans the moves between gantry settings.
+
+    ko       = keepout volumes to stay clear of
+    model    = motion_model with the speeds/accelerations of the moves
+    nsamples = number of times along each move at which the path is checked
+    '''
+    def __init__( self, ko, model=None, nsamples=40 ):
+        if model is None:
+            model = motion_model()
+        self.ko = ko
+        self.model = model
+        self.nsamples = nsamples
+
+    def path( self, gfrom, gto, axes ):
+        '''
+        Gantry settings sampled along a move of the given axes from gfrom to gto.
+        '''
+        gfrom = np.asarray( gfrom, dtype=float )
+        dcounts = np.zeros( 5 )
+        for k in axes:
+            dcounts[k] = ( gto[k] - gfrom[k] ) * counts_per_gset_unit[k]
+        duration = float( self.model.move_time( np.zeros(5), dcounts ) )
+        t = np.linspace( 0., duration, self.nsamples )
+        return gfrom + self.model.covered( dcounts, t ) / counts_per_gset_unit
+
+    def stages_clear( self, gfrom, gto, stages ):
+        '''True if moving the stages of axes one after the other avoids all keep-out volumes.'''
+        cur = np.asarray( gfrom, dtype=float ).copy()
+        for axes in stages:
+            if self.ko.collides( self.path( cur, gto, axes ) ):
+                return False
+            for k in axes:
+                cur[k] = gto[k]
+        return True
+
+    def plan( self, gfrom, gto ):
+        '''
+        Plan the move from gantry setting gfrom to gto.
+
+        Returns a list of stages to execute in order.  Each stage is a list of
+        5 target values with None for the axes that are not moved in that stage.
+        A single stage is returned if all axes can move at once.  Raises
+        PlanningError if no plan is clear.
+        '''
+        gfrom = np.asarray( gfrom, dtype=float )
+        gto = np.asarray( gto, dtype=float )
+        others = (0, 1, 3, 4)
+        candidates = [ [ (0, 1, 2, 3, 4) ],  # everything at once
+                       [ (2,), others ],     # z first
+                       [ others, (2,) ] ]    # z last
+        for stages in candidates:
+            if self.stages_clear( gfrom, gto, stages ):
+                return self._stages( gto, stages )
+        # go up above the keep-out volumes, across, then down
+        via = gfrom.copy()
+        via[2] = min( 0., max( gfrom[2], gto[2], self.ko.top() + self.ko.target_radius + self.ko.post_radius ) )
+        if self.stages_clear( gfrom, via, [ (2,) ] ) and self.stages_clear( via, gto, [ others, (2,) ] ):
+            return [ self._stage( via, (2,) ) ] + self._stages( gto, [ others, (2,) ] )
+        raise PlanningError( 'no collision free move from ' + str(gfrom) + ' to ' + str(gto) )
+
+    def plan_scan( self, gsets, start ):
+        '''
+        Plan the moves of a whole scan starting from gantry setting start.
+        Returns one list of stages (see plan) per scan point.  Raises PlanningError
+        naming the points that can not be reached from the one before.
+        '''
+        plans = []
+        blocked = []
+        cur = start
+        for n, gset in enumerate( gsets ):
+            try:
+                plans.append( self.plan( cur, gset ) )
+            except PlanningError:
+                blocked.append( n )
+            cur = gset
+        if len(blocked) > 0:
+            raise PlanningError( '%d points have no collision free move from the point before, first: %s'
+                                 % ( len(blocked), ', '.join( str(n) for n in blocked[:10] ) ) )
+        return plans
+
+    def _stage( self, gto, axes ):
+        return [ float(gto[k]) if k in axes else None for k in range(5) ]
+
+    def _stages( self, gto, stages ):
+        return [ self._stage( gto, axes ) for axes in stages ]
@@ -10,13 +10,13 @@ move_x_in_mm = 50.0
 delay_in_seconds = 30
 
 
-import gantrycontrol as gc
+import gantry_daemon as gd
 import time
 import math
 import subprocess
 import numpy as np
 import math
-gantry = gc.gantrycontrol()
+gantry = gd.connect() # the gantry daemon if it is running, else a connection of our own
 
 #Move desired axis(x,y,z) by desired mm
 for i in range(number_of_moves):
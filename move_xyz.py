@@ -2,13 +2,13 @@
 ######## Program to move x,y,z axes by desired mm. ###########
 ######## Just answer the questions the program asks        ###########
 
-import gantrycontrol as gc
+import gantry_daemon as gd
 import time
 import math
 import subprocess
 import numpy as np
 import math
-gantry = gc.gantrycontrol()
+gantry = gd.connect() # the gantry daemon if it is running, else a connection of our own
 
 #Move desired axis(x,y,z) by desired mm
 run=True
@@ -5,16 +5,29 @@ Blair Jamieson
 Nov. 2022
 '''
 
+import concurrent.futures
+import queue
+import re
 import subprocess
+import threading
 import time
+import tracing
+from camera_workers import CameraError, camera_worker
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
 
 # Global blob of info
 class pgcamera2:
-    def __init__( self, camerafile='pgcamera_cameras.txt', buildcamerafile=False ):
+    def __init__( self, camerafile='pgcamera_cameras.txt', buildcamerafile=False, max_pending=20, backend=None ):
         '''
         Setup camera control object to keep track of all
         cameras available, or just use ones in a list in a textfile.
 
+        The cameras are found once per process by the camera registry
+        (see get_registry), so making more pgcamera2 objects is cheap.
+
         If buildcamerafile is True then the list_of_cameras_file
         is overwritten with the list of cameras found.
 
@@ -22,25 +35,59 @@ class pgcamera2:
         cameras in the file.
 
         setcamno is the camera number to use from startup
+
+        max_pending is the most images captured with deferred=True
+        left on a camera waiting to be downloaded
+
+        backend is a camera_workers backend class to keep a session open
+        with each camera in a worker process, or None to run gphoto2 for
+        every capture
         '''
+        self.max_pending = max_pending
+        self.downloads = {}  # cam_no -> queue of (camera path, image name) to download
+        self.failed = []     # (cam_no, camera path, image name) of failed downloads
+        self.on_download = None  # called with (cam_no, image name, ok) after each deferred download
+        self.guard = threading.Lock()
+        self.registry = get_registry( backend=backend )
         if buildcamerafile:
-            self.camvitals = build_camera_file( camerafile )
-        else:
-            self.camvitals = read_camera_file( camerafile )
+            build_camera_file( camerafile )
+        self.camnos = read_camera_numbers( camerafile )
+
+    @property
+    def camvitals( self ):
+        '''
+        camvitals of the cameras in the camera file that are connected,
+        with their current USB ports.
+        '''
+        return self.registry.camvitals( self.camnos )
 
-    def capture_image(self, cam_no,  dir='', label='img', append_date=True ):
+    def capture_image(self, cam_no,  dir='', label='img', append_date=True, deferred=False, barrier=None ):
         '''
         Takes a photo from camera cam_no and saves it as filename:
         'dir/c<num>_'+label[+date].jpg'
 
         Stores the camera settings in:
         'dir/c<unm>_'+label[+date].txt'
+
+        If deferred is True only the exposure is taken and the image is left
+        on the camera.  A background thread downloads it (and deletes it from
+        the camera) while the gantry moves on.  This waits if max_pending
+        images are already waiting on the camera.  Call flush() to wait for
+        all downloads.
+
+        barrier is a threading.Barrier waited on just before gphoto2 is
+        started, so that several cameras fire together (see capture_all).
+
+        Returns a dict with the image 'file' (None if it failed), the
+        'latency' in seconds from starting gphoto2 until it finished,
+        the 'error' text (None if it worked) and the camera 'serial' number.
         '''
         cam_no = str(cam_no)
-        idx = camvitals_index_from_camno( self.camvitals, cam_no )
+        camvitals = self.camvitals
+        idx = camvitals_index_from_camno( camvitals, cam_no )
         if idx < 0:
             print('capture_image camera ',cam_no,' not found')
-            return
+            return { 'file': None, 'latency': 0., 'error': 'camera '+cam_no+' not found' }
         imgname = dir+'/'
         if dir == '':
             imgname = '';
@@ -49,26 +96,418 @@ class pgcamera2:
             imgname = imgname + time.strftime('%Y%m%d-%H:%M:%S%Z')
         metaname = imgname + '.txt'
         imgname = imgname + '.jpg'
-        command = ['gphoto2',
-                   '--port='+self.camvitals[idx][2],
-                   '--wait-event=4s',
-                   '--capture-image-and-download',
-                   '--filename='+imgname ]
+        with self.camera_lock( cam_no ):
+            if barrier is not None:
+                try:
+                    with tracing.span( 'barrier', 'camera', cam=cam_no ):
+                        barrier.wait( 60 )
+                except threading.BrokenBarrierError:
+                    pass # another camera did not get ready in time, fire anyway
+            tstart = time.time()
+            with tracing.span( 'trigger' if deferred else 'capture', 'camera', cam=cam_no ):
+                if self.registry.backend is None:
+                    error, campath = self.spawn_capture( camvitals[idx][0], camvitals[idx][2], imgname, deferred )
+                else:
+                    error, campath = self.worker_capture( camvitals[idx][0], imgname, deferred )
+            latency = time.time()-tstart
+        if error is not None:
+            return { 'file': None, 'latency': latency, 'error': error }
+        if deferred:
+            if campath is None:
+                print('capture_image camera ',cam_no,' did not report the new file')
+                return { 'file': None, 'latency': latency, 'error': 'no new file reported' }
+            self.download_queue( cam_no ).put( (campath, imgname) )
+        #capture_abilities( camvitals[idx][2], metaname )
+        return { 'file': imgname, 'latency': latency, 'error': None, 'serial': camvitals[idx][0] }
+
+    def spawn_capture( self, serno, port, imgname, deferred ):
+        '''
+        Capture with a new gphoto2 process, retrying once if it fails.
+        Returns the error (None if it worked) and the path of the image
+        on the camera if deferred.
+        '''
+        if deferred:
+            command = ['gphoto2',
+                       '--port='+port,
+                       '--wait-event=4s',
+                       '--capture-image' ]
+        else:
+            command = ['gphoto2',
+                       '--port='+port,
+                       '--wait-event=4s',
+                       '--capture-image-and-download',
+                       '--filename='+imgname ]
         print(command)
         result = subprocess.run( command, capture_output=True, text=True )
         if result.stderr != '':  # check if there was an error
             print(result.stderr)
-            self.camvitals = reset_camera_camvital_idx( self.camvitals, idx )
-            # try the capture again
-            command[3] = 'port='+self.camvitals[idx][2]
+            # find the camera again, in case it moved to another port, and try the capture again
+            port = self.registry.reprobe( serno )
+            if port is not None:
+                command[1] = '--port='+port
             print(command)
             result = subprocess.run( command, capture_output=True, text=True )
             if result.stderr != '':
                 print(result.stderr, ' giving up!')
-        #capture_abilities( self.camvitals[idx][2], metaname )
+                return result.stderr, None
+        return None, camera_file_path( result.stdout )
+
+    def worker_capture( self, serno, imgname, deferred ):
+        '''
+        Capture with the camera's worker process (see camera_workers),
+        retrying once if it fails.  Returns the error (None if it worked)
+        and the path of the image on the camera if deferred.
+        '''
+        for attempt in range(2):
+            try:
+                worker = self.registry.worker( serno )
+                if worker is None:
+                    raise CameraError( 'camera '+serno+' is not connected' )
+                if deferred:
+                    return None, worker.call( 'trigger' )
+                worker.call( 'capture', imgname )
+                return None, None
+            except CameraError as e:
+                error = str(e)
+                print(error)
+                if attempt == 0:
+                    self.registry.reprobe( serno )
+        print(' giving up!')
+        return error, None
+
+    def capture_all(self, cam_nos, dir='', label='img', append_date=True, deferred=False ):
+        '''
+        Takes a photo with each of the cameras in cam_nos at the same time,
+        one thread (and gphoto2 process) per camera.  The threads wait on a
+        barrier so all the gphoto2 processes are started together.
+
+        label is used for all the cameras, or is a dict of labels by
+        camera number.  The other arguments are as for capture_image.
+
+        Returns a dict of capture_image results by camera number.
+        '''
+        cam_nos = [ str(cam_no) for cam_no in cam_nos ]
+        if isinstance( label, dict ):
+            labels = { str(cam_no): lab for cam_no, lab in label.items() }
+        else:
+            labels = { cam_no: label for cam_no in cam_nos }
+        found = [ cam_no for cam_no in cam_nos if camvitals_index_from_camno( self.camvitals, cam_no ) >= 0 ]
+        barrier = threading.Barrier( max( len(found), 1 ) )
+        with concurrent.futures.ThreadPoolExecutor( max_workers=max( len(cam_nos), 1 ) ) as pool:
+            futures = { cam_no: pool.submit( self.capture_image, cam_no, dir, labels[cam_no], append_date, deferred,
+                                             barrier if cam_no in found else None )
+                        for cam_no in cam_nos }
+        return { cam_no: future.result() for cam_no, future in futures.items() }
+
+    def camera_lock( self, cam_no ):
+        '''
+        Lock to hold while running gphoto2 on camera cam_no, since only one
+        process at a time can use a camera.
+        '''
+        camvitals = self.camvitals
+        idx = camvitals_index_from_camno( camvitals, str(cam_no) )
+        if idx < 0:
+            return self.registry.camera_lock( 'cam'+str(cam_no) )
+        return self.registry.camera_lock( camvitals[idx][0] )
+
+    def download_queue( self, cam_no ):
+        '''
+        Queue of images waiting on camera cam_no, starting its download thread
+        the first time.
+        '''
+        with self.guard:
+            if cam_no not in self.downloads:
+                self.downloads[cam_no] = queue.Queue( maxsize=self.max_pending )
+                worker = threading.Thread( target=self.download_worker, args=(cam_no,), daemon=True )
+                worker.start()
+            return self.downloads[cam_no]
+
+    def download_worker( self, cam_no ):
+        '''
+        Download the images queued for camera cam_no, one at a time.
+        '''
+        q = self.downloads[cam_no]
+        while True:
+            campath, imgname = q.get()
+            try:
+                with self.camera_lock( cam_no ), tracing.span( 'download', 'camera', cam=cam_no ):
+                    camvitals = self.camvitals
+                    idx = camvitals_index_from_camno( camvitals, cam_no )
+                    if idx < 0:
+                        ok = False
+                    elif self.registry.backend is None:
+                        ok = download_camera_file( camvitals[idx][2], campath, imgname )
+                    else:
+                        self.registry.worker( camvitals[idx][0] ).call( 'download', campath, imgname )
+                        ok = True
+                if not ok:
+                    self.failed.append( (cam_no, campath, imgname) )
+            except Exception as e:
+                print('download of',imgname,'failed:',e)
+                self.failed.append( (cam_no, campath, imgname) )
+                ok = False
+            finally:
+                if self.on_download is not None:
+                    self.on_download( cam_no, imgname, ok )
+                q.task_done()
+
+    def flush( self ):
+        '''
+        Wait until all the images captured with deferred=True are downloaded.
+        Returns the list of (cam_no, camera path, image name) that failed.
+        '''
+        with tracing.span( 'flush', 'camera' ):
+            for q in list( self.downloads.values() ):
+                q.join()
+        failed = self.failed
+        self.failed = []
+        for cam_no, campath, imgname in failed:
+            print('flush: camera',cam_no,'image',campath,'was not downloaded to',imgname)
+        return failed
+
+
+class camera_registry:
+    '''
+    Process wide map of the connected cameras, from serial number to USB port.
+
+    The serial numbers are probed once per port (which takes a few seconds
+    per camera), and then only for cameras that appear on a new port or
+    whose capture failed.  watch() keeps the map up to date when cameras
+    are plugged in or out, without running gphoto2 while a camera is in use.
+    '''
+    def __init__( self, backend=None ):
+        self.backend = backend  # camera_workers backend class, None to spawn gphoto2
+        self.lock = threading.Lock()        # protects cameras, locks and workers
+        self.refreshing = threading.Lock()  # one refresh at a time
+        self.cameras = {}  # port -> [ser_no, cam_type]
+        self.locks = {}    # ser_no -> lock held while gphoto2 uses the camera
+        self.workers = {}  # port -> camera_worker, with a backend
+        self.probes = 0    # number of serial number probes done
+        self.watcher = None
+
+    def refresh( self ):
+        '''
+        Rerun gphoto2 --auto-detect, probe the serial number of the cameras
+        on new ports only, and forget the ports that are gone.
+        '''
+        with self.refreshing:
+            if self.backend is None:
+                detected = detect_camera_ports()
+            else:
+                detected = self.backend.detect()
+            with self.lock:
+                known = dict( self.cameras )
+            cameras = {}
+            for port, camname in detected:
+                if port in known:
+                    cameras[port] = known[port]
+                else:
+                    cameras[port] = [ self.probe( port ), camname ]
+                    self.probes += 1
+            with self.lock:
+                self.cameras = cameras
+                gone = [ port for port in self.workers if port not in cameras ]
+                workers = [ self.workers.pop( port ) for port in gone ]
+            for worker in workers:
+                worker.stop()
+
+    def probe( self, port ):
+        '''Serial number of the camera on port, '-1' if there is none.'''
+        if self.backend is None:
+            return get_camera_serialno( port )
+        worker = camera_worker( self.backend, port )
+        try:
+            serno = str( worker.call( 'serial_number' ) )
+        except CameraError as e:
+            print('usbport=',port,' probe failed:',e)
+            worker.stop()
+            return '-1'
+        with self.lock:
+            self.workers[port] = worker
+        print('usbport=',port,' serno=',serno)
+        return serno
+
+    def worker( self, serno ):
+        '''
+        camera_worker of camera serno (with a backend), or None if it is
+        not connected.
+        '''
+        port = self.port( serno )
+        with self.lock:
+            if port is None:
+                return None
+            if port not in self.workers:
+                self.workers[port] = camera_worker( self.backend, port )
+            return self.workers[port]
+
+    def reprobe( self, serno ):
+        '''
+        Find camera serno again after its capture failed, probing its old
+        port again.  Returns its port, or None if it is not connected.
+        '''
+        workers = []
+        with self.lock:
+            for port, camera in list( self.cameras.items() ):
+                if camera[0] == serno:
+                    del self.cameras[port]
+                    if port in self.workers:
+                        workers.append( self.workers.pop( port ) )
+        for worker in workers:
+            worker.stop()
+        self.refresh()
+        return self.port( serno )
+
+    def port( self, serno ):
+        '''USB port of camera serno, or None if it is not connected.'''
+        with self.lock:
+            for port, camera in self.cameras.items():
+                if camera[0] == serno:
+                    return port
+        return None
+
+    def camports( self ):
+        '''
+        The connected cameras as returned by get_camera_ports:
+        camports = [ [ser_no, port, cam_type], ... ]
+        '''
+        with self.lock:
+            return [ [camera[0], port, camera[1]] for port, camera in self.cameras.items() ]
+
+    def camvitals( self, camnos ):
+        '''
+        camvitals = [ [ser_no, cam_no, port, cam_type ], ... ] of the cameras
+        in camnos = [ [cam_no, ser_no], ... ] that are connected.
+        '''
+        byserial = { camport[0]: camport for camport in self.camports() }
+        camvitals = []
+        for camno, serno in camnos:
+            if serno in byserial:
+                camvitals.append( [serno, camno, byserial[serno][1], byserial[serno][2]] )
+        return camvitals
+
+    def camera_lock( self, serno ):
+        '''Lock to hold while gphoto2 uses camera serno.'''
+        with self.lock:
+            if serno not in self.locks:
+                self.locks[serno] = threading.Lock()
+            return self.locks[serno]
+
+    def refresh_idle( self ):
+        '''
+        refresh() holding the locks of all the cameras, so gphoto2 does not
+        use the USB bus while a camera is capturing or downloading.  Returns
+        False without refreshing if a camera is in use.
+        '''
+        with self.lock:
+            locks = list( self.locks.values() )
+        held = []
+        try:
+            for lock in locks:
+                if not lock.acquire( blocking=False ):
+                    return False
+                held.append( lock )
+            self.refresh()
+            return True
+        finally:
+            for lock in held:
+                lock.release()
+
+    def watch( self, poll=None ):
+        '''
+        Keep the registry up to date from a background thread.  USB hot-plug
+        events trigger a refresh if pyudev is installed.  Without it nothing
+        is watched unless poll is given: then gphoto2 --auto-detect is rerun
+        every poll seconds.  Refreshes wait until no camera is in use.
+        '''
+        if self.watcher is not None:
+            return
+        if pyudev is None and poll is None:
+            return
+        target = self.watch_udev if pyudev is not None else self.watch_poll
+        self.watcher = threading.Thread( target=target, args=(poll,), daemon=True )
+        self.watcher.start()
+
+    def watch_udev( self, poll ):
+        monitor = pyudev.Monitor.from_netlink( pyudev.Context() )
+        monitor.filter_by( subsystem='usb', device_type='usb_device' )
+        for device in iter( monitor.poll, None ):
+            if device.action in ('add', 'remove'):
+                time.sleep( 1 ) # let the camera finish connecting
+                while not self.refresh_idle():
+                    time.sleep( 1 )
+
+    def watch_poll( self, poll ):
+        while True:
+            time.sleep( poll )
+            self.refresh_idle()
+
+
+registry = None
+registry_guard = threading.Lock()
+
+def get_registry( watch=True, backend=None ):
+    '''
+    Return the process wide camera_registry, finding the cameras and
+    starting to watch for hot-plug events (with pyudev) the first time.  backend is
+    the camera_workers backend class used by the cameras (None to spawn
+    gphoto2 for each command), and can only be chosen the first time.
+    '''
+    global registry
+    with registry_guard:
+        if registry is None:
+            registry = camera_registry( backend )
+            registry.refresh()
+            if watch:
+                registry.watch()
+        elif backend is not None and backend is not registry.backend:
+            print('get_registry: cameras already use',registry.backend,', not',backend)
+        return registry
 
 
 # Helper functions outsidet he class
+def camera_file_path( output ):
+        '''
+        Path of the new image on the camera from the output of
+        gphoto2 --capture-image, or None if there is none.
+        '''
+        match = re.search( r'New file is in location (\S+) on the camera', output )
+        if match is None:
+            return None
+        return match.group(1)
+
+def download_camera_file( port, campath, imgname ):
+        '''
+        Download the file at campath on the camera at usbport 'port'
+        to imgname, then delete it from the camera.
+        Returns True if it worked.
+        '''
+        folder, name = campath.rsplit( '/', 1 )
+        command = ['gphoto2',
+                   '--port='+port,
+                   '--folder='+folder,
+                   '--list-files' ]
+        result = subprocess.run( command, capture_output=True, text=True )
+        number = None
+        for line in result.stdout.splitlines():
+            words = line.split()
+            if len(words) > 1 and words[0].startswith('#') and words[1] == name:
+                number = words[0][1:]
+        if number is None:
+            print('download_camera_file',campath,'not found on camera',port)
+            return False
+        command = ['gphoto2',
+                   '--port='+port,
+                   '--folder='+folder,
+                   '--get-file='+number,
+                   '--filename='+imgname,
+                   '--delete-file='+number ]
+        print(command)
+        result = subprocess.run( command, capture_output=True, text=True )
+        if result.stderr != '':
+            print(result.stderr)
+            return False
+        return True
+
 def capture_abilities( port, metaname ):
         '''
         talk to camera at usbport 'port' to get its settings
@@ -149,22 +588,35 @@ def get_camera_ports():
     Returns the list:
     camports = [ [ser_no, port, cam_type], ... ]
     '''
+    camports = []
+    for camport, camname in detect_camera_ports():
+        serno = get_camera_serialno( camport )
+        camports.append( [serno, camport, camname] )
+
+    return camports
+
+def detect_camera_ports():
+    '''
+    Return the list of ports with cameras connected, without probing
+    their serial numbers.
+
+    Returns the list:
+    detected = [ [port, cam_type], ... ]
+    '''
     command = ['gphoto2','--auto-detect' ]
     result = subprocess.run( command, capture_output=True, text=True )
     lines = result.stdout.splitlines()
-    camports = []
-    #print('get_camera_ports result=',result)
+    detected = []
+    #print('detect_camera_ports result=',result)
     for line in lines:  
-        print('line=',line)
         words = line.split(' ')
         if words[0] == 'Sony' or (words[0] == 'USB' and words[1] == 'PTP'):
             words = line.split(':')
             camname = words[0][:-6].strip(' ')
             camport = 'usb:'+words[1].strip(' ')
-            serno = get_camera_serialno( camport )
-            camports.append( [serno, camport, camname] )
+            detected.append( [camport, camname] )
 
-    return camports
+    return detected
 
 def get_camera_serialno( usbport ):
      '''
@@ -190,7 +642,7 @@ def build_camera_file( camerafile = 'pgcamera_cameras.txt' ):
 
      camvitals = [ [ser_no, cam_no, port, cam_type ], ... ]
      '''
-     camports = get_camera_ports()
+     camports = get_registry().camports()
      # sort by serial number and assign camera numbers
      sorted( camports, key=lambda x : x[0] )
      camvitals = []
@@ -212,25 +664,27 @@ def read_camera_file( fname ):
 
      Returns camvitals for cameras from file that are currently connected.
      '''
-     camports = get_camera_ports()
-     camvitals = []
+     return get_registry().camvitals( read_camera_numbers( fname ) )
+
+
+def read_camera_numbers( fname ):
+     '''
+     Read the camera number to serial number mapping from file fname.
+
+     Returns camnos = [ [cam_no, ser_no], ... ]
+     '''
+     camnos = []
      try:
          f=open(fname,'r')
          lines = f.readlines()
          for line in lines:
             curcam, curserno = line.split(' ')
             curserno = curserno.strip('\n')
-            #print('search for curcam=',curcam,' curserno=',curserno)
-            #print(' in camports=',camports)
-            for camport in camports:
-                #print('... try camport=',camport,' serno=',camport[0])
-                if camport[0] == curserno:
-                    camvitals.append( [camport[0], curcam, camport[1], camport[2] ] )
-                    break
+            camnos.append( [curcam, curserno] )
          f.close()
      except:
-         print('read_camera_file(',fname,') failed')
-     return camvitals
+         print('read_camera_numbers(',fname,') failed')
+     return camnos
 
 
 def print_camera_list( camvitals ):
@@ -20,9 +20,10 @@
 #Location of limit switch is -ve direction for move command.
 
 from datetime import datetime
+import argparse
 import gantrycontrol as gc
 import pgcamera2 as pg
-import time
+import tracing
 import math
 import subprocess
 import numpy as np
@@ -98,75 +99,148 @@ class Parameters:
 		print("r = ", self.r)
 
 
+def arc_pose(r_c,r,phi):
+	'''
+	Gantry x,y (mm) and pattern angle phi_t (degrees, tangent to the arc) at arc angle(s) phi (rad).
+	'''
+	x=r_c[0]+r*np.cos(phi)
+	y=r_c[1]+r*np.sin(phi)
+	phi_t=np.degrees(np.arctan2(np.sin(phi),np.cos(phi))-math.pi/2) #Angle to make pattern tangent to the arc
+	return x,y,phi_t
+
+def fly_arc(r,phi_from,phi_to,speed,accel,dt):
+	'''
+	Arc angles (rad) every dt seconds of a fly scan along the arc of radius r from phi_from to
+	phi_to, at constant tangential speed (mm/s) with acceleration accel (mm/s^2) at both ends.
+	The last angle is phi_to.
+	'''
+	length=abs(phi_to-phi_from)*r
+	taccel=speed/accel
+	if speed*taccel>length: #too short to reach speed
+		taccel=math.sqrt(length/accel)
+		speed=accel*taccel
+	tend=2*taccel+(length-speed*taccel)/speed
+	t=np.arange(math.ceil(tend/dt)+1)*dt
+	s=np.where(t<taccel,0.5*accel*t**2,0.5*accel*taccel**2+speed*(t-taccel))
+	s=np.where(t>tend-taccel,length-0.5*accel*np.maximum(tend-t,0.)**2,s)
+	s=np.minimum(s,length)
+	return phi_from+math.copysign(1.,phi_to-phi_from)*s/r
+
+def capture(n,x,y,z):
+	with tracing.span('images','scan',n=n):
+		capture_images(n,x,y,z)
+
+def capture_images(n,x,y,z):
+	#capturing image here
+	labels = {4: str(n)+'_pch4air1_z'+str(round(z,1))+'_y'+str(round(y,1))+'_x'+str(round(x,1)),
+		  7: str(n)+'_pch7air1_z'+str(round(z,1))+'_y'+str(round(y,1))}
+	print(labels)
+	pgc.capture_all([4,7],dir='',label=labels,append_date=False)
+
+	capture_command = ['ssh','jamieson@hyperk.uwinnipeg.ca','python /home/jamieson/HyperK_Summer_Photogrammetry/RayfinRelated/RayfinTCP_takepicture.py -i 192.168.0.102 -l 192.168.0.100 -p 8888' ]
+	print(capture_command)
+	with tracing.span('rayfin','camera'):
+		capture=subprocess.run( capture_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10 )
+
+
+parser = argparse.ArgumentParser( description='scan_arc options' )
+parser.add_argument('--fly',help='Move continuously along each arc, taking the images without stopping',action='store_true')
+parser.add_argument('--fly-speed',dest='fly_speed',default=0.,type=float,help='Tangential speed of the fly scan (mm/s), default is the fastest the stop-and-go axis speeds allow')
+parser.add_argument('--fly-dt',dest='fly_dt',default=6,type=int,help='Contour segment time of the fly scan is 2**n ms')
+parser.add_argument('--trace',default='',help='Record tracing spans and write them to this Chrome trace JSON file (and a .csv summary)')
+args = parser.parse_args()
+if args.trace!='':
+	tracing.enable()
+
 param=Parameters()
 
 gantry = gc.gantrycontrol()
+pgc=pg.pgcamera2()
 
 # zero the gantry; Moves the gantry to home(where all limit switches are)
 gantry.locate_home_xyz()
 
 # scan in circle
 #Copying the parameter values into 'nicer' variable names
-cur_phi=param.phi_min
 zmin=param.z_min
 zstep=param.z_step
 r_c=param.r_c
-phistep=param.phi_step
+
+#Arc angles of the stations, the arcs go back and forth
+stations=param.phi_min+param.phi_step*np.arange(param.nphi)
+arcs=[stations if i%2==0 else stations[::-1] for i in range(param.nz)]
+
+#Axis speeds of the stop-and-go scan (counts/s), also the limits for the fly scan
+xy_speed=1000
+phi_speed=100
+fly_speed=args.fly_speed
+if fly_speed<=0:
+	x_speed,y_speed,_,phi_speed_deg,_=gantry.units.from_counts([xy_speed,xy_speed,0,phi_speed,0]) #mm/s and degrees/s
+	fly_speed=min(x_speed,y_speed,param.r*math.radians(phi_speed_deg))
+fly_accel=4*fly_speed # reach speed in 0.25 s
 
 
 n=1 #For keeping track of which z height we are in. For the purpose of assigning filename to images.
 f_time = open("time_per_pos", "w")
+prev_phi_t=None
 for i in range( param.nz ):
 	#Moving Gantry here
 	curz = zmin+zstep*i
 #	_,_,curz,_,_ = gantry.unconvert( 1, 1, curz, 1, 1)
 	gantry.move( "DM", "DM", curz )
-	for j in range( param.nphi ):
-		t1 = datetime.now() #initial time
-		print('Picture no: ',n)
-		#print('cur t = ',t)
-		r=param.r*np.array([math.cos(cur_phi),math.sin(cur_phi)])
-		r_t=r_c+r
-		print("current angle =",cur_phi)
-
-		#Calculating Angle to make pattern tangent to the arc
-		phi_prime=math.atan2(r[1],r[0])+math.pi
-		phi_t = math.degrees(phi_prime-math.pi/2-math.pi) #Angle to make pattern tangent to the arc
-		print("phi_t= ",phi_t)
-		print("rx, ry = ",r[0]," ",r[1])
-		print("phi_prime = ",phi_prime)
-
-		gantry.move(r_t[0],r_t[1],"DM",phi_t,0,1000,1000,100,100)
-		time.sleep(1)
-		cur_phi=cur_phi+phistep
-
-#capturing image here
-		label = str(n)+'_pch4air1_z'+str(round(curz,1))+'_y'+str(round(r_t[1],1))+'_x'+str(round(r_t[0],1))
-		print(label)
-		pgc=pg.pgcamera2()
-		pgc.capture_image(4,dir='',label=label,append_date=False)
-
-		label = str(n)+'_pch7air1_z'+str(round(curz,1))+'_y'+str(round(cury,1))
-		print(label)
-		pgc.capture_image(7,dir='',label=label,append_date=False)
-
-		capture_command = ['ssh','jamieson@hyperk.uwinnipeg.ca','python /home/jamieson/HyperK_Summer_Photogrammetry/RayfinRelated/RayfinTCP_takepicture.py -i 192.168.0.102 -l 192.168.0.100 -p 8888' ]
-		print(capture_command)
-		capture=subprocess.run( capture_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10 )
-
-
-		#Writing time taken to capture image per position.
-		t2 = datetime.now() #final time
-		delta_t=(t2-t1).total_seconds()
-		print("time taken = ",delta_t)
-		f_time.write(str(delta_t)+", ") #Write the time taken per pose.
+	if args.fly:
+		#Stations of this arc, then the commanded arc angle every 2**fly_dt ms
+		stations=arcs[i]
+		phis=fly_arc(param.r,stations[0],stations[-1],fly_speed,fly_accel,2**args.fly_dt/1000.)
+		x,y,phi_t=arc_pose(r_c,param.r,phis)
+		phi_t=phi_t[0]+np.degrees(phis-phis[0]) #no jump where atan2 wraps
+		if prev_phi_t is not None:
+			phi_t=phi_t+360.*round((prev_phi_t-phi_t[0])/360.) #start the pattern rotation where the last arc ended
+		prev_phi_t=phi_t[-1]
+		gantry.move(x[0],y[0],"DM",phi_t[0],0,1000,1000,100,100)
+		gantry.wait_settled()
+		zeros=np.zeros(len(x))
+		counts=gantry.units.to_counts(np.column_stack([x,y,zeros,phi_t,zeros]))[:,[0,1,3]].astype(int)
+		s=np.abs(phis-phis[0])
+		station_index=np.searchsorted(s,np.abs(stations-stations[0])-1e-9)
+		t1 = datetime.now()
+		def at_station(j,k):
+			global t1
+			print('Picture no: ',n,' station ',j,' at angle ',math.degrees(phis[k]))
+			capture(n,x[k],y[k],curz)
+			t2 = datetime.now()
+			f_time.write(str((t2-t1).total_seconds())+", ") #Write the time taken per pose.
+			t1 = t2
+		skipped=gantry.run_contour('ABD',counts.tolist(),args.fly_dt,station_index.tolist(),at_station)
+		if len(skipped)>0:
+			print('Skipped stations',skipped,'use a lower --fly-speed')
+	else:
+		#Poses of all the stations of this arc, pattern tangent to the arc
+		x,y,phi_t=arc_pose(r_c,param.r,arcs[i])
+		for j in range( param.nphi ):
+			t1 = datetime.now() #initial time
+			print('Picture no: ',n)
+			print("current angle =",arcs[i][j])
+			print("phi_t= ",phi_t[j])
+			print("x, y = ",x[j]," ",y[j])
+
+			gantry.move(x[j],y[j],"DM",phi_t[j],0,1000,1000,100,100)
+			gantry.wait_settled()
+
+			capture(n,x[j],y[j],curz)
+
+			#Writing time taken to capture image per position.
+			t2 = datetime.now() #final time
+			delta_t=(t2-t1).total_seconds()
+			print("time taken = ",delta_t)
+			f_time.write(str(delta_t)+", ") #Write the time taken per pose.
 
-	# flip sign of phi step to step back!
-	phistep = -phistep
-	cur_phi=cur_phi+phistep
 	n+=1
 
 #gantry.move("DM","DM","DM",0) #"DM" means don't move
 print('Done scan')
 f_time.close() # close the file
+if args.trace!='':
+	tracing.export_chrome(args.trace)
+	tracing.export_csv(args.trace.rsplit('.',1)[0]+'.csv')
 del gantry
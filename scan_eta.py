@@ -0,0 +1,183 @@
+'''
+scan_eta predicts how long a scan will take without connecting to the controller.
+
+Each move follows the trapezoidal profile of motion_model (SP, AC and DC of every
+axis), lengthened by the KS smoothing of the axes that move.  Every scan point
+then costs a settle time and a capture time.  The total, the time per point and
+how busy each axis is are reported.
+
+The model can be calibrated from recorded per-point times, like the time_per_pos
+files written by scan_arc.py and scan_spherical.py --time-per-pos: the recorded
+times are fitted as move_scale * predicted move time + per-point overhead.  The
+capture time the points were recorded with is taken off the overhead, which then
+replaces the settle time only, so a calibration made with one camera setup still
+predicts scans with another (give their capture time).
+
+Usage:
+
+> from scan_eta import scan_eta, read_time_per_pos
+> eta = scan_eta( settle=0.1, capture=5.0 )
+> est = eta.estimate( plans, start=[0.,0.,0.,0.,0.] )   # plans as made by motion_planner.plan_scan
+> est = eta.summarize( plan.move_times, plan.axis_times ) # same, from the times compiled into a scan_plan
+> print_estimate( est )
+> eta.calibrate( est['move_times'], read_time_per_pos( 'time_per_pos' ) )
+> eta.save( 'scan_eta_calibration.json' )
+'''
+import json
+import numpy as np
+from scan_order import motion_model, counts_per_gset_unit, scan_speeds, scan_accels, scan_decels
+
+axis_names = ( 'x', 'y', 'z', 'phi', 'theta' )
+
+# KS smoothing of each axis: controller default 2, gantrycontrol sets 50 on phi and theta
+scan_ks = ( 2., 2., 2., 50., 50. )
+
+# Seconds a move is lengthened per unit of KS (the smoothing filter delays the end of the move)
+ks_time = 0.0005
+
+
+class scan_eta:
+    '''
+    Offline scan time model.
+
+    speeds, accels, decels, ks = SP (counts/s), AC, DC (counts/s^2) and KS of each axis
+    settle   = seconds to settle after the last move of each point
+    capture  = seconds to take the images at each point
+    '''
+    def __init__( self, speeds=scan_speeds, accels=scan_accels, decels=scan_decels, ks=scan_ks, settle=0.1, capture=0.0 ):
+        self.model = motion_model( speeds, accels, decels )
+        self.smoothing = np.array( ks, dtype=float ) * ks_time
+        self.settle = settle
+        self.capture = capture
+        self.move_scale = 1.0    # calibrated factor on the predicted move times
+        self.overhead = None     # calibrated seconds per point besides moving and capturing, replaces settle
+
+    def point_overhead( self ):
+        '''Seconds spent at each point besides moving'''
+        if self.overhead is not None:
+            return self.overhead + self.capture
+        return self.settle + self.capture
+
+    def stage_times( self, cur, stage ):
+        '''
+        Per-axis times (5 values, 0 for axes not moving) of one stage: a list of 5 gantry
+        setting values (mm, rad) with None for the axes not moved, starting from cur.
+        '''
+        dcounts = np.array( [ 0. if v is None else (v - c) for v, c in zip( stage, cur ) ] ) * counts_per_gset_unit
+        times = self.model.axis_times( dcounts )
+        return np.where( np.abs( dcounts ) > 0.5, times + self.smoothing, 0. )
+
+    def estimate( self, plans, start=None ):
+        '''
+        Estimate a scan.  plans has, for each point, the list of stages moved to get
+        there (see motion_planner.plan); start is the gantry setting the scan starts
+        from (default: the first point, so its move is free).
+
+        Returns a dict with
+          total      = predicted scan time (s), not counting homing
+          moving     = time spent moving (s)
+          stopped    = time spent settling and capturing (s)
+          move_times = predicted move time of each point (s, before move_scale)
+          axis_times = (points,5) time each axis is moving to each point (s, before move_scale)
+          point_times = predicted time of each point (s)
+          utilization = fraction of the total each axis is moving (5 values)
+        '''
+        if start is None:
+            start = first_position( plans ) if len(plans) > 0 else [ 0. ]*5
+        cur = np.array( start, dtype=float )
+        move_times = np.zeros( len(plans) )
+        axis_times = np.zeros( ( len(plans), 5 ) )
+        for n, stages in enumerate( plans ):
+            for stage in stages:
+                times = self.stage_times( cur, stage )
+                move_times[n] += np.max( times )
+                axis_times[n] += times
+                cur = np.array( [ c if v is None else v for v, c in zip( stage, cur ) ] )
+        return self.summarize( move_times, axis_times )
+
+    def summarize( self, move_times, axis_times ):
+        '''
+        Estimate of a scan from the predicted move time of each point and the time each
+        axis moves to each point (see estimate, or the times compiled into a scan_plan).
+        '''
+        move_times = np.asarray( move_times, dtype=float )
+        axis_times = np.asarray( axis_times, dtype=float ).reshape( -1, 5 )
+        busy = np.sum( axis_times, axis=0 )
+        point_times = self.move_scale*move_times + self.point_overhead()
+        total = float( np.sum( point_times ) )
+        return { 'total': total,
+                 'moving': float( self.move_scale*np.sum( move_times ) ),
+                 'stopped': float( len(move_times)*self.point_overhead() ),
+                 'move_times': move_times,
+                 'axis_times': axis_times,
+                 'point_times': point_times,
+                 'utilization': self.move_scale*busy/max( total, 1e-9 ) }
+
+    def calibrate( self, move_times, timings ):
+        '''
+        Fit recorded per-point times (s) as move_scale * move_times + overhead, where
+        move_times are the predicted move times of the same points (estimate()['move_times']).
+        The points must have been recorded with the capture time of this scan_eta.
+        Only as many points as are in both are used.  Returns (move_scale, overhead, rms),
+        overhead including the capture time.
+        '''
+        n = min( len(move_times), len(timings) )
+        if n < 2:
+            raise ValueError('calibrate needs at least 2 recorded points, got '+str(n))
+        m = np.asarray( move_times[:n], dtype=float )
+        t = np.asarray( timings[:n], dtype=float )
+        if np.ptp( m ) > 0.:
+            (scale, overhead), _, _, _ = np.linalg.lstsq( np.column_stack( [ m, np.ones(n) ] ), t, rcond=None )
+        else:
+            scale, overhead = 1.0, float( np.mean( t - m ) )
+        self.move_scale = float( scale )
+        self.overhead = float( overhead ) - self.capture
+        rms = float( np.sqrt( np.mean( ( scale*m + overhead - t )**2 ) ) )
+        return self.move_scale, float( overhead ), rms
+
+    def save( self, fname ):
+        '''Write the calibration to fname, with the capture time of the scan it was made from (not part of overhead)'''
+        with open( fname, 'w' ) as f:
+            json.dump( { 'move_scale': self.move_scale, 'overhead': self.overhead, 'capture': self.capture }, f )
+
+    def load( self, fname ):
+        '''Use the calibration saved in fname, returns False if there is none.'''
+        try:
+            with open( fname, 'r' ) as f:
+                cal = json.load( f )
+        except FileNotFoundError:
+            return False
+        if 'capture' not in cal: # written when the overhead still included the capture time
+            print('Ignoring', fname, ': its overhead includes the capture time of the scan it was made from, recalibrate')
+            return False
+        self.move_scale = cal['move_scale']
+        self.overhead = cal['overhead']
+        return True
+
+
+def first_position( plans ):
+    '''Gantry setting reached at the first point of plans'''
+    cur = [ 0. ]*5
+    for stage in plans[0]:
+        cur = [ c if v is None else v for v, c in zip( stage, cur ) ]
+    return cur
+
+
+def read_time_per_pos( fname ):
+    '''Per-point times (s) from a time_per_pos file: numbers separated by commas'''
+    with open( fname, 'r' ) as f:
+        return [ float(v) for v in f.read().replace( '\n', ',' ).split( ',' ) if v.strip() != '' ]
+
+
+def format_duration( seconds ):
+    h, rem = divmod( int( round( seconds ) ), 3600 )
+    m, s = divmod( rem, 60 )
+    return '%d:%02d:%02d' % (h, m, s)
+
+
+def print_estimate( est ):
+    n = len( est['point_times'] )
+    print('Predicted scan time', format_duration( est['total'] ), '(', round( est['total'], 1 ), 's, plus homing) for', n, 'points')
+    print('  moving', round( est['moving'], 1 ), 's, settling and capturing', round( est['stopped'], 1 ), 's,',
+          round( est['total']/max( n, 1 ), 2 ), 's per point')
+    print('  axis utilization:', ', '.join( name+' '+str( round( 100.*u, 1 ) )+'%' for name, u in zip( axis_names, est['utilization'] ) ))
@@ -0,0 +1,137 @@
+'''
+scan_journal is an append-only record of a scan, so a scan that died part way
+can be resumed from the first point that was not finished.
+
+The journal is a text file with one JSON record per line.  The first record
+holds the plan of the scan (gantry settings and staged moves, in order) and its
+hash; then one record is appended for each completed point with its pose, the
+controller position, the image files and the time.  Each record is flushed and
+fdatasync'ed, one small write per point, so a crash loses at most the point in
+progress.  A torn last line (crash while writing) is ignored when reading.
+
+Usage:
+
+> from scan_journal import scan_journal, plan_hash
+> journal = scan_journal( 'scan_journal.jsonl' )
+> if journal.unfinished():                         # a scan died part way, keep its journal
+>     journal.move_aside()
+> journal.start( gsets, plans )                    # new scan, truncates the file
+> journal.point( n, gsets[n], counts, files )      # after point n is done
+>
+> journal = scan_journal( 'scan_journal.jsonl' )
+> header, points = journal.load()                  # resuming
+> first = journal.first_incomplete()
+'''
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+
+def plan_hash( gsets, plans ):
+    '''Hash of the scan plan: the gantry settings and staged moves, in order'''
+    text = json.dumps( { 'gsets': np.round( np.asarray( gsets, dtype=float ), 6 ).tolist(),
+                         'plans': [ [ [ None if v is None else round( float(v), 6 ) for v in stage ] for stage in stages ]
+                                    for stages in plans ] }, sort_keys=True )
+    return hashlib.sha1( text.encode('ASCII') ).hexdigest()
+
+
+def same_points( gsets1, gsets2 ):
+    '''True if both lists hold the same gantry settings, in any order'''
+    a = np.round( np.asarray( gsets1, dtype=float ), 4 ).reshape( -1, 5 )
+    b = np.round( np.asarray( gsets2, dtype=float ), 4 ).reshape( -1, 5 )
+    if a.shape != b.shape:
+        return False
+    return np.array_equal( a[ np.lexsort( a.T ) ], b[ np.lexsort( b.T ) ] )
+
+
+class scan_journal:
+    def __init__( self, fname ):
+        self.fname = fname
+        self.header = None
+        self.points = {}  # point number -> record
+        self.torn = False # the file ends with a partly written record
+
+    def append( self, record ):
+        with open( self.fname, 'a' ) as f:
+            f.write( ( '\n' if self.torn else '' ) + json.dumps( record ) + '\n' )
+            self.torn = False
+            f.flush()
+            if hasattr( os, 'fdatasync' ):
+                os.fdatasync( f.fileno() )
+            else:
+                os.fsync( f.fileno() )
+
+    def start( self, gsets, plans, **info ):
+        '''Start the journal of a new scan (the file is overwritten). info is stored in the header.'''
+        gsets = np.asarray( gsets, dtype=float ).tolist()
+        self.header = dict( info, type='plan', hash=plan_hash( gsets, plans ), npoints=len(gsets),
+                            gsets=gsets, plans=plans, started=time.time() )
+        self.points = {}
+        self.torn = False
+        open( self.fname, 'w' ).close()
+        self.append( self.header )
+
+    def point( self, n, pose, counts, files=[] ):
+        '''Record that point n is done: pose (gantry setting), counts (controller position), image files'''
+        record = { 'type': 'point', 'n': int(n), 'pose': [ float(v) for v in pose ],
+                   'counts': [ float(v) for v in counts ], 'files': list( files ), 't': time.time() }
+        self.points[int(n)] = record
+        self.append( record )
+
+    def load( self ):
+        '''
+        Read the journal.  Returns (header, points) with points a dict of the
+        completed point records by point number.  Raises ValueError if the
+        journal has no valid header or its plan does not match its hash.
+        '''
+        self.header = None
+        self.points = {}
+        self.torn = False
+        with open( self.fname, 'r' ) as f:
+            for line in f:
+                self.torn = not line.endswith('\n')
+                try:
+                    record = json.loads( line )
+                except ValueError:
+                    continue # torn write of the last record
+                if record.get('type') == 'plan':
+                    self.header = record
+                    self.points = {}
+                elif record.get('type') == 'point' and 'n' in record:
+                    self.points[ record['n'] ] = record
+        if self.header is None:
+            raise ValueError( self.fname + ' has no scan plan' )
+        if plan_hash( self.header['gsets'], self.header['plans'] ) != self.header['hash']:
+            raise ValueError( self.fname + ' scan plan does not match its hash' )
+        return self.header, self.points
+
+    def unfinished( self ):
+        '''True if the file holds a scan with points not done yet'''
+        try:
+            header, points = self.load()
+        except (FileNotFoundError, ValueError):
+            return False
+        return self.first_incomplete() < header['npoints']
+
+    def move_aside( self ):
+        '''Rename the file to <name>_<time it was last written><ext>, returns the new name'''
+        base, ext = os.path.splitext( self.fname )
+        aside = base + time.strftime( '_%Y%m%d-%H%M%S', time.localtime( os.path.getmtime( self.fname ) ) ) + ext
+        os.replace( self.fname, aside )
+        return aside
+
+    def first_incomplete( self ):
+        '''Number of the first point not done, npoints if they all are'''
+        n = 0
+        while n in self.points:
+            n += 1
+        return n
+
+    def last_counts( self, before ):
+        '''Controller position recorded for the last completed point before point number before, or None'''
+        done = [ n for n in self.points if n < before ]
+        if len(done) == 0:
+            return None
+        return self.points[ max(done) ]['counts']
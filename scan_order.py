@@ -0,0 +1,343 @@
+'''
+scan_order finds a fast order to visit the gantry settings of a scan.
+
+All five axes move at the same time, so the time to go from one setting to the
+next is the longest of the per-axis move times, where each axis follows a
+trapezoidal velocity profile with its own speed and acceleration.  The xyz axes
+move at ~1000 counts/s, but phi and theta only at 200-250 counts/s, so the best
+order is often not the one that is shortest in space.
+
+The order is found as an open travelling salesman path: a nearest neighbour
+path, improved by 2-opt (reverse a piece of the path) and Or-opt (move 1-3
+consecutive points somewhere else) moves until no move helps or the time limit
+is reached.  Candidate moves only look at the K nearest points of each point and
+are evaluated with numpy for all points at once, so a few thousand points take
+well under a second.
+
+Usage:
+
+> from scan_order import optimize_scan_order, scan_motion_time
+> order = optimize_scan_order( gsets, start=[0.,0.,0.,0.,0.] )
+> print( scan_motion_time( gsets, start=[0.,0.,0.,0.,0.] ), scan_motion_time( gsets, order, [0.,0.,0.,0.,0.] ) )
+> gsets = [ gsets[i] for i in order ]
+
+Use motion_model( stages=scan_stages ) for moves done as z first, then the other axes.
+'''
+import time
+import numpy as np
+from axis_units import units_per_count
+
+rad2deg = 180.0/np.pi
+
+# Counts per gset unit: gsets are (x,y,z) in mm and (phi,theta) in radians
+counts_per_gset_unit = np.array( [ 1.0/units_per_count[0], 1.0/units_per_count[1], 1.0/units_per_count[2],
+                                   rad2deg/units_per_count[3], rad2deg/units_per_count[4] ] )
+
+# Speeds (counts/s), accelerations and decelerations (counts/s^2) used by scan_spherical.
+# The controller default AC/DC of 256000 is used except where gantrycontrol sets AC.
+scan_speeds = ( 1000., 1000., 1000., 200., 200. )
+scan_accels = ( 256000., 256000., 256000., 2048., 1024. )
+scan_decels = ( 256000., 256000., 256000., 256000., 256000. )
+
+
+# Axes moved together in each stage of a scan_spherical move: first z, then the rest
+scan_stages = ( (2,), (0, 1, 3, 4) )
+
+
+class motion_model:
+    '''
+    Time taken for trapezoidal moves of the five axes.
+
+    A move of d counts with speed sp, acceleration ac and deceleration dc takes
+       sqrt( k*min(d,dfull) ) + max(d-dfull,0)/sp
+    where dfull = sp^2/(2ac) + sp^2/(2dc) is the distance needed to reach full
+    speed and k = 2(ac+dc)/(ac*dc).  Below dfull the profile is a triangle.
+
+    stages lists the groups of axes that are moved one after the other; the axes
+    within a stage move at the same time, so a stage takes as long as its slowest
+    axis.  The default is a single simultaneous move of all five axes.
+    '''
+    def __init__( self, speeds=scan_speeds, accels=scan_accels, decels=scan_decels, stages=( (0, 1, 2, 3, 4), ) ):
+        sp = np.array( speeds, dtype=float )
+        ac = np.array( accels, dtype=float )
+        dc = np.array( decels, dtype=float )
+        self.sp = sp
+        self.ac = ac
+        self.dc = dc
+        self.dfull = sp*sp/(2*ac) + sp*sp/(2*dc)
+        self.k = 2*(ac+dc)/(ac*dc)
+        self.stages = stages
+
+    def axis_times( self, dcounts ):
+        '''
+        Per-axis move times for an array of count distances with last dimension 5.
+        '''
+        d = np.abs( dcounts )
+        return np.sqrt( self.k*np.minimum( d, self.dfull ) ) + np.maximum( d-self.dfull, 0. )/self.sp
+
+    def covered( self, dcounts, t ):
+        '''
+        Signed distance covered by each axis t seconds after the start of a move of
+        dcounts (5 values, axes all starting together).  t is an array of times,
+        the result has shape (len(t),5).
+        '''
+        d = np.abs( np.asarray( dcounts, dtype=float ) )
+        vpeak = np.where( d >= self.dfull, self.sp, np.sqrt( 2*d*self.ac*self.dc/(self.ac+self.dc) ) )
+        ta = vpeak/self.ac
+        tc = np.maximum( d-self.dfull, 0. )/self.sp
+        td = vpeak/self.dc
+        t = np.asarray( t, dtype=float )[:,None]
+        tacc = np.minimum( t, ta )
+        tcru = np.clip( t-ta, 0., tc )
+        tdec = np.clip( t-ta-tc, 0., td )
+        s = 0.5*self.ac*tacc*tacc + vpeak*tcru + vpeak*tdec - 0.5*self.dc*tdec*tdec
+        return np.sign( dcounts ) * np.minimum( s, d )
+
+    def move_time( self, counts1, counts2 ):
+        '''
+        Time to move between positions counts1 and counts2 (arrays with last dimension 5).
+        '''
+        total = 0.
+        for stage in self.stages:
+            t = 0.
+            for k in stage:
+                # one axis at a time is much faster in numpy than reducing over the short last axis
+                d = np.abs( counts2[...,k] - counts1[...,k] )
+                t = np.maximum( t, np.sqrt( self.k[k]*np.minimum( d, self.dfull[k] ) ) + np.maximum( d-self.dfull[k], 0. )/self.sp[k] )
+            total = total + t
+        return total
+
+
+def scan_motion_time( gsets, order=None, start=None, model=None ):
+    '''
+    Predicted total motion time (s) to visit gsets in the given order
+    (default: as listed), starting from gantry setting start if given.
+    '''
+    if model is None:
+        model = motion_model()
+    pts = np.array( gsets, dtype=float ) * counts_per_gset_unit
+    if order is not None:
+        pts = pts[ np.asarray(order) ]
+    if start is not None:
+        pts = np.vstack( [ np.array(start, dtype=float) * counts_per_gset_unit, pts ] )
+    return float( np.sum( model.move_time( pts[:-1], pts[1:] ) ) )
+
+
+class _path:
+    '''
+    Open path through the scan points used by optimize_scan_order.
+
+    Node 0 is the start and node n+1 is a free end, both are kept in place.
+    Nodes 1..n are the scan points.  Moves to or from a free node cost nothing.
+    '''
+    def __init__( self, pts, start, model, nneighbours ):
+        n = len(pts)
+        self.n = n
+        self.model = model
+        self.nodes = np.zeros( (n+2, 5) )
+        self.nodes[1:n+1] = pts
+        self.free = np.zeros( n+2, dtype=bool )
+        self.free[n+1] = True
+        if start is None:
+            self.free[0] = True
+        else:
+            self.nodes[0] = start
+        self._find_neighbours( min( nneighbours, n-1 ) )
+
+    def cost( self, a, b ):
+        '''Move time between node (arrays) a and b'''
+        t = self.model.move_time( self.nodes[a], self.nodes[b] )
+        return np.where( self.free[a] | self.free[b], 0., t )
+
+    def _find_neighbours( self, k ):
+        '''
+        K nearest scan points (in move time) of the start and of every scan point.
+        2K candidates are picked with the cruise-time distance max(|d|/sp), which is
+        cheap to compute for all pairs, then sorted by the true move time.
+        '''
+        n = self.n
+        self.nbr = np.zeros( (n+1, max(k,0)), dtype=int )
+        self.nbr_cost = np.zeros( (n+1, max(k,0)) )
+        if k <= 0:
+            return
+        kc = min( 2*k, n-1 )
+        cruise = ( self.nodes[:n+1] / self.model.sp ).astype( np.float32 )
+        targets = np.arange( 1, n+1 )
+        block = max( 1, 4000000 // (5*n) )
+        for first in range( 0, n+1, block ):
+            rows = np.arange( first, min(first+block, n+1) )
+            d = np.abs( cruise[rows,None,0] - cruise[None,1:,0] )
+            for j in range( 1, 5 ):
+                np.maximum( d, np.abs( cruise[rows,None,j] - cruise[None,1:,j] ), out=d )
+            d[ rows[:,None] == targets[None,:] ] = np.inf
+            cand = targets[ np.argpartition( d, kc-1, axis=1 )[:, :kc] ]
+            c = self.cost( np.repeat( rows[:,None], kc, axis=1 ), cand )
+            srt = np.argsort( c, axis=1 )[:, :k]
+            self.nbr[rows] = np.take_along_axis( cand, srt, axis=1 )
+            self.nbr_cost[rows] = np.take_along_axis( c, srt, axis=1 )
+
+    def nearest_neighbour( self ):
+        '''Build the route by always moving to the closest unvisited point'''
+        n = self.n
+        visited = np.zeros( n+2, dtype=bool )
+        visited[0] = True
+        visited[n+1] = True
+        route = [0]
+        cur = 0
+        unvisited = np.arange( 1, n+1 )
+        for step in range( n ):
+            nxt = -1
+            for c in self.nbr[cur]:
+                if not visited[c]:
+                    nxt = c
+                    break
+            if nxt < 0:
+                unvisited = unvisited[ ~visited[unvisited] ]
+                nxt = unvisited[ np.argmin( self.cost( np.full( len(unvisited), cur ), unvisited ) ) ]
+            visited[nxt] = True
+            route.append( nxt )
+            cur = nxt
+        route.append( n+1 )
+        self.set_route( np.array( route ) )
+
+    def set_route( self, route ):
+        self.route = route
+        self.pos = np.empty( len(route), dtype=int )
+        self.pos[route] = np.arange( len(route) )
+        self.edge = self.cost( route[:-1], route[1:] )
+
+    def total( self ):
+        return float( np.sum( self.edge ) )
+
+    def two_opt( self ):
+        '''
+        One round of 2-opt.  Removing the edges at positions x<y and reversing
+        route[x+1..y] adds the edges (route[x],route[y]) and (route[x+1],route[y+1]).
+        Candidates make a point adjacent to one of its neighbours.  All the improving,
+        non-overlapping moves found are applied.  Returns the time saved.
+        '''
+        r = self.route
+        a = np.arange( 1, self.n+1 )
+        i = np.repeat( self.pos[a], self.nbr.shape[1] )
+        j = self.pos[ self.nbr[a].ravel() ]
+        # (a,next) with (c,next) and (prev,a) with (prev,c)
+        x = np.concatenate( [ np.minimum(i,j), np.minimum(i,j)-1 ] )
+        y = np.concatenate( [ np.maximum(i,j), np.maximum(i,j)-1 ] )
+        ok = (x >= 0) & (y > x+1) & (y <= len(r)-2)
+        x = x[ok]
+        y = y[ok]
+        gain = self.edge[x] + self.edge[y] - self.cost( r[x], r[y] ) - self.cost( r[x+1], r[y+1] )
+        return self._apply_reversals( x, y, gain )
+
+    def _apply_reversals( self, x, y, gain ):
+        better = gain > 1e-9
+        x = x[better]
+        y = y[better]
+        gain = gain[better]
+        if len(gain) == 0:
+            return 0.
+        used = np.zeros( len(self.route), dtype=bool )
+        r = self.route.copy()
+        saved = 0.
+        for m in np.argsort( -gain ):
+            if used[ x[m]:y[m]+2 ].any():
+                continue
+            used[ x[m]:y[m]+2 ] = True
+            r[ x[m]+1:y[m]+1 ] = r[ x[m]+1:y[m]+1 ][::-1]
+            saved += gain[m]
+        self.set_route( r )
+        return saved
+
+    def or_opt( self ):
+        '''
+        One round of Or-opt: move a run of 1-3 consecutive points next to a
+        neighbour of its first point, possibly reversed.  All the improving moves
+        that touch different parts of the route are applied.  Returns the time saved.
+        '''
+        r = self.route
+        m = len(r)
+        k = self.nbr.shape[1]
+        moves = []
+        for length in (1, 2, 3):
+            s = np.arange( 1, m-1-length+1 )
+            if len(s) == 0:
+                continue
+            e = s + length - 1
+            removed = self.edge[s-1] + self.edge[e] - self.cost( r[s-1], r[e+1] )
+            c = self.nbr[ r[s] ].ravel()
+            cc = self.nbr_cost[ r[s] ].ravel()
+            ls = np.repeat( r[e], k )
+            ss = np.repeat( s, k )
+            es = np.repeat( e, k )
+            rem = np.repeat( removed, k )
+            for after in (True, False):
+                # insert between route[q] and route[q+1], with c at q (c-f..l-next) or at q+1 (prev-l..f-c)
+                q = self.pos[c] if after else self.pos[c]-1
+                ok = (q >= 0) & (q <= m-2) & ( (q < ss-1) | (q > es) )
+                q = q[ok]
+                if after:
+                    add = cc[ok] + self.cost( ls[ok], r[q+1] ) - self.edge[q]
+                else:
+                    add = self.cost( r[q], ls[ok] ) + cc[ok] - self.edge[q]
+                gain = rem[ok] - add
+                better = gain > 1e-9
+                moves.append( ( gain[better], ss[ok][better], es[ok][better], q[better], np.full( np.sum(better), after ) ) )
+        gain, s, e, q, after = [ np.concatenate( v ) for v in zip( *moves ) ]
+        if len(gain) == 0:
+            return 0.
+        used = np.zeros( m, dtype=bool )
+        cut = np.zeros( m, dtype=bool )
+        inserts = {}
+        saved = 0.
+        for i in np.argsort( -gain ):
+            if used[ s[i]-1:e[i]+2 ].any() or used[ q[i]:q[i]+2 ].any():
+                continue
+            used[ s[i]-1:e[i]+2 ] = True
+            used[ q[i]:q[i]+2 ] = True
+            cut[ s[i]:e[i]+1 ] = True
+            inserts[ q[i] ] = r[ s[i]:e[i]+1 ] if after[i] else r[ s[i]:e[i]+1 ][::-1]
+            saved += gain[i]
+        route = []
+        for p in range( m ):
+            if not cut[p]:
+                route.append( r[p] )
+            if p in inserts:
+                route.extend( inserts[p] )
+        self.set_route( np.array( route ) )
+        return saved
+
+
+def optimize_scan_order( gsets, start=None, model=None, nneighbours=10, time_limit=1.0 ):
+    '''
+    Reorder gantry settings to minimize the total move time of a scan.
+
+    Inputs:
+    gsets       = list of gantry settings (xg,yg,zg,phig,thetag) in mm and rad, as
+                  returned by get_gantry_settings
+    start       = gantry setting the scan starts from, eg. the home position
+                  (default: free to start at any point)
+    model       = motion_model with the speeds/accelerations used (default: scan_spherical ones)
+    nneighbours = number of closest points considered for each improvement move
+    time_limit  = stop improving after this many seconds
+
+    Returns:
+    order = list of indices into gsets in the order to visit them
+    '''
+    t0 = time.perf_counter()
+    if model is None:
+        model = motion_model()
+    pts = np.array( gsets, dtype=float ).reshape( -1, 5 ) * counts_per_gset_unit
+    if len(pts) < 2:
+        return list( range( len(pts) ) )
+    if start is not None:
+        start = np.array( start, dtype=float ) * counts_per_gset_unit
+    path = _path( pts, start, model, nneighbours )
+    path.nearest_neighbour()
+    improved = True
+    while improved and time.perf_counter() - t0 < time_limit:
+        improved = False
+        while path.two_opt() > 0. and time.perf_counter() - t0 < time_limit:
+            improved = True
+        while path.or_opt() > 0. and time.perf_counter() - t0 < time_limit:
+            improved = True
+    return [ int(i)-1 for i in path.route[1:-1] ]
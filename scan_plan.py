@@ -0,0 +1,184 @@
+'''
+scan_plan is the compiled form of a scan: everything scan_spherical.py works
+out before the gantry moves, in one versioned .npz file.
+
+Making a scan means parsing the parameter file, generating the scan points and
+their gantry settings, optionally ordering them (time limited, so not exactly
+repeatable) and planning the moves around the keep-out volumes.  The compiled
+plan keeps the result: for each point the gantry setting, the target position
+and normal, the staged moves (mm, rad, and controller counts), the axis speeds,
+a label and the predicted move times (see scan_eta).  It is keyed by a hash of the parameter file, the axis calibration
+the gantry converts with, the planning options and the source of the code that
+makes the plan, so it is reused only while all of them are unchanged.
+
+The scan, dry runs, the scan time prediction and the range check then all use
+the exact same plan, loaded in milliseconds, and the counts of the range check
+and the scan table are those of the plan.
+
+Usage:
+
+> from scan_plan import scan_plan, plan_key, load_plan
+> key = plan_key( 'parameters_sphere.txt', 'axis_calibration.json', optimize_order=True, plan_moves=True )
+> est = scan_eta().estimate( plans, start=home )
+> plan = scan_plan( gsets, tls, plans, (1000,1000,1000,200,200), gantry_units, key, est['move_times'], est['axis_times'] )
+> plan.save( 'scan_plans/scan_plan_'+key[:16]+'.npz' )
+> plan = load_plan( 'scan_plans/scan_plan_'+key[:16]+'.npz' )
+> plan.plans()        # staged moves as made by motion_planner.plan_scan, None for axes not moved
+> plan.counts[n]      # (stages,5) counts of the moves to point n, NaN for axes not moved
+> plan.stage_counts( first )   # counts of all the moves from point first on, for gantrycontrol.check_counts
+'''
+import hashlib
+import json
+import os
+import numpy as np
+from axis_units import axis_units, default_calibration
+
+# Version of the file layout, plans of other versions are not loaded
+plan_version = 3
+
+# Code that makes the plan, its source is part of the key
+plan_sources = ( 'scan_spherical.py', 'gantry_spherical_scan.py', 'scan_order.py', 'motion_planner.py', 'axis_units.py',
+                 'scan_eta.py', 'scan_plan.py' )
+
+rad2deg = 180.0/np.pi
+
+
+def file_digest( fname ):
+    '''sha1 of the contents of fname, empty if there is no such file'''
+    try:
+        with open( fname, 'rb' ) as f:
+            return hashlib.sha1( f.read() ).hexdigest()
+    except FileNotFoundError:
+        return ''
+
+
+def plan_key( param_file, calibration=default_calibration, **options ):
+    '''
+    Hash identifying a plan: the parameter file and axis calibration contents
+    (calibration is the file the gantry converts with, see gantrycontrol),
+    the planning options and the source of plan_sources.
+    '''
+    here = os.path.dirname( os.path.abspath( __file__ ) )
+    text = json.dumps( { 'version': plan_version, 'options': options,
+                         'param_file': file_digest( param_file ), 'calibration': file_digest( calibration ),
+                         'code': [ file_digest( os.path.join( here, src ) ) for src in plan_sources ] },
+                       sort_keys=True )
+    return hashlib.sha1( text.encode('ASCII') ).hexdigest()
+
+
+def calibrated_units( calibration=default_calibration ):
+    '''axis_units with the calibration tables in calibration (nominal if there is no such file)'''
+    units = axis_units()
+    units.load( calibration )
+    return units
+
+
+def point_label( gset ):
+    '''Pose part of the image names of a point: z, y and x of the gantry setting'''
+    x, y, z = gset[0], gset[1], gset[2]
+    return 'z'+str(round(z,1))+'_y'+str(round(y,1))+'_x'+str(round(x,1))
+
+
+def stage_units( stages ):
+    '''Staged moves (...,5) from gantry setting units (mm, rad) to gantrycontrol.move units (mm, degrees)'''
+    units = np.array( stages, dtype=float )
+    units[...,3] *= rad2deg
+    units[...,4] *= -rad2deg
+    return units
+
+
+def setting_units( poses ):
+    '''Poses (...,5) from gantrycontrol.move units (mm, degrees) to gantry setting units (mm, rad), see stage_units'''
+    units = np.array( poses, dtype=float )
+    units[...,3] /= rad2deg
+    units[...,4] /= -rad2deg
+    return units
+
+
+def below_home( gsets, units=None ):
+    '''Indices of the gantry settings (mm, rad) with x, y or z below home, where the counts are negative'''
+    if len(gsets) == 0:
+        return np.zeros( 0, dtype=int )
+    if units is None:
+        units = calibrated_units()
+    counts = units.to_counts( stage_units( gsets ) )
+    return np.nonzero( ( counts[:,:3] < 0 ).any( axis=1 ) )[0]
+
+
+class scan_plan:
+    '''
+    Compiled scan of N points, at most S stages per point.
+
+    gsets      = (N,5) gantry settings (mm, rad)
+    tls        = (N,6) target positions and normals (mm)
+    stages     = (N,S,5) staged moves (mm, rad), NaN for axes not moved and unused stages
+    nstages    = (N,) number of stages of each point
+    counts     = (N,S,5) controller counts of the stages, NaN like stages
+    speeds     = (N,5) speed of each axis (counts/s) for the moves to each point
+    labels     = (N,) pose part of the image names
+    move_times = (N,) predicted move time of each point (s, uncalibrated, see scan_eta.summarize)
+    axis_times = (N,5) predicted time each axis moves to each point (s, uncalibrated)
+    key        = plan_key the plan was made for
+
+    units converts the stages to counts and must be those of the gantry (gantry.units,
+    or calibrated_units of its calibration file), default: calibrated_units().
+    '''
+    def __init__( self, gsets, tls, plans, speeds, units=None, key='', move_times=None, axis_times=None ):
+        self.gsets = np.asarray( gsets, dtype=float ).reshape( -1, 5 )
+        self.tls = np.asarray( tls, dtype=float ).reshape( -1, 6 )
+        n = len(self.gsets)
+        self.nstages = np.array( [ len(stages) for stages in plans ], dtype=np.int32 )
+        self.stages = np.full( ( n, max( self.nstages, default=1 ), 5 ), np.nan )
+        for i, stages in enumerate( plans ):
+            for k, stage in enumerate( stages ):
+                self.stages[i,k] = [ np.nan if v is None else v for v in stage ]
+        if units is None:
+            units = calibrated_units()
+        self.counts = units.to_counts( stage_units( self.stages ) )
+        self.speeds = np.broadcast_to( np.asarray( speeds, dtype=np.int32 ), ( n, 5 ) ).copy()
+        self.labels = np.array( [ point_label( gset ) for gset in self.gsets ] )
+        self.move_times = np.zeros( n ) if move_times is None else np.asarray( move_times, dtype=float )
+        self.axis_times = np.zeros( ( n, 5 ) ) if axis_times is None else np.asarray( axis_times, dtype=float ).reshape( n, 5 )
+        self.key = key
+
+    def __len__( self ):
+        return len(self.gsets)
+
+    def plans( self ):
+        '''Staged moves of each point as lists, None for axes not moved (like motion_planner.plan_scan)'''
+        return [ [ [ None if np.isnan(v) else float(v) for v in self.stages[i,k] ] for k in range( self.nstages[i] ) ]
+                 for i in range( len(self.gsets) ) ]
+
+    def stage_counts( self, first=0 ):
+        '''(stages,5) counts of the moves to points first.. in order, NaN for axes not moved'''
+        return np.concatenate( [ np.zeros( ( 0, 5 ) ) ] +
+                               [ self.counts[i,:self.nstages[i]] for i in range( first, len(self.gsets) ) ] )
+
+    def save( self, fname ):
+        '''Write the plan to fname (.npz), replacing it in one step'''
+        folder = os.path.dirname( fname )
+        if folder != '':
+            os.makedirs( folder, exist_ok=True )
+        tmp = fname + '.tmp'
+        with open( tmp, 'wb' ) as f:
+            np.savez( f, version=plan_version, key=self.key, gsets=self.gsets, tls=self.tls, stages=self.stages,
+                      nstages=self.nstages, counts=self.counts, speeds=self.speeds, labels=self.labels,
+                      move_times=self.move_times, axis_times=self.axis_times )
+        os.replace( tmp, fname )
+
+
+def load_plan( fname, key=None ):
+    '''
+    Read the plan saved in fname.  Raises ValueError if it was written by another
+    version, or is not the plan of key (when given).
+    '''
+    with np.load( fname ) as f:
+        if int( f['version'] ) != plan_version:
+            raise ValueError( fname + ' is a version ' + str( int( f['version'] ) ) + ' plan, expected ' + str(plan_version) )
+        if key is not None and str( f['key'] ) != key:
+            raise ValueError( fname + ' is the plan of another scan' )
+        plan = scan_plan.__new__( scan_plan )
+        for name in ( 'gsets', 'tls', 'stages', 'nstages', 'counts', 'speeds', 'labels', 'move_times', 'axis_times' ):
+            setattr( plan, name, f[name] )
+        plan.key = str( f['key'] )
+    return plan
@@ -12,12 +12,23 @@ from datetime import datetime
 import gantrycontrol as gc
 from gantry_spherical_scan import camera
 from gantry_spherical_scan import get_gantry_settings
+from scan_order import optimize_scan_order, scan_motion_time, motion_model, scan_stages, scan_speeds
+from motion_planner import keepout, motion_planner, PlanningError
+from scan_eta import scan_eta, read_time_per_pos, print_estimate
+from scan_journal import scan_journal, plan_hash, same_points
+from scan_plan import scan_plan, plan_key, load_plan, point_label, setting_units, below_home, calibrated_units
+from image_manifest import image_manifest
+from image_qa import image_qa
 import pgcamera2 as pg
+import camera_workers
+import tracing
 import time
 import subprocess
 import numpy as np
 import argparse
+import os
 import sys
+import tempfile
 import matplotlib.pyplot as plt
 
 deg2rad   = np.pi/180.0
@@ -35,6 +46,10 @@ class Parameters:
     phimax    = 80.0 * deg2rad
     thetamin  = 20.0 * deg2rad
     thetamax  = 85.0 * deg2rad
+    keepout_radius = 250.0 # mm
+    target_radius  = 100.0 # mm
+    tank_min  = None # mm
+    tank_max  = None # mm
     '''
     def __init__(self,filename="parameters_sphere.txt"):
         self.Nscan     = 200
@@ -45,6 +60,10 @@ class Parameters:
         self.phimax    = 70.0 * deg2rad
         self.thetamin  = 20.0 * deg2rad
         self.thetamax  = 85.0 * deg2rad
+        self.keepout_radius = 250.0 # mm around the camera
+        self.target_radius  = 100.0 # mm
+        self.tank_min  = None
+        self.tank_max  = None
 
         self.load_parameters(filename)
         self.print_parameters()
@@ -83,6 +102,18 @@ class Parameters:
                     elif name=="Rscan":
                         val=line.split('=')[1].split('#')[0]
                         self.Rscan = float(val)
+                    elif name=="keepout_radius":
+                        val=line.split('=')[1].split('#')[0]
+                        self.keepout_radius = float(val)
+                    elif name=="target_radius":
+                        val=line.split('=')[1].split('#')[0]
+                        self.target_radius = float(val)
+                    elif name=="tank_min":
+                        val=line.split('=')[1].split('#')[0].split(',')
+                        self.tank_min=np.array([float(i) for i in val])
+                    elif name=="tank_max":
+                        val=line.split('=')[1].split('#')[0].split(',')
+                        self.tank_max=np.array([float(i) for i in val])
                 print(first_char)
             f.close()
         except FileNotFoundError:
@@ -100,6 +131,21 @@ class Parameters:
         print('phimax   =',rad2deg*self.phimax,'deg')
         print('thetamin =',rad2deg*self.thetamin,'deg')
         print('thetamax =',rad2deg*self.thetamax,'deg')
+        print('keepout_radius =',self.keepout_radius,'mm')
+        print('target_radius  =',self.target_radius,'mm')
+        print('tank_min =',self.tank_min,'mm')
+        print('tank_max =',self.tank_max,'mm')
+
+    def get_keepout(self):
+        '''
+        Keep-out volumes for the motion planner: a sphere around the camera,
+        and the tank walls if tank_min and tank_max are given.
+        '''
+        tank = None
+        if self.tank_min is not None and self.tank_max is not None:
+            tank = list(self.tank_min) + list(self.tank_max)
+        sphere = list(self.campos) + [self.keepout_radius]
+        return keepout( spheres=[sphere], tank=tank, target_radius=self.target_radius )
 
 
 def plot_scan( c1, gsets, tls, label ):
@@ -142,6 +188,48 @@ def plot_scan( c1, gsets, tls, label ):
     print('min Gz=',np.min(GZ),' max Gz=',np.max(GZ))
         
 
+def make_plan( param, cam, optimize_order, plan_moves, home, units, key='', drop_below_home=False ):
+    '''
+    Scan points, gantry settings, order and staged moves of the scan of param,
+    compiled into a scan_plan with the axis_units of the gantry.  With drop_below_home
+    the points with x, y or z below home (out of the range of the gantry) are left
+    out, with a warning.
+    '''
+    scanpts = cam.get_scanpoints( param.Nscan, param.Rscan, param.phimin, param.phimax, param.thetamin, param.thetamax  )
+    gsets, tls = get_gantry_settings( cam, scanpts )
+    below = below_home( gsets, units ) if drop_below_home else []
+    if len(below) > 0:
+        print('Warning: dropping', len(below), 'of', len(gsets), 'scan points below home, first:',
+              '; '.join( point_label( gsets[i] ) for i in below[:5] ))
+        keep = [ i for i in range( len(gsets) ) if i not in set( below ) ]
+        gsets = [ gsets[i] for i in keep ]
+        tls = [ tls[i] for i in keep ]
+    if optimize_order:
+        if plan_moves:
+            model = motion_model() # all axes at once
+        else:
+            model = motion_model( stages=scan_stages ) # z is moved first, then the other axes
+        order = optimize_scan_order( gsets, start=home, model=model )
+        t_before = scan_motion_time( gsets, start=home, model=model )
+        t_after = scan_motion_time( gsets, order, start=home, model=model )
+        gsets = [ gsets[i] for i in order ]
+        tls = [ tls[i] for i in order ]
+        print('Optimized scan order: predicted move time', round(t_before,1), 's ->', round(t_after,1),
+              's, saves', round(t_before-t_after,1), 's')
+
+    if plan_moves:
+        plans = motion_planner( param.get_keepout() ).plan_scan( gsets, home )
+    else:
+        plans = [ [ [None, None, gset[2], None, None], [gset[0], gset[1], None, gset[3], gset[4]] ] for gset in gsets ]
+    return compile_plan( gsets, tls, plans, home, units, key )
+
+
+def compile_plan( gsets, tls, plans, home, units, key ):
+    '''scan_plan of the staged moves plans, with the move times predicted from home by scan_eta'''
+    est = scan_eta().estimate( plans, start=home )
+    return scan_plan( gsets, tls, plans, scan_speeds, units, key, est['move_times'], est['axis_times'] )
+
+
 def main():
     parser = argparse.ArgumentParser( description='scan_spherical options' )
     parser.add_argument('-p','--param_file',default='parameters_sphere.txt', help='Parameter file')
@@ -153,14 +241,116 @@ def main():
     parser.add_argument('--rayfin',default=True,help='Rayfin camera only',action='store_true')
     parser.add_argument('--no-rayfin',dest='rayfin',action='store_false')
     parser.set_defaults(rayfin=False)
+    parser.add_argument('--emulate',help='Run against the local controller emulator instead of the gantry',action='store_true')
+    parser.add_argument('--time-warp',dest='time_warp',default=100.0,help='Emulator speed up factor (with --emulate)',type=float)
+    parser.add_argument('--min-rate',dest='min_rate',default=0.0,help='Exit with an error if fewer points/hour than this are achieved',type=float)
+    parser.add_argument('--optimize-order',dest='optimize_order',help='Reorder scan points to minimize move time',action='store_true')
+    parser.add_argument('--plan-moves',dest='plan_moves',help='Move all axes at once when the path is clear of the keep-out volumes',action='store_true')
+    parser.add_argument('--no-plan-moves',dest='plan_moves',help='Always move z first, then the other axes',action='store_false')
+    parser.set_defaults(plan_moves=True)
+    parser.add_argument('--table',help='Download the scan to the controller and run it there, the host only takes the images',action='store_true')
+    parser.add_argument('--defer-download',dest='defer_download',help='Only trigger the cameras at each point, download the images in the background while moving',action='store_true')
+    parser.add_argument('--camera-backend',dest='camera_backend',default='gphoto2',choices=sorted(camera_workers.backends),help='gphoto2 runs gphoto2 for each image, the others keep a session open per camera')
+    parser.add_argument('--max-pending',dest='max_pending',default=20,help='Most images left on a camera waiting for download (with --defer-download)',type=int)
+    parser.add_argument('--eta-settle-time',dest='eta_settle_time',default=0.1,help='Settle time per point assumed by the predicted scan time (s), the gantry itself settles on TE/TV (see gantrycontrol.wait_settled)',type=float)
+    parser.add_argument('--capture-time',dest='capture_time',default=None,help='Capture time per point used for the predicted scan time (s), default 5 with cameras, 0 without',type=float)
+    parser.add_argument('--eta-calibration',dest='eta_calibration',default='scan_eta_calibration.json',help='File with the calibration of the predicted scan time')
+    parser.add_argument('--calibrate-eta',dest='calibrate_eta',default='',help='time_per_pos file recorded for this scan to calibrate the predicted scan time from')
+    parser.add_argument('--fast-home',dest='fast_home',help='Home with the fast approach and slow re-approach run on the controller',action='store_true')
+    parser.add_argument('--home-index',dest='home_index',help='With --fast-home, finish homing on the encoder index',action='store_true')
+    parser.add_argument('--trust-position',dest='trust_position',help='Skip searching for the limit switches if the saved position agrees with the controller and the switches',action='store_true')
+    parser.add_argument('--telemetry',default=0.,help='Stream the controller data records every this many ms and wait for the motion and settling with them (0: poll with commands)',type=float)
+    parser.add_argument('--telemetry-spill',dest='telemetry_spill',default='',help='File to keep all the data records of the scan in (see telemetry.read_spill)')
+    parser.add_argument('--trace',default='',help='Record tracing spans and write them to this Chrome trace JSON file (and a .csv summary)')
+    parser.add_argument('--journal',default='',help='Journal of the completed points, default scan_journal[_label].jsonl')
+    parser.add_argument('--resume',help='Continue the scan in the journal from its first incomplete point',action='store_true')
+    parser.add_argument('--new-scan',dest='new_scan',help='Start over even if the journal holds an unfinished scan (its journal is moved aside)',action='store_true')
+    parser.add_argument('--manifest',default='image_manifest.db',help='SQLite manifest the images are recorded in (empty: none)')
+    parser.add_argument('--qa',help='Check each image in the background, retake the failed ones at the point and revisit the points still failing at the end',action='store_true')
+    parser.add_argument('--qa-min-sharpness',dest='qa_min_sharpness',default=20.,help='Least variance of the Laplacian of a good image (see image_qa.py)',type=float)
+    parser.add_argument('--qa-max-clipped',dest='qa_max_clipped',default=0.02,help='Largest fraction of saturated pixels of a good image',type=float)
+    parser.add_argument('--qa-checkerboard',dest='qa_checkerboard',default='',help='Inner corners COLSxROWS of the checkerboard that must be in the images, empty to not look for it')
+    parser.add_argument('--qa-wait',dest='qa_wait',default=1.0,help='Seconds to wait at a point for the image checks before moving on',type=float)
+    parser.add_argument('--qa-retakes',dest='qa_retakes',default=1,help='Retakes at the point of the images failing the checks',type=int)
+    parser.add_argument('--drop-below-home',dest='drop_below_home',help='Leave out the scan points below home (out of the range of the gantry) with a warning, instead of refusing the scan',action='store_true')
+    parser.add_argument('--calibration',default='axis_calibration.json',help='Axis calibration tables of the gantry (see axis_units.py), used if the file exists')
+    parser.add_argument('--plan-cache',dest='plan_cache',default='scan_plans',help='Folder of the compiled scan plans, reused while the parameters, calibration and code are unchanged (empty: always plan)')
+    parser.add_argument('--time-per-pos',dest='time_per_pos',default='',help='Write the time taken at each point to this file (for --calibrate-eta)')
     
     args = parser.parse_args()
     print(args)
+    if args.trace != '':
+        tracing.enable()
     param  = Parameters( args.param_file )
-    gantry = gc.gantrycontrol()
     cam    = camera( param.campos, param.camfacing )
-    scanpts = cam.get_scanpoints( param.Nscan, param.Rscan, param.phimin, param.phimax, param.thetamin, param.thetamax  )
-    gsets, tls = get_gantry_settings( cam, scanpts )
+    home = [0.0, 0.0, 0.0, 0.0, 0.0]
+    units = calibrated_units( args.calibration )
+    key = plan_key( args.param_file, args.calibration, optimize_order=args.optimize_order, plan_moves=args.plan_moves, drop_below_home=args.drop_below_home )
+    plan_file = os.path.join( args.plan_cache, 'scan_plan_'+key[:16]+'.npz' ) if args.plan_cache != '' else ''
+    plan = None
+    if plan_file != '' and os.path.exists( plan_file ):
+        try:
+            plan = load_plan( plan_file, key )
+            print('Using the compiled scan plan', plan_file)
+        except ValueError as e:
+            print('Planning the scan again:', e)
+    if plan is None:
+        try:
+            with tracing.span( 'plan', 'scan' ):
+                plan = make_plan( param, cam, args.optimize_order, args.plan_moves, home, units, key, args.drop_below_home )
+        except PlanningError as e:
+            print('The scan can not be planned:', e)
+            return 1
+        if plan_file != '':
+            plan.save( plan_file )
+            print('Compiled scan plan written to', plan_file)
+    gsets = plan.gsets.tolist()
+    tls = plan.tls.tolist()
+    plans = plan.plans()
+    nsingle = int( np.sum( plan.nstages == 1 ) )
+    print('Planned moves:', nsingle, 'of', len(plans), 'points in a single move')
+
+    journal = scan_journal( args.journal if args.journal != '' else 'scan_journal'+('_'+args.label if args.label != '' else '')+'.jsonl' )
+    first = 0 # first point to scan
+    scan_id = time.strftime('%Y%m%d-%H%M%S') + ('_'+args.label if args.label != '' else '')
+    if args.resume:
+        try:
+            header, done = journal.load()
+        except (FileNotFoundError, ValueError) as e:
+            print('Nothing to resume in journal', journal.fname, ':', e)
+            return 1
+        scan_id = header.get( 'scan_id', scan_id )
+        if plan_hash( gsets, plans ) != header['hash']:
+            if not same_points( gsets, header['gsets'] ):
+                print('Journal', journal.fname, 'is for a different scan, can not resume')
+                return 1
+            print('Using the scan order and moves planned in', journal.fname)
+            tl_of = { tuple( np.round( gset, 4 ) ): tl for gset, tl in zip( gsets, tls ) }
+            gsets = header['gsets']
+            plans = header['plans']
+            tls = [ tl_of[ tuple( np.round( gset, 4 ) ) ] for gset in gsets ]
+            plan = compile_plan( gsets, tls, plans, home, units, key )
+        first = journal.first_incomplete()
+        print('Resuming at point', first, 'of', len(gsets))
+        if first >= len(gsets):
+            print('All points are done')
+            return 0
+
+    cameras = args.camera[0] if len(args.camera) > 0 else []
+    capture_time = args.capture_time
+    if capture_time is None:
+        capture_time = 5.0 if len(cameras) > 0 or args.rayfin else 0.0
+    eta = scan_eta( settle=args.eta_settle_time, capture=capture_time )
+    if eta.load( args.eta_calibration ):
+        print('Predicted scan time calibration from', args.eta_calibration)
+    est = eta.summarize( plan.move_times[first:], plan.axis_times[first:] )
+    if args.calibrate_eta != '':
+        scale, overhead, rms = eta.calibrate( est['move_times'], read_time_per_pos( args.calibrate_eta ) )
+        print('Calibrated predicted scan time from', args.calibrate_eta, ': move time x', round(scale,3), '+',
+              round(overhead,2), 's per point, rms error', round(rms,2), 's')
+        eta.save( args.eta_calibration )
+        est = eta.summarize( plan.move_times[first:], plan.axis_times[first:] )
+    print_estimate( est )
 
 
     print('Rayfin=',args.rayfin)
@@ -177,34 +367,239 @@ def main():
         plot_scan( cam, gsets, tls, args.label )
         return 0
 
+    if not args.resume and journal.unfinished():
+        if not args.new_scan:
+            print('Journal', journal.fname, 'holds an unfinished scan: continue it with --resume or start over with --new-scan')
+            return 1
+        print('Unfinished scan journal moved to', journal.move_aside())
 
-    pgc=pg.pgcamera2()
-    gantry.locate_home_xyz();
-    for n,gset in enumerate(gsets):
-        print('move',n,'to',gset)
-        curx, cury, curz, curphi, curtheta = gset
-        curphi*=rad2deg
-        curtheta*=-rad2deg
-        
-        gantry.move( "DM", "DM", curz )
-        gantry.move( curx, cury,"DM",curphi,curtheta,1000,1000,1000,200,200)
-        time.sleep(1)
-        
-        #capturing image(s) here
+    if args.emulate:
+        # keep the emulated position away from the real galil_last_position.txt
+        posfile = tempfile.NamedTemporaryFile( mode='w', prefix='galil_emulated_position_', suffix='.txt', delete=False )
+        posfile.write('0, 0, 0, 0, 0')
+        posfile.close()
+        gantry = gc.gantrycontrol( posfile.name, backend='emulator', time_warp=args.time_warp, calibration=args.calibration )
+        tracing.set_clock( gantry.clock ) # trace the emulated time
+    else:
+        gantry = gc.gantrycontrol( calibration=args.calibration )
+    if args.telemetry > 0:
+        gantry.start_telemetry( args.telemetry/1000., spill=args.telemetry_spill if args.telemetry_spill != '' else None )
+
+    manifest = None
+    if len(cameras) > 0:
+        pgc=pg.pgcamera2( max_pending=args.max_pending, backend=camera_workers.backends[args.camera_backend] )
+        if args.manifest != '':
+            manifest = image_manifest( args.manifest )
+            manifest.start_scan( scan_id, args.label, args.param_file, plan.key, len(gsets) )
+    qa = None
+    if len(cameras) > 0 and args.qa:
+        checkerboard = tuple( int(v) for v in args.qa_checkerboard.lower().split('x') ) if args.qa_checkerboard != '' else None
+        qa = image_qa( min_sharpness=args.qa_min_sharpness, max_clipped=args.qa_max_clipped, checkerboard=checkerboard )
+        if args.defer_download:
+            # check the images once they are downloaded
+            pgc.on_download = lambda icam, fname, ok: qa.submit( fname ) if ok else qa.record( fname, 'not downloaded' )
+    latest = {} # (point, camera) -> newest image file, None if the capture failed
+    def capture( n, cams=None, suffix='' ):
+        #capturing image(s) here with cams (default all), returns (camera, serial number, file) of each image
+        images = []
+        cams = cameras if cams is None else cams
         if args.rayfin == True:
             capture_command = ['ssh','jamieson@hyperk.uwinnipeg.ca','python /home/jamieson/HyperK_Summer_Photogrammetry/RayfinRelated/RayfinTCP_takepicture.py -i 192.168.0.102 -l 192.168.0.100 -p 8888' ]
             print(capture_command)
-            capture=subprocess.run( capture_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10 )
+            with tracing.span( 'rayfin', 'camera' ):
+                capture=subprocess.run( capture_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10 )
             time.sleep(5)
 
-        else:
-            for icam in args.camera[0]:
-                label = str(n) + 'pch' + icam + '_' + args.label + '_z'+\
-                        str(round(curz,1))+'_y'+str(round(cury,1))+'_x'+str(round(curx,1))
-                print(label)
-                pgc.capture_image( int(icam), dir='', label=label, append_date=False)
+        elif len(cameras) > 0:
+            labels = {}
+            for icam in cams:
+                labels[icam] = str(n) + 'pch' + icam + '_' + args.label + '_' + point_label( gsets[n] ) + suffix
+                print(labels[icam])
+            results = pgc.capture_all( cams, dir='', label=labels, append_date=False, deferred=args.defer_download )
+            for icam, res in results.items():
+                latest[(n, icam)] = res['file']
+                if res['error'] is not None:
+                    print('camera',icam,'failed at point',n,':',res['error'])
+                else:
+                    images.append( ( icam, res.get('serial'), res['file'] ) )
+                    if qa is not None and not args.defer_download:
+                        qa.submit( res['file'] )
+        return images
+
+    def failing( n, wait=0., report=False ):
+        # cameras whose newest image of point n failed its checks, waiting up to wait s for them
+        tend = time.monotonic() + wait
+        bad = []
+        for icam in cameras:
+            fname = latest.get( (n, icam) )
+            result = qa.result( fname, max( tend - time.monotonic(), 0. ) ) if fname is not None else None
+            if fname is None or ( result is not None and not result['ok'] ):
+                bad.append( icam )
+                if report and result is not None:
+                    print('QA: point',n,'camera',icam,':','; '.join( result['problems'] ))
+        return bad
+
+    def retake( n, images ):
+        # retake the images of point n that fail their checks while the gantry is still there
+        wait = 0. if args.defer_download else args.qa_wait # downloads come later, revisit those at the end
+        for k in range( 1, args.qa_retakes+1 ):
+            bad = failing( n, wait, report=True )
+            if len(bad) == 0:
+                break
+            print('QA: retaking point', n, 'camera(s)', ', '.join( bad ))
+            with tracing.span( 'retake', 'scan', n=n ):
+                images = images + capture( n, bad, '_retake'+str(k) )
+        return images
+
+    def stage_units( stage ):
+        # gantry setting units (mm, rad) to gantrycontrol.move units (mm, degrees)
+        x, y, z, phi, theta = stage
+        if phi is not None:
+            phi*=rad2deg
+        if theta is not None:
+            theta*=-rad2deg
+        return [ x, y, z, phi, theta ]
+
+    point_times = []
+    def at_point( n ):
+        # take the images and record the time spent on this point, move included
+        t_capture = gantry.clock()
+        with tracing.span( 'images', 'scan', n=n ):
+            images = capture( n )
+        if qa is not None:
+            images = retake( n, images )
+        record_point( n, images, t_capture )
+        t_point = gantry.clock()
+        point_times.append( t_point - (t_homed + sum(point_times)) )
+
+    def record_point( n, images, t_capture ):
+        # the pose of the images: encoder position when they were taken with telemetry, else read now (TP)
+        counts = gantry.encoder_position( t_capture )
+        files = [ latest[(n, icam)] for icam in cameras if latest.get( (n, icam) ) is not None ]
+        journal.point( n, gsets[n], counts, files )
+        if manifest is not None:
+            measured = setting_units( gantry.units.from_counts( counts ) )
+            t_wall = time.time() - ( gantry.clock() - t_capture )
+            with tracing.span( 'manifest', 'file' ):
+                for icam, serial, fname in images:
+                    manifest.add_image( scan_id, n, gsets[n], measured, tls[n], icam, serial, fname, t_wall )
+
+    def revisit( cur ):
+        # go back to the points whose images still fail their checks, from gantry setting cur
+        qa.wait_all()
+        points = [ n for n in range( first, len(gsets) ) if len( failing( n, report=True ) ) > 0 ]
+        if len(points) == 0:
+            return
+        print('QA: revisiting', len(points), 'points:', points)
+        if len(points) > 1:
+            points = [ points[i] for i in optimize_scan_order( [ gsets[n] for n in points ], start=cur ) ]
+        for n in points:
+            bad = failing( n )
+            with tracing.span( 'revisit', 'scan', n=n ):
+                if args.plan_moves:
+                    try:
+                        stages = motion_planner( param.get_keepout() ).plan( cur, gsets[n] )
+                    except PlanningError as e:
+                        print('QA: can not revisit point', n, ':', e)
+                        continue
+                else:
+                    stages = [ [None, None, gsets[n][2], None, None], [gsets[n][0], gsets[n][1], None, gsets[n][3], gsets[n][4]] ]
+                for stage in stages:
+                    x, y, z, phi, theta = [ "DM" if v is None else v for v in stage_units( stage ) ]
+                    gantry.move( x, y, z, phi, theta, *plan.speeds[n].tolist() )
+                gantry.wait_settled()
+                t_capture = gantry.clock()
+                images = capture( n, bad, '_revisit' )
+                record_point( n, images, t_capture )
+            cur = gsets[n]
+        pgc.flush()
+        qa.wait_all()
+        still = [ n for n in points if len( failing( n ) ) > 0 ]
+        if len(still) > 0:
+            print('QA: images of', len(still), 'points still fail their checks:', still)
+
+    # a resumed scan starts from home unless the controller kept its position
+    trusted = first > 0 and gantry.position_trusted( journal.last_counts( first ) )
+    if first > 0 and not trusted and args.plan_moves:
+        try:
+            plans[first] = motion_planner( param.get_keepout() ).plan( home, gsets[first] )
+        except PlanningError as e:
+            print('The scan can not be resumed from home:', e)
+            return 1
+        plan = compile_plan( gsets, tls, plans, home, gantry.units, key )
+
+    # check the counts of the whole scan before anything moves
+    try:
+        gantry.check_counts( plan.stage_counts( first ) )
+    except ValueError as e:
+        print('The scan leaves the range of the gantry:', e)
+        print('Use --drop-below-home to leave out the points below home')
+        return 1
+
+    if not args.resume:
+        journal.start( gsets, plans, param_file=args.param_file, label=args.label, scan_id=scan_id )
+    t_start = gantry.clock()
+    if trusted:
+        print('The controller kept its position since point '+str(first-1)+', continuing without homing')
+    else:
+        gantry.home( trust=args.trust_position, fast=args.fast_home, index=args.home_index )
+    t_homed = gantry.clock()
+    saved_start = gantry.saved_round_trips
+    if args.table:
+        points = [ [ stage_units( stage ) for stage in stages ] for stages in plans[first:] ]
+        gantry.run_scan_table( points, lambda k: at_point( first+k ), plan.speeds[first].tolist(), counts=plan.stage_counts( first ) )
+    else:
+        for n in range( first, len(gsets) ):
+            gset = gsets[n]
+            with tracing.span( 'point', 'scan', n=n ):
+                print('move',n,'to',gset)
+                for stage in plans[n]:
+                    x, y, z, phi, theta = [ "DM" if v is None else v for v in stage_units( stage ) ]
+                    with tracing.span( 'move', 'motion' ):
+                        gantry.move( x, y, z, phi, theta, *plan.speeds[n].tolist() )
+                gantry.wait_settled()
+                at_point( n )
+    if len(cameras) > 0:
+        failed = pgc.flush()
+        if len(failed) > 0:
+            print(len(failed), 'images were not downloaded')
+        if qa is not None:
+            revisit( gsets[-1] )
+            qa.close()
+        if manifest is not None:
+            manifest.update_files()
+            if qa is not None:
+                for fname, result in qa.results.items():
+                    manifest.set_qa( fname, result )
+            manifest.close()
 
+    t_end = gantry.clock()
+    if args.time_per_pos != '':
+        with tracing.span( 'time_per_pos', 'file' ), open( args.time_per_pos, 'w' ) as f_time:
+            f_time.write( ', '.join( str(t) for t in point_times ) )
+    rate = (len(gsets)-first) * 3600.0 / (t_end - t_homed)
+    print('Predicted', round(est['total'], 1), 's for the scan')
+    print('Homing took', round(t_homed - t_start, 1), 's')
+    print('Scanned', len(gsets)-first, 'points in', round(t_end - t_homed, 1), 's =', round(rate, 1), 'points/hour')
+    print('Controller round trips saved by the cache:', gantry.saved_round_trips - saved_start)
+    if len(gantry.settle_times) > 0:
+        print('Settle time: mean', round(np.mean(gantry.settle_times), 3), 's, max', round(np.max(gantry.settle_times), 3), 's')
+    if gantry.telemetry is not None:
+        print('Data records received:', gantry.telemetry.count, ', unreadable:', gantry.telemetry.errors)
+        gantry.stop_telemetry()
+    if args.trace != '':
+        tracing.export_chrome( args.trace )
+        csvname = os.path.splitext( args.trace )[0] + '.csv'
+        tracing.export_csv( csvname )
+        print('Trace written to', args.trace, 'and', csvname, ', most time spent in:')
+        for name, cat, count, total, mean, longest in tracing.summary()[:8]:
+            print('  %-16s %-10s %6d x %8.4f s = %8.1f s' % (name, cat, count, mean, total))
+    tracing.set_clock( None ) # let go of the gantry, so it is closed when main returns
     print('Done')
+    if rate < args.min_rate:
+        print('Throughput', round(rate, 1), 'points/hour is below --min-rate', args.min_rate)
+        return 1
+    return 0
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -78,6 +78,7 @@ class Parameters:
 param=Parameters()
 
 gantry = gc.gantrycontrol()
+pgc=pg.pgcamera2()
 
 # zero the gantry; Moves the gantry to home(where all limit switches are)
 # please position gantry at starting point!
@@ -90,7 +91,13 @@ ymin=param.y_min
 zstep=param.z_step
 ystep=param.y_step
 
-cury = ymin
+#y of the pictures of each row, the rows go back and forth starting one step from ymin
+ys=[]
+cury=ymin
+for i in range( param.nz ):
+    ys.append( cury+ystep*np.arange( 1, param.ny+1 ) )
+    cury=ys[-1][-1]
+    ystep=-ystep
 
 n=1 #For keeping track of which z height we are in. For the purpose of assigning filename to images.
 e=1 #Keeping track of error #.
@@ -105,21 +112,18 @@ for i in range( param.nz ):
         t1 = datetime.now() #initial time
         print('Picture no: ',n)
         #print('cur t = ',t)
-        cury += ystep
+        cury = ys[i][j]
         print("z=",curz,' y =',cury)
-        label = str(n)+'_pch7_air_r1c_z'+str(round(curz,1))+'_y'+str(round(cury,1))
-        print(label)
+        labels = { 7: str(n)+'_pch7_air_r1c_z'+str(round(curz,1))+'_y'+str(round(cury,1)),
+                   4: str(n)+'_pch4_air_r1c_z'+str(round(curz,1))+'_y'+str(round(cury,1)) }
+        label = labels[4]
+        print(labels)
 
 
         gantry.move( "DM", cury, curz,"DM","DM",1000,1000,1000,100,100)
-        time.sleep(1)
-
-        pgc=pg.pgcamera2()
-        pgc.capture_image(7,dir='',label=label,append_date=False)
+        gantry.wait_settled()
 
-        label = str(n)+'_pch4_air_r1c_z'+str(round(curz,1))+'_y'+str(round(cury,1))
-        print(label)
-        pgc.capture_image(4,dir='',label=label,append_date=False)
+        pgc.capture_all([7,4],dir='',label=labels,append_date=False)
 
         capture_command = ['gphoto2','--wait-event=3s','--capture-image-and-download','--filename='+str(label)+".jpg" ]
         print(capture_command)
@@ -141,9 +145,6 @@ for i in range( param.nz ):
 
 
 
-	# flip sign of phi step to step back!
-    print('flip sign of y step')
-    ystep = -ystep
     time.sleep(1)
     n+=1
 
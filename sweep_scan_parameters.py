@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#*****************************************************************************************#
+#  This Program evaluates a grid of spherical scan parameters (Rscan, phi range, theta
+#  range, camera position) on all cores, to help choose the values for
+#  parameters_sphere.txt without trial and error dry runs.
+#
+#  For each parameter set it reports:
+#    - the number of scan points whose gantry setting is within the soft limits (FL)
+#    - the predicted scan duration (moves + a fixed overhead per point)
+#    - the angular coverage (solid angle of the reachable points)
+#
+#  Results are cached in a json file, so sweeping again only computes the new grid cells.
+#
+#  Example:
+#    python sweep_scan_parameters.py --fl 135000,130000,90000 --Rscan 400 450 500 \
+#           --phimin -70 -60 --phimax 60 70 --thetamin 20 30 --campos 800,500,-600 800,550,-600
+#*******************************************************************************************
+
+import argparse
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import sys
+import numpy as np
+from gantry_spherical_scan import camera, get_gantry_settings_array
+from axis_units import axis_units
+from scan_order import motion_model
+from scan_plan import stage_units
+from scan_spherical import Parameters
+
+deg2rad   = np.pi/180.0
+rad2deg   = 180.0/np.pi
+
+sweep_version = 1 # bump when the evaluation changes so old cached results are not reused
+
+
+def cell_key( cell ):
+    '''Hash identifying a grid cell (including limits, overheads and sweep_version)'''
+    text = json.dumps( dict( cell, version=sweep_version ), sort_keys=True )
+    return hashlib.sha1( text.encode('ASCII') ).hexdigest()
+
+
+def evaluate_cell( cell ):
+    '''
+    Evaluate one parameter set.  cell is a dict with Nscan, Rscan, phimin, phimax,
+    thetamin, thetamax (degrees), campos, camfacing, fl (soft limits in counts),
+    overhead (seconds per point), calibration (axis_units calibration tables).
+    Returns a dict of results.
+    '''
+    cam = camera( np.array(cell['campos']), np.array(cell['camfacing']) )
+    rvecs = cam.get_scanpoints_array( cell['Nscan'], cell['Rscan'],
+                                      cell['phimin']*deg2rad, cell['phimax']*deg2rad,
+                                      cell['thetamin']*deg2rad, cell['thetamax']*deg2rad )
+    gsets, tls = get_gantry_settings_array( cam, rvecs )
+    # counts as sent by gantrycontrol.move
+    counts = axis_units( tables=cell['calibration'] ).to_counts( stage_units( gsets ), rounded=False )
+    fl = np.array( cell['fl'], dtype=float )
+    reachable = np.all( (counts[:,:3] >= 0.) & (counts[:,:3] <= fl), axis=1 )
+
+    # predicted duration of visiting the reachable points in scan order, starting from home
+    path = np.vstack( [ np.zeros(5), counts[reachable] ] )
+    tmove = float( np.sum( motion_model().move_time( path[:-1], path[1:] ) ) )
+    nreach = int( np.sum(reachable) )
+    duration = tmove + nreach*cell['overhead']
+
+    # solid angle of the scanned patch of sphere, scaled by the fraction reached
+    patch = (cell['phimax']-cell['phimin'])*deg2rad * ( np.cos(cell['thetamin']*deg2rad) - np.cos(cell['thetamax']*deg2rad) )
+    npts = len(gsets)
+    result = { 'npoints': npts,
+               'nreachable': nreach,
+               'duration_s': duration,
+               'solid_angle_sr': patch * nreach / max(npts,1) }
+    for name, col in (('phi',3), ('theta',4)):
+        vals = gsets[reachable,col]*rad2deg
+        result[name+'_range_deg'] = [ float(np.min(vals)), float(np.max(vals)) ] if nreach > 0 else None
+    return result
+
+
+def load_cache( fname ):
+    try:
+        with open( fname, 'r' ) as f:
+            return json.load( f )
+    except FileNotFoundError:
+        return {}
+
+
+def save_cache( fname, cache ):
+    tmpname = fname + '.tmp'
+    with open( tmpname, 'w' ) as f:
+        json.dump( cache, f )
+    os.replace( tmpname, fname )
+
+
+def parse_vec( text ):
+    return [ float(v) for v in text.split(',') ]
+
+
+def main():
+    parser = argparse.ArgumentParser( description='Sweep spherical scan parameters' )
+    parser.add_argument('-p','--param_file',default='parameters_sphere.txt', help='Parameter file with the values not swept')
+    parser.add_argument('--fl',default=None,type=parse_vec,help='x,y,z soft limits in counts (default: ask the controller with FL)')
+    parser.add_argument('--Nscan',default=None,type=int,nargs='+',help='Number of scan points')
+    parser.add_argument('--Rscan',default=None,type=float,nargs='+',help='Scan radius(es) (mm)')
+    parser.add_argument('--phimin',default=None,type=float,nargs='+',help='Minimum phi(s) (deg)')
+    parser.add_argument('--phimax',default=None,type=float,nargs='+',help='Maximum phi(s) (deg)')
+    parser.add_argument('--thetamin',default=None,type=float,nargs='+',help='Minimum theta(s) (deg)')
+    parser.add_argument('--thetamax',default=None,type=float,nargs='+',help='Maximum theta(s) (deg)')
+    parser.add_argument('--campos',default=None,type=parse_vec,nargs='+',help='Camera positions x,y,z (mm)')
+    parser.add_argument('--calibration',default='axis_calibration.json',help='Axis calibration tables used by gantrycontrol (see axis_units.py)')
+    parser.add_argument('--overhead',default=2.0,type=float,help='Settle and capture time per point (s)')
+    parser.add_argument('-j','--jobs',default=None,type=int,help='Number of worker processes (default: all cores)')
+    parser.add_argument('--cache',default='sweep_scan_parameters_cache.json',help='File caching evaluated grid cells')
+    parser.add_argument('-o','--output',default='',help='Also write the results to this csv file')
+    args = parser.parse_args()
+
+    param = Parameters( args.param_file )
+    units = axis_units()
+    units.load( args.calibration )
+    fl = args.fl
+    if fl is None:
+        import gantrycontrol as gc
+        fl = list( gc.gantrycontrol().get_max() )
+    Nscans = args.Nscan or [ param.Nscan ]
+    Rscans = args.Rscan or [ param.Rscan ]
+    phimins = args.phimin or [ param.phimin*rad2deg ]
+    phimaxs = args.phimax or [ param.phimax*rad2deg ]
+    thetamins = args.thetamin or [ param.thetamin*rad2deg ]
+    thetamaxs = args.thetamax or [ param.thetamax*rad2deg ]
+    camposs = args.campos or [ list(param.campos) ]
+
+    cells = []
+    for N, R, phi1, phi2, theta1, theta2, pos in itertools.product( Nscans, Rscans, phimins, phimaxs, thetamins, thetamaxs, camposs ):
+        if phi2 <= phi1 or theta2 <= theta1:
+            continue
+        cells.append( { 'Nscan': N, 'Rscan': R, 'phimin': phi1, 'phimax': phi2,
+                        'thetamin': theta1, 'thetamax': theta2,
+                        'campos': list(pos), 'camfacing': list(param.camfacing),
+                        'fl': list(fl), 'overhead': args.overhead, 'calibration': units.tables } )
+    keys = [ cell_key(cell) for cell in cells ]
+
+    cache = load_cache( args.cache )
+    todo = [ (key, cell) for key, cell in zip( keys, cells ) if key not in cache ]
+    todo = list( dict( todo ).items() ) # same cell listed twice is only computed once
+    print('Grid of', len(cells), 'parameter sets,', len(cells)-len(todo), 'cached,', len(todo), 'to compute')
+    if len(todo) > 0:
+        with concurrent.futures.ProcessPoolExecutor( max_workers=args.jobs ) as pool:
+            results = pool.map( evaluate_cell, [ cell for key, cell in todo ], chunksize=max( 1, len(todo)//(4*(args.jobs or os.cpu_count() or 1)) ) )
+            for (key, cell), result in zip( todo, results ):
+                cache[key] = dict( result, cell=cell )
+        save_cache( args.cache, cache )
+
+    header = 'Nscan,Rscan,phimin,phimax,thetamin,thetamax,camx,camy,camz,npoints,nreachable,duration_s,solid_angle_sr'
+    lines = []
+    for key in keys:
+        res = cache[key]
+        cell = res['cell']
+        lines.append( (res['nreachable'], ','.join( str(v) for v in
+            [ cell['Nscan'], cell['Rscan'], cell['phimin'], cell['phimax'], cell['thetamin'], cell['thetamax'] ]
+            + cell['campos'] + [ res['npoints'], res['nreachable'], round(res['duration_s'],1), round(res['solid_angle_sr'],4) ] ) ) )
+    lines.sort( key=lambda x: -x[0] )
+    print( header )
+    for n, line in lines:
+        print( line )
+    if args.output != '':
+        with open( args.output, 'w' ) as f:
+            f.write( header+'\n' )
+            for n, line in lines:
+                f.write( line+'\n' )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
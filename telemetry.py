@@ -0,0 +1,233 @@
+'''
+telemetry streams the controller's data records into a ring buffer, so the
+position, velocity, position error, limit switches and status of every axis
+can be read without sending commands to the controller.
+
+The controller sends a data record every period (DR, started with
+GRecordRate) and a reader thread decodes each one with GRecord into a
+structured NumPy array.  Records are stamped with the controller's sample
+counter, converted to the host clock, and kept in a ring buffer of the most
+recent ones, optionally spilled to a file so a whole scan can be looked at
+afterwards (see read_spill).
+
+gantrycontrol.start_telemetry() uses it to wait for the motion to complete,
+for the servos to settle and to read the encoder position when the images
+are taken, with no controller round trips.
+
+The record layout is the DMC-4000 one: a 74 byte general block (header, I/O,
+coordinated planes) followed by a 36 byte block per axis.
+
+Usage:
+
+> import telemetry
+> tel = telemetry.telemetry( g, period=0.01, clock=gantry.clock )  # g: open gclib connection
+> tel.start()
+> tel.wait_for( gantry.clock() )        # block until a record of the current time arrived
+> tel.latest()['position']              # counts of each axis in the newest record
+> tel.position_at( t )                  # position interpolated at time t
+> tel.window( t0, t1 )['error']         # position errors of the records between t0 and t1
+> tel.stop()
+'''
+import threading
+import time
+import numpy as np
+import gclib
+
+general_block = 74 # bytes before the first axis block
+axis_block = 36    # bytes per axis
+
+# status bits of each axis (axis status word)
+status_moving = 1 << 15
+status_negative = 1 << 7
+status_motor_off = 1 << 0
+
+# switch bits of each axis, 0 when the switch is tripped (like _LF and _LR)
+switch_forward_limit = 1 << 3
+switch_reverse_limit = 1 << 2
+switch_home = 1 << 1
+
+axis_dtype = np.dtype( { 'names': [ 'status', 'switches', 'stop_code', 'reference', 'position', 'error',
+                                    'aux_position', 'velocity', 'torque', 'analog', 'hall', 'variable' ],
+                         'formats': [ '<u2', 'u1', 'u1', '<i4', '<i4', '<i4', '<i4', '<i4', '<i4', '<i2', 'u1', '<i4' ],
+                         'offsets': [ 0, 2, 3, 4, 8, 12, 16, 20, 24, 28, 30, 32 ],
+                         'itemsize': axis_block } )
+
+
+def record_dtype( naxes=5 ):
+    '''NumPy dtype of a data record of a controller with naxes axes'''
+    return np.dtype( { 'names': [ 'header', 'length', 'sample', 'inputs', 'outputs', 'error_code',
+                                  'thread_status', 'amplifier_status', 'axes' ],
+                       'formats': [ 'u1', '<u2', '<u2', ('u1', 10), ('u1', 10), 'u1', 'u1', '<u4', (axis_dtype, naxes) ],
+                       'offsets': [ 0, 2, 4, 6, 16, 42, 43, 44, general_block ],
+                       'itemsize': general_block + naxes*axis_block } )
+
+
+def decode( data, naxes=5 ):
+    '''Decode the bytes of one data record (as returned by GRecord) into a structured array element'''
+    dtype = record_dtype( naxes )
+    if len(data) < dtype.itemsize or data[0] & 0x80 == 0:
+        raise ValueError( 'not a data record of ' + str(naxes) + ' axes (' + str(len(data)) + ' bytes)' )
+    return np.frombuffer( data[:dtype.itemsize], dtype=dtype )[0]
+
+
+def spill_dtype( naxes=5 ):
+    '''Layout of the records spilled to file: host time (s) then the record'''
+    return np.dtype( [ ('t', '<f8'), ('record', record_dtype( naxes )) ] )
+
+
+def read_spill( fname, naxes=5 ):
+    '''Records spilled to fname, as a structured array with fields t and record'''
+    return np.fromfile( fname, dtype=spill_dtype( naxes ) )
+
+
+class telemetry:
+    '''
+    Ring buffer of the data records streamed by the controller.
+
+    g        = open gclib connection (gclib.py or the emulator)
+    period   = seconds between records
+    capacity = number of records kept
+    spill    = file the records are appended to, every spill_every records (None to not keep them)
+    clock    = host clock the records are stamped with (gantrycontrol.clock for the emulator)
+    sample_period = seconds per controller sample (TM/1e6)
+    '''
+    def __init__( self, g, period=0.01, capacity=60000, spill=None, spill_every=1000, clock=time.monotonic,
+                  naxes=5, sample_period=0.001 ):
+        self.g = g
+        self.period = period
+        self.spill = spill
+        self.spill_every = spill_every
+        self.clock = clock
+        self.naxes = naxes
+        self.sample_period = sample_period
+        self.times = np.zeros( capacity )
+        self.records = np.zeros( capacity, dtype=record_dtype( naxes ) )
+        self.count = 0       # records received
+        self.spilled = 0     # records written to the spill file
+        self.errors = 0      # records that could not be read or decoded
+        self.offset = None   # host clock - controller sample time, smallest seen (least delayed record)
+        self.changed = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    def start( self ):
+        '''Start the record stream and the reader thread'''
+        if self.spill is not None:
+            open( self.spill, 'wb' ).close()
+        self.running = True
+        self.g.GRecordRate( self.period*1000. )
+        self.thread = threading.Thread( target=self.read_records, name='telemetry', daemon=True )
+        self.thread.start()
+
+    def stop( self ):
+        '''Stop the record stream and write the records not spilled yet'''
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.g.GRecordRate( 0 )
+        self.write_spill()
+
+    def read_records( self ):
+        last = None # unwrapped sample number of the previous record
+        while self.running:
+            try:
+                data = self.g.GRecord( gclib.G_DR )
+                received = self.clock()
+                record = decode( data, self.naxes )
+            except (gclib.GclibError, ValueError):
+                self.errors += 1
+                continue
+            # the sample counter wraps every 65536 samples, unwrap it from the receive time
+            sample = int( record['sample'] )
+            if self.offset is not None:
+                expected = ( received - self.offset )/self.sample_period
+                sample += 65536*int( round( ( expected - sample )/65536. ) )
+            if last is not None and sample <= last:
+                continue # duplicate or out of order
+            last = sample
+            self.offset = min( self.offset, received - sample*self.sample_period ) if self.offset is not None \
+                          else received - sample*self.sample_period
+            with self.changed:
+                i = self.count % len(self.times)
+                self.times[i] = self.offset + sample*self.sample_period
+                self.records[i] = record
+                self.count += 1
+                self.changed.notify_all()
+            if self.spill is not None and self.count - self.spilled >= self.spill_every:
+                self.write_spill()
+
+    def write_spill( self ):
+        '''Append the records received since the last spill to the spill file'''
+        if self.spill is None:
+            return
+        with self.changed:
+            first = max( self.spilled, self.count - len(self.times) )
+            idx = np.arange( first, self.count ) % len(self.times)
+            chunk = np.zeros( len(idx), dtype=spill_dtype( self.naxes ) )
+            chunk['t'] = self.times[idx]
+            chunk['record'] = self.records[idx]
+            self.spilled = self.count
+        with open( self.spill, 'ab' ) as f:
+            chunk.tofile( f )
+
+    def ordered( self ):
+        '''Indices of the records in the buffer, oldest first'''
+        n = min( self.count, len(self.times) )
+        return np.arange( self.count - n, self.count ) % len(self.times)
+
+    def wait_for( self, t, timeout=1.0 ):
+        '''
+        Block until a record stamped t or later was received, at most timeout seconds
+        of real time.  Returns False if none arrived.
+        '''
+        tend = time.monotonic() + timeout
+        with self.changed:
+            while self.count == 0 or self.times[ (self.count-1) % len(self.times) ] < t:
+                remaining = tend - time.monotonic()
+                if remaining <= 0 or not self.running:
+                    return False
+                self.changed.wait( remaining )
+        return True
+
+    def latest( self ):
+        '''Newest record as a dict of per-axis arrays (see window), None before the first record'''
+        with self.changed:
+            if self.count == 0:
+                return None
+            i = (self.count-1) % len(self.times)
+            return self.fields( self.times[i], self.records[i] )
+
+    def window( self, t0, t1=None ):
+        '''Records stamped between t0 and t1 (default: all since t0) as a dict of arrays, one row per record'''
+        with self.changed:
+            idx = self.ordered()
+            times = self.times[idx]
+            first = np.searchsorted( times, t0, side='left' )
+            last = len(times) if t1 is None else np.searchsorted( times, t1, side='right' )
+            return self.fields( times[first:last], self.records[idx[first:last]] )
+
+    def fields( self, t, records ):
+        axes = records['axes']
+        return { 't': t,
+                 'sample': records['sample'],
+                 'position': axes['position'],
+                 'reference': axes['reference'],
+                 'velocity': axes['velocity'],
+                 'error': axes['error'],
+                 'status': axes['status'],
+                 'switches': axes['switches'],
+                 'stop_code': axes['stop_code'],
+                 'moving': ( axes['status'] & status_moving ) != 0,
+                 'forward_limit': ( axes['switches'] & switch_forward_limit ) == 0,
+                 'reverse_limit': ( axes['switches'] & switch_reverse_limit ) == 0 }
+
+    def position_at( self, t ):
+        '''Position (counts) of each axis at time t, interpolated between the records around it'''
+        with self.changed:
+            idx = self.ordered()
+            if len(idx) == 0:
+                return None
+            times = self.times[idx]
+            positions = self.records['axes']['position'][idx].astype( float )
+        return np.array( [ np.interp( t, times, positions[:,k] ) for k in range( self.naxes ) ] )
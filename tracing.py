@@ -0,0 +1,170 @@
+'''
+tracing records timed spans (controller commands, motion waits, settling, camera
+triggers, downloads, file writes) so you can see which phase dominates each scan point.
+
+Spans go to a ring buffer holding the most recent ones, and can be exported as
+Chrome trace-event JSON (open in https://ui.perfetto.dev or chrome://tracing) and as
+a CSV summary with the count and total/mean/max time of each kind of span.
+
+Tracing is off until enable() is called.  While it is off span() returns a shared
+do-nothing context manager and traced() wrappers only check a flag, so the
+instrumentation costs well under a microsecond per call.
+
+Usage:
+
+> import tracing
+> tracing.enable()                       # or set GANTRY_TRACE=1, see below
+> with tracing.span( 'point', 'scan', n=3 ):
+>     ...
+> tracing.instrument( g, { 'GCommand': 'controller' } )  # trace methods of an object
+> tracing.set_clock( gantry.clock )     # emulated time when running on the emulator
+> tracing.export_chrome( 'trace.json' )
+> tracing.export_csv( 'trace.csv' )
+
+GANTRY_TRACE=1 traces any program using the gantry and writes gantry_trace.json
+and gantry_trace.csv when it exits; GANTRY_TRACE=name.json writes name.json and
+name.csv instead.
+'''
+import atexit
+import collections
+import csv
+import json
+import os
+import threading
+import time
+
+enabled = False
+buffer = collections.deque( maxlen=200000 ) # (name, cat, start ns, duration ns, thread id, args)
+thread_names = {}  # thread id -> name
+now = time.perf_counter_ns # clock of the spans (ns)
+
+
+class _null_span:
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc ):
+        return False
+
+_null = _null_span()
+
+
+class _span:
+    def __init__( self, name, cat, args ):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__( self ):
+        self.t0 = now()
+        return self
+
+    def __exit__( self, exc_type, exc, tb ):
+        t1 = now()
+        tid = threading.get_ident()
+        if tid not in thread_names:
+            thread_names[tid] = threading.current_thread().name
+        if exc_type is not None:
+            self.args = dict( self.args, error=repr(exc) )
+        buffer.append( (self.name, self.cat, self.t0, t1-self.t0, tid, self.args) )
+        return False
+
+
+def span( name, cat='', **args ):
+    '''Context manager timing a span called name in category cat, with args shown in the trace'''
+    if not enabled:
+        return _null
+    return _span( name, cat, args )
+
+
+def traced( func, name, cat='' ):
+    '''
+    Wrap func so each call is a span called name.  The first argument (eg. the
+    command sent) is kept in the span args.
+    '''
+    def call( *args, **kwargs ):
+        if not enabled:
+            return func( *args, **kwargs )
+        with _span( name, cat, { 'arg': str( args[0] )[:80] } if len(args) > 0 else {} ):
+            return func( *args, **kwargs )
+    return call
+
+
+def instrument( obj, methods ):
+    '''Replace the methods of obj given as { method name: category } by traced versions'''
+    for method, cat in methods.items():
+        setattr( obj, method, traced( getattr( obj, method ), method, cat ) )
+
+
+def enable( capacity=None ):
+    '''Start recording spans, keeping the last capacity of them (default: the current size)'''
+    global enabled, buffer
+    if capacity is not None and capacity != buffer.maxlen:
+        buffer = collections.deque( buffer, maxlen=capacity )
+    enabled = True
+
+
+def set_clock( seconds ):
+    '''
+    Time the spans with the function seconds() instead of the wall clock, eg. the
+    emulated controller clock (gantrycontrol.clock) for time warped emulator runs.
+    None goes back to the wall clock.
+    '''
+    global now
+    now = time.perf_counter_ns if seconds is None else lambda: int( seconds()*1e9 )
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def clear():
+    buffer.clear()
+
+
+def export_chrome( fname ):
+    '''Write the recorded spans as Chrome trace-event JSON'''
+    pid = os.getpid()
+    events = [ { 'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': { 'name': name } }
+               for tid, name in list( thread_names.items() ) ]
+    for name, cat, t0, dur, tid, args in list( buffer ):
+        events.append( { 'name': name, 'cat': cat, 'ph': 'X', 'ts': t0/1000., 'dur': dur/1000.,
+                         'pid': pid, 'tid': tid, 'args': args } )
+    with open( fname, 'w' ) as f:
+        json.dump( { 'traceEvents': events, 'displayTimeUnit': 'ms' }, f )
+
+
+def summary():
+    '''Rows of (name, cat, count, total s, mean s, max s), largest total first'''
+    stats = {}
+    for name, cat, t0, dur, tid, args in list( buffer ):
+        count, total, longest = stats.get( (name, cat), (0, 0, 0) )
+        stats[(name, cat)] = ( count+1, total+dur, max( longest, dur ) )
+    rows = [ ( name, cat, count, total*1e-9, total*1e-9/count, longest*1e-9 )
+             for (name, cat), (count, total, longest) in stats.items() ]
+    rows.sort( key=lambda row: -row[3] )
+    return rows
+
+
+def export_csv( fname ):
+    '''Write the summary() of the recorded spans as CSV'''
+    with open( fname, 'w', newline='' ) as f:
+        writer = csv.writer( f )
+        writer.writerow( [ 'name', 'category', 'count', 'total_s', 'mean_s', 'max_s' ] )
+        for row in summary():
+            writer.writerow( row[:3] + tuple( round( v, 6 ) for v in row[3:] ) )
+
+
+def export_at_exit( fname ):
+    '''Write the spans to the Chrome trace JSON file fname and its .csv summary when the program exits'''
+    def export():
+        export_chrome( fname )
+        export_csv( fname.rsplit( '.', 1 )[0] + '.csv' )
+        print('Trace written to', fname)
+    atexit.register( export )
+
+
+if os.environ.get( 'GANTRY_TRACE', '' ) not in ( '', '0' ):
+    enable()
+    export_at_exit( 'gantry_trace.json' if os.environ['GANTRY_TRACE'] == '1' else os.environ['GANTRY_TRACE'] )